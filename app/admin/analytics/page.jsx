@@ -71,6 +71,32 @@ export default function AdminAnalyticsPage() {
     return map
   }, [analytics, allUsers])
 
+  // Exports are streamed by the backend as gzipped CSV; the browser saves the file as it arrives
+  async function downloadExport(kind) {
+    setError('')
+    try {
+      const { data: { session } } = await supabase.auth.getSession()
+      if (!session) throw new Error('No active session')
+      const resp = await fetch(`http://localhost:8000/api/admin/export/${kind}?format=csv`, {
+        headers: { Authorization: `Bearer ${session.access_token}` },
+      })
+      if (!resp.ok) {
+        const payload = await resp.json().catch(() => ({}))
+        throw new Error(payload.detail || 'Export failed')
+      }
+      const disposition = resp.headers.get('Content-Disposition') || ''
+      const filename = disposition.match(/filename="([^"]+)"/)?.[1] || `${kind}.csv.gz`
+      const url = URL.createObjectURL(await resp.blob())
+      const link = document.createElement('a')
+      link.href = url
+      link.download = filename
+      link.click()
+      URL.revokeObjectURL(url)
+    } catch (e) {
+      setError(e.message || 'Export failed')
+    }
+  }
+
   function displayUser(uOrId) {
     const u = typeof uOrId === 'string' ? usersById[uOrId] : uOrId
     if (!u) return typeof uOrId === 'string' ? uOrId : '—'
@@ -92,6 +118,10 @@ export default function AdminAnalyticsPage() {
             <button onClick={() => router.push('/admin')} className="text-blue-600 hover:text-blue-700">← Back to Admin</button>
             <h1 className="text-2xl font-bold text-gray-900">System Analytics</h1>
           </div>
+          <div className="flex items-center gap-2">
+            <button onClick={() => downloadExport('diagnoses')} className="px-3 py-1.5 text-sm bg-white border rounded-md hover:bg-gray-50">Export analyses (CSV)</button>
+            <button onClick={() => downloadExport('users')} className="px-3 py-1.5 text-sm bg-white border rounded-md hover:bg-gray-50">Export users (CSV)</button>
+          </div>
         </div>
 
         {error && (
@@ -4,6 +4,7 @@ import { useEffect, useState } from 'react'
 import { useRouter } from 'next/navigation'
 import Link from 'next/link'
 import { supabase } from '../../lib/supabase'
+import { apiStream } from '../../lib/api'
 
 export default function AskAIPage() {
   const router = useRouter()
@@ -67,14 +68,18 @@ export default function AskAIPage() {
     setLoading(true)
     try {
       const context = typeof window !== 'undefined' ? localStorage.getItem('last_ai_findings') || '' : ''
-      const res = await fetch('/api/ask-ai', {
+      // The answer is streamed token by token; repeated questions come back from the cache at once
+      setAnswer('')
+      let failure = null
+      await apiStream('/api/ask-ai', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ question, context })
+      }, (event, data) => {
+        if (event === 'token') setAnswer(prev => prev + data.text)
+        else if (event === 'error') failure = data.error
       })
-      const data = await res.json()
-      if (!res.ok) throw new Error(data.error || 'Request failed')
-      setAnswer(data.answer)
+      if (failure) throw new Error(failure)
     } catch (e) {
       setError(e.message || 'Something went wrong')
     } finally {
@@ -155,14 +155,33 @@ export default function Dashboard() {
       const formData = new FormData()
       formData.append('file', selectedFile)
 
-      // Send file to AI backend
-      const response = await fetch('http://localhost:8000/api/ai/predict', {
-        method: 'POST',
-        headers: {
-          'Authorization': `Bearer ${session.access_token}`
-        },
-        body: formData
-      })
+      // The backend runs the model and saves the diagnosis in one request.
+      // Retries reuse the idempotency key, so they return the saved result
+      // instead of analyzing (and saving) the image twice.
+      const idempotencyKey = crypto.randomUUID()
+      let response
+      for (let attempt = 0; ; attempt++) {
+        try {
+          response = await fetch('http://localhost:8000/api/diagnoses/predict', {
+            method: 'POST',
+            headers: {
+              'Authorization': `Bearer ${session.access_token}`,
+              'Idempotency-Key': idempotencyKey
+            },
+            body: formData
+          })
+        } catch (networkError) {
+          if (attempt >= 2) throw networkError
+          await new Promise(resolve => setTimeout(resolve, 1000 * (attempt + 1)))
+          continue
+        }
+        if (response.status === 409 && attempt < 5) {
+          const retryAfter = Number(response.headers.get('Retry-After')) || 1
+          await new Promise(resolve => setTimeout(resolve, retryAfter * 1000))
+          continue
+        }
+        break
+      }
 
       if (!response.ok) {
         throw new Error(`AI analysis failed: ${response.statusText}`)
@@ -172,8 +191,8 @@ export default function Dashboard() {
       setPrediction(result)
       setShowPrediction(true)
 
-      // Save diagnosis to database
-      await saveDiagnosis(result)
+      // Reload diagnoses to update stats
+      await loadDiagnoses(user.id)
 
     } catch (error) {
       console.error('Upload error:', error)
@@ -183,26 +202,6 @@ export default function Dashboard() {
     }
   }
 
-  const saveDiagnosis = async (result) => {
-    try {
-      const { error } = await supabase
-        .from('diagnoses')
-        .insert({
-          user_id: user.id,
-          image_path: selectedFile.name, // Changed from image_name to image_path
-          predictions: result,
-          status: 'completed'
-        })
-
-      if (error) throw error
-
-      // Reload diagnoses to update stats
-      await loadDiagnoses(user.id)
-    } catch (error) {
-      console.error('Error saving diagnosis:', JSON.stringify(error, null, 2))
-    }
-  }
-
   const handleSignOut = async () => {
     await supabase.auth.signOut()
     router.push('/')
@@ -1,78 +1,83 @@
 'use client'
 
-import { useEffect, useState } from 'react'
+import { useEffect, useState, useCallback } from 'react'
 import { useRouter } from 'next/navigation'
 import { supabase } from '../../lib/supabase'
+import { listConversations, loadConversationMessages, markConversationRead } from '../../lib/conversations'
 
 export default function UserMessagesPage() {
   const router = useRouter()
   const [loading, setLoading] = useState(true)
-  const [items, setItems] = useState([])
   const [myId, setMyId] = useState(null)
   const [conversations, setConversations] = useState([])
   const [activeId, setActiveId] = useState(null)
-  const [profilesById, setProfilesById] = useState({})
+  const [messages, setMessages] = useState([])
+  const [olderCursor, setOlderCursor] = useState(null)
+  const [moreConversations, setMoreConversations] = useState(null)
   const [inputText, setInputText] = useState('')
   const [sending, setSending] = useState(false)
   const [replyText, setReplyText] = useState('')
   const [replyTarget, setReplyTarget] = useState(null)
   const [busy, setBusy] = useState(false)
 
+  // The inbox comes from the backend's conversation index: one row per peer
+  // with the last message and unread count, however long the history is
+  const loadConversations = useCallback(async () => {
+    try {
+      const page = await listConversations()
+      setConversations(page.conversations)
+      setMoreConversations(page.next_cursor)
+      setActiveId(current => current || page.conversations[0]?.peer_id || null)
+    } catch (e) {
+      console.warn('Load conversations error', e)
+    }
+  }, [])
+
+  async function loadMoreConversations() {
+    if (!moreConversations) return
+    try {
+      const page = await listConversations(moreConversations)
+      setConversations(prev => [...prev, ...page.conversations])
+      setMoreConversations(page.next_cursor)
+    } catch (e) { console.warn('Load conversations error', e) }
+  }
+
+  const openConversation = useCallback(async (peerId) => {
+    if (!peerId) return
+    try {
+      const page = await loadConversationMessages(peerId)
+      setMessages(page.messages.slice().reverse())
+      setOlderCursor(page.next_cursor)
+      setConversations(prev => prev.map(c => c.peer_id === peerId ? { ...c, unread_count: 0 } : c))
+      await markConversationRead(peerId)
+    } catch (e) { console.warn('Load messages error', e) }
+  }, [])
+
+  async function loadOlderMessages() {
+    if (!activeId || !olderCursor) return
+    try {
+      const page = await loadConversationMessages(activeId, olderCursor)
+      setMessages(prev => [...page.messages.slice().reverse(), ...prev])
+      setOlderCursor(page.next_cursor)
+    } catch (e) { console.warn('Load messages error', e) }
+  }
+
   useEffect(() => {
     (async () => {
       const { data: { user } } = await supabase.auth.getUser()
       if (!user) { router.push('/auth'); return }
       setMyId(user.id)
-      const { data, error } = await supabase
-        .from('messages')
-        .select('id, created_at, content, from_user_id, to_user_id')
-        .or(`from_user_id.eq.${user.id},to_user_id.eq.${user.id}`)
-        .order('created_at', { ascending: false })
-      if (error) console.warn('Load messages error', error)
-      setItems(data || [])
-      buildConversations(user.id, data || [])
+      await loadConversations()
       setLoading(false)
     })()
-  }, [router])
+  }, [router, loadConversations])
 
-  function buildConversations(uid, msgs) {
-    const map = new Map()
-    for (const m of msgs) {
-      const other = m.from_user_id === uid ? m.to_user_id : m.from_user_id
-      const prev = map.get(other)
-      if (!prev || new Date(m.created_at) > new Date(prev.created_at)) map.set(other, m)
-    }
-    const list = Array.from(map.entries()).map(([otherId, lastMessage]) => ({ otherId, lastMessage }))
-    list.sort((a,b) => new Date(b.lastMessage.created_at) - new Date(a.lastMessage.created_at))
-    setConversations(list)
-    if (!activeId && list.length) setActiveId(list[0].otherId)
-
-    // Try to fetch counterpart profiles for display
-    const otherIds = list.map(c => c.otherId)
-    if (otherIds.length) {
-      supabase.from('messaging_profiles').select('id, username, email, first_name, last_name')
-        .in('id', otherIds)
-        .then(({ data }) => {
-          if (Array.isArray(data)) {
-            const dict = {}
-            data.forEach(p => { dict[p.id] = p })
-            setProfilesById(dict)
-          }
-        })
-        .catch(() => {})
-    }
-  }
-
-  const activeMessages = items
-    .filter(m => activeId && (m.from_user_id === activeId || m.to_user_id === activeId))
-    .sort((a,b) => new Date(a.created_at) - new Date(b.created_at))
+  useEffect(() => { openConversation(activeId) }, [activeId, openConversation])
 
   function displayName(id) {
-    const p = profilesById[id]
+    const p = conversations.find(c => c.peer_id === id)?.peer
     // Avoid showing raw UUIDs; prefer human-friendly fields
-    if (!p) return 'Unknown user'
-    const full = [p.first_name, p.last_name].filter(Boolean).join(' ').trim()
-    return full || p.username || p.email || 'User'
+    return p?.display_name || 'Unknown user'
   }
 
   async function sendMessage() {
@@ -88,14 +93,7 @@ export default function UserMessagesPage() {
         content: text,
       })
       if (error) throw error
-      // reload messages
-      const { data } = await supabase
-        .from('messages')
-        .select('id, created_at, content, from_user_id, to_user_id')
-        .or(`from_user_id.eq.${user.id},to_user_id.eq.${user.id}`)
-        .order('created_at', { ascending: false })
-      setItems(data || [])
-      buildConversations(user.id, data || [])
+      await Promise.all([loadConversations(), openConversation(activeId)])
     } catch (e) {
       alert(e.message || 'Failed to send')
     } finally { setSending(false) }
@@ -112,7 +110,7 @@ export default function UserMessagesPage() {
             <button onClick={() => router.back()} className="px-3 py-2 text-sm rounded-md bg-black text-white hover:bg-gray-900">Back</button>
           </div>
         </div>
-        {items.length === 0 ? (
+        {conversations.length === 0 ? (
           <div className="bg-white shadow rounded-md p-4 text-sm text-gray-500">No messages yet. Use Consult a doctor on Ask AI.</div>
         ) : (
           <div className="bg-white shadow rounded-lg grid grid-cols-1 md:grid-cols-3" style={{minHeight: '480px'}}>
@@ -122,14 +120,22 @@ export default function UserMessagesPage() {
               <div className="space-y-1">
                 {conversations.map(c => (
                   <button
-                    key={c.otherId}
-                    onClick={() => setActiveId(c.otherId)}
-                    className={`w-full text-left px-3 py-2 rounded-md border ${activeId === c.otherId ? 'bg-blue-50 border-blue-200' : 'hover:bg-gray-50 border-transparent'}`}
+                    key={c.peer_id}
+                    onClick={() => setActiveId(c.peer_id)}
+                    className={`w-full text-left px-3 py-2 rounded-md border ${activeId === c.peer_id ? 'bg-blue-50 border-blue-200' : 'hover:bg-gray-50 border-transparent'}`}
                   >
-                    <div className="text-sm font-medium text-gray-900 truncate">{displayName(c.otherId)}</div>
-                    <div className="text-xs text-gray-500 truncate">{c.lastMessage.content}</div>
+                    <div className="flex items-center justify-between gap-2">
+                      <div className="text-sm font-medium text-gray-900 truncate">{displayName(c.peer_id)}</div>
+                      {c.unread_count > 0 && (
+                        <span className="shrink-0 rounded-full bg-blue-600 px-2 text-[10px] font-semibold text-white">{c.unread_count}</span>
+                      )}
+                    </div>
+                    <div className="text-xs text-gray-500 truncate">{c.last_message.content}</div>
                   </button>
                 ))}
+                {moreConversations && (
+                  <button onClick={loadMoreConversations} className="w-full px-3 py-2 text-xs text-blue-600 hover:underline">Load more</button>
+                )}
               </div>
             </div>
 
@@ -140,7 +146,10 @@ export default function UserMessagesPage() {
                 <div className="text-lg font-semibold text-gray-900">{activeId ? displayName(activeId) : '—'}</div>
               </div>
               <div className="flex-1 overflow-auto p-4 space-y-2 bg-gray-50">
-                {activeMessages.map(m => {
+                {olderCursor && (
+                  <button onClick={loadOlderMessages} className="mx-auto block text-xs text-blue-600 hover:underline">Load older messages</button>
+                )}
+                {messages.map(m => {
                   const isMine = m.from_user_id === myId
                   return (
                     <div key={m.id} className={`max-w-[75%] rounded-lg px-3 py-2 ${isMine ? 'ml-auto bg-blue-600 text-white' : 'mr-auto bg-white border text-black'}`}>
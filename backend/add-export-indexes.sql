@@ -0,0 +1,5 @@
+-- Keyset indexes for the admin exports (/api/admin/export/*), which page
+-- through each table in (created_at, id) order, optionally by status or role.
+CREATE INDEX IF NOT EXISTS idx_diagnoses_created_id ON diagnoses(created_at, id);
+CREATE INDEX IF NOT EXISTS idx_diagnoses_status_created_id ON diagnoses(status, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_profiles_created_id ON profiles(created_at, id);
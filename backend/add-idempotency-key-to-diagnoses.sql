@@ -0,0 +1,10 @@
+-- Idempotency keys for POST /api/diagnoses/predict (predict and save in one request).
+-- A retried request with the same key gets the stored diagnosis back instead of
+-- a second inference and a duplicate row.
+ALTER TABLE diagnoses ADD COLUMN IF NOT EXISTS idempotency_key TEXT;
+ALTER TABLE diagnoses ADD COLUMN IF NOT EXISTS request_digest TEXT;  -- sha256 of the uploaded image
+
+-- One diagnosis per key and user; the insert that claims a key relies on this
+CREATE UNIQUE INDEX IF NOT EXISTS idx_diagnoses_user_idempotency_key
+    ON diagnoses(user_id, idempotency_key)
+    WHERE idempotency_key IS NOT NULL;
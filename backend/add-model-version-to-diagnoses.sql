@@ -0,0 +1,26 @@
+-- Tag diagnosis predictions with the model version that produced them.
+-- Needed by the re-score backfill (backend/backfill.py).
+ALTER TABLE diagnoses ADD COLUMN IF NOT EXISTS model_version TEXT;
+CREATE INDEX IF NOT EXISTS idx_diagnoses_model_version ON diagnoses(model_version);
+
+-- Batched update for the backfill: one round trip per batch of re-scored rows.
+-- Rows deleted meanwhile are skipped rather than re-created (unlike an upsert).
+CREATE OR REPLACE FUNCTION apply_prediction_backfill(updates JSONB)
+RETURNS INTEGER AS $$
+DECLARE
+    updated INTEGER;
+BEGIN
+    UPDATE diagnoses d
+    SET predictions = u.predictions,
+        model_version = u.model_version,
+        updated_at = NOW()
+    FROM jsonb_to_recordset(updates) AS u(id UUID, predictions JSONB, model_version TEXT)
+    WHERE d.id = u.id;
+    GET DIAGNOSTICS updated = ROW_COUNT;
+    RETURN updated;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
+
+-- Only the service role (the backend) may call it
+REVOKE ALL ON FUNCTION apply_prediction_backfill(JSONB) FROM PUBLIC;
+REVOKE ALL ON FUNCTION apply_prediction_backfill(JSONB) FROM anon, authenticated;
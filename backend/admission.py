@@ -0,0 +1,286 @@
+"""
+Admission control for the inference endpoints: how many requests run and
+wait per worker (with per-user and per-role quotas), the deadline and
+client-disconnect cancellation each request carries through its stages,
+and load shedding to a cheaper model version under sustained overload.
+
+    async with deadline_scope(request) as deadline, admission.slot(user_id, role, deadline):
+        ...
+"""
+import asyncio
+import collections
+import contextlib
+import os
+import threading
+import time
+
+import numpy as np
+from fastapi import HTTPException, Request
+
+from inference import registry, thread_budget
+
+# ---------------- Admission control ----------------
+# Bounds how much inference work a worker takes on: a fixed number of requests
+# execute, a bounded number wait, and per-user / per-role quotas stop one
+# client from filling the queue. Everything else is rejected immediately.
+INFERENCE_CONCURRENCY = thread_budget["inference_slots"]
+INFERENCE_QUEUE_DEPTH = int(os.getenv("INFERENCE_QUEUE_DEPTH", "16"))
+INFERENCE_QUEUE_TIMEOUT = float(os.getenv("INFERENCE_QUEUE_TIMEOUT", "10"))
+USER_MAX_CONCURRENT = int(os.getenv("USER_MAX_CONCURRENT", "2"))
+ROLE_MAX_CONCURRENT = {
+    "doctor": int(os.getenv("DOCTOR_MAX_CONCURRENT", "12")),
+    "super_admin": int(os.getenv("SUPER_ADMIN_MAX_CONCURRENT", "4")),
+}
+
+# Requests carry a deadline (X-Request-Timeout-Ms header, capped by config) and a
+# cancellation flag set when the client disconnects; each stage checks both first.
+INFERENCE_DEADLINE_SECONDS = float(os.getenv("INFERENCE_DEADLINE_SECONDS", "30"))
+DEADLINE_HEADER = "x-request-timeout-ms"
+_deadline_stats = {"expired": {}, "cancelled": {}}
+_deadline_stats_lock = threading.Lock()
+
+class RequestDeadline:
+    def __init__(self, timeout_s: float):
+        self.timeout_s = timeout_s
+        self.expires_at = time.monotonic() + timeout_s
+        self.cancelled = threading.Event()
+        self._on_cancel = []
+
+    @classmethod
+    def from_request(cls, request: Request):
+        timeout_s = INFERENCE_DEADLINE_SECONDS
+        header = request.headers.get(DEADLINE_HEADER)
+        if header:
+            try:
+                timeout_s = min(max(float(header) / 1000.0, 0.0), INFERENCE_DEADLINE_SECONDS)
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Invalid {DEADLINE_HEADER} header")
+        return cls(timeout_s)
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def cancel(self):
+        """Flag the request as abandoned and wake anything waiting on its behalf (event loop only)"""
+        self.cancelled.set()
+        for callback in list(self._on_cancel):
+            callback()
+
+    def on_cancel(self, callback):
+        """Run `callback` on cancel(); returns a function that unregisters it"""
+        self._on_cancel.append(callback)
+        return lambda: self._on_cancel.remove(callback)
+
+    def _count(self, kind: str, stage: str):
+        with _deadline_stats_lock:
+            _deadline_stats[kind][stage] = _deadline_stats[kind].get(stage, 0) + 1
+
+    def check(self, stage: str):
+        """Abort before `stage` if nobody is waiting for the result any more"""
+        if self.cancelled.is_set():
+            self._count("cancelled", stage)
+            print(f"[AI] Client went away, dropping request before {stage}")
+            raise HTTPException(status_code=499, detail="Client closed request")
+        if self.remaining() <= 0:
+            self._count("expired", stage)
+            print(f"[AI] Deadline of {self.timeout_s:.1f}s exceeded before {stage}")
+            raise HTTPException(status_code=504, detail=f"Request deadline exceeded before {stage}")
+
+async def _watch_disconnect(request: Request, deadline: RequestDeadline):
+    while not deadline.cancelled.is_set():
+        if await request.is_disconnected():
+            deadline.cancel()
+            return
+        await asyncio.sleep(0.25)
+
+@contextlib.asynccontextmanager
+async def deadline_scope(request: Request):
+    """Deadline for one request plus a watcher that cancels it when the client disconnects"""
+    deadline = RequestDeadline.from_request(request)
+    watcher = asyncio.create_task(_watch_disconnect(request, deadline))
+    try:
+        yield deadline
+    finally:
+        watcher.cancel()
+
+# Under sustained overload new requests are served by a cheaper registry version
+# (e.g. the int8 variant). Separate enter/exit thresholds plus a minimum dwell
+# time keep routing from flapping between the two.
+DEGRADED_MODEL_VERSION = os.getenv("DEGRADED_MODEL_VERSION")
+DEGRADE_QUEUE_WAIT_MS = float(os.getenv("DEGRADE_QUEUE_WAIT_MS", "2000"))
+DEGRADE_P95_MS = float(os.getenv("DEGRADE_P95_MS", "5000"))
+RECOVER_QUEUE_WAIT_MS = float(os.getenv("RECOVER_QUEUE_WAIT_MS", "300"))
+RECOVER_P95_MS = float(os.getenv("RECOVER_P95_MS", "2000"))
+DEGRADE_MIN_DWELL_SECONDS = float(os.getenv("DEGRADE_MIN_DWELL_SECONDS", "15"))
+DEGRADE_WINDOW = int(os.getenv("DEGRADE_WINDOW", "50"))
+
+class DegradationPolicy:
+    def __init__(self, fallback_version: str):
+        self.fallback_version = fallback_version
+        self.degraded = False
+        self.changed_at = time.monotonic()
+        self.transitions = 0
+        self.waits_ms = collections.deque(maxlen=DEGRADE_WINDOW)
+        self.latencies_ms = collections.deque(maxlen=DEGRADE_WINDOW)
+        self._lock = threading.Lock()
+
+    def observe(self, wait_s: float, latency_s: float):
+        if not self.fallback_version:
+            return
+        with self._lock:
+            self.waits_ms.append(wait_s * 1000)
+            self.latencies_ms.append(latency_s * 1000)
+            self._evaluate()
+
+    def _p95(self, values) -> float:
+        return float(np.percentile(values, 95)) if values else 0.0
+
+    def _evaluate(self):
+        now = time.monotonic()
+        if now - self.changed_at < DEGRADE_MIN_DWELL_SECONDS:
+            return
+        wait_p95 = self._p95(self.waits_ms)
+        latency_p95 = self._p95(self.latencies_ms)
+        if not self.degraded and (wait_p95 >= DEGRADE_QUEUE_WAIT_MS or latency_p95 >= DEGRADE_P95_MS):
+            self.degraded = True
+        elif self.degraded and wait_p95 <= RECOVER_QUEUE_WAIT_MS and latency_p95 <= RECOVER_P95_MS:
+            self.degraded = False
+        else:
+            return
+        self.changed_at = now
+        self.transitions += 1
+        # Judge the new state on fresh samples only
+        self.waits_ms.clear()
+        self.latencies_ms.clear()
+        print(f"[AI] Load shedding {'ON' if self.degraded else 'OFF'} "
+              f"(queue wait p95 {wait_p95:.0f} ms, latency p95 {latency_p95:.0f} ms)")
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": bool(self.fallback_version),
+                "fallback_version": self.fallback_version,
+                "degraded": self.degraded,
+                "transitions": self.transitions,
+                "queue_wait_p95_ms": round(self._p95(self.waits_ms), 1),
+                "latency_p95_ms": round(self._p95(self.latencies_ms), 1),
+            }
+
+degradation = DegradationPolicy(DEGRADED_MODEL_VERSION)
+if DEGRADED_MODEL_VERSION:
+    registry.register_preload(DEGRADED_MODEL_VERSION)
+
+def _current_task_cancelling() -> bool:
+    task = asyncio.current_task()
+    return task is not None and task.cancelling() > 0
+
+class AdmissionController:
+    def __init__(self, concurrency: int, queue_depth: int):
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.executing = 0
+        self.waiting = 0
+        self.per_user = {}
+        self.per_role = {}
+        self.service_time_s = 1.0  # EWMA of time spent holding a slot
+        self.counters = {
+            "admitted": 0, "completed": 0, "rejected_queue_full": 0,
+            "rejected_user_quota": 0, "rejected_role_quota": 0, "queue_timeouts": 0,
+        }
+        self._semaphore = None
+
+    def _retry_after(self) -> str:
+        backlog = (self.waiting + 1) / max(self.concurrency, 1)
+        return str(max(1, int(np.ceil(self.service_time_s * backlog))))
+
+    def _reject(self, status_code: int, counter: str, detail: str):
+        self.counters[counter] += 1
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": self._retry_after()})
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id: str, role: str, deadline: RequestDeadline = None):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        # All checks and increments happen without an await in between, so they are atomic on the event loop
+        if self.per_user.get(user_id, 0) >= USER_MAX_CONCURRENT:
+            self._reject(429, "rejected_user_quota", "Too many concurrent analyses for this user")
+        role_limit = ROLE_MAX_CONCURRENT.get(role)
+        if role_limit is not None and self.per_role.get(role, 0) >= role_limit:
+            self._reject(429, "rejected_role_quota", f"Too many concurrent analyses for role {role}")
+        if self.executing + self.waiting >= self.concurrency + self.queue_depth:
+            self._reject(503, "rejected_queue_full", "Inference queue is full, please retry shortly")
+
+        self.per_user[user_id] = self.per_user.get(user_id, 0) + 1
+        self.per_role[role] = self.per_role.get(role, 0) + 1
+        self.waiting += 1
+        acquired = False
+        queued_at = time.monotonic()
+        try:
+            try:
+                await self._acquire(deadline)
+                acquired = True
+            finally:
+                self.waiting -= 1
+            self.executing += 1
+            self.counters["admitted"] += 1
+            start = time.monotonic()
+            try:
+                yield
+            finally:
+                self.executing -= 1
+                self.counters["completed"] += 1
+                finished = time.monotonic()
+                self.service_time_s = 0.8 * self.service_time_s + 0.2 * (finished - start)
+                degradation.observe(start - queued_at, finished - queued_at)
+        finally:
+            if acquired:
+                self._semaphore.release()
+            self.per_user[user_id] -= 1
+            if self.per_user[user_id] <= 0:
+                del self.per_user[user_id]
+            self.per_role[role] -= 1
+            if self.per_role[role] <= 0:
+                del self.per_role[role]
+
+    async def _acquire(self, deadline: RequestDeadline = None):
+        """
+        One wait in the semaphore's FIFO queue, bounded by the queue timeout and
+        the deadline; a client disconnect cancels it so the slot goes to the next waiter
+        """
+        timeout = INFERENCE_QUEUE_TIMEOUT
+        if deadline is not None:
+            deadline.check("queue")
+            timeout = min(timeout, deadline.remaining())
+        waiter = asyncio.ensure_future(self._semaphore.acquire())
+        unregister = deadline.on_cancel(waiter.cancel) if deadline is not None else None
+        try:
+            await asyncio.wait_for(waiter, timeout=timeout)
+        except asyncio.TimeoutError:
+            if deadline is not None:
+                deadline.check("queue")
+            self._reject(503, "queue_timeouts", "Timed out waiting for an inference slot")
+        except asyncio.CancelledError:
+            # Cancelled by the disconnect watcher rather than the request task itself
+            if deadline is not None and deadline.cancelled.is_set() and not _current_task_cancelling():
+                deadline.check("queue")
+            raise
+        finally:
+            if unregister is not None:
+                unregister()
+
+    def metrics(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "queue_capacity": self.queue_depth,
+            "executing": self.executing,
+            "queue_depth": self.waiting,
+            "avg_service_time_s": round(self.service_time_s, 3),
+            "active_users": len(self.per_user),
+            "per_role": dict(self.per_role),
+            "counters": dict(self.counters),
+            "expired": dict(_deadline_stats["expired"]),
+            "cancelled": dict(_deadline_stats["cancelled"]),
+            "load_shedding": degradation.metrics(),
+        }
+
+admission = AdmissionController(INFERENCE_CONCURRENCY, INFERENCE_QUEUE_DEPTH)
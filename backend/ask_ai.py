@@ -0,0 +1,405 @@
+"""
+Answers for the Ask-AI page (/api/ask-ai).
+
+    service = AskAIService(llm_from_env())
+    generation = service.ask(question, context)
+    chunks, done = generation.subscribe(on_chunk)   # on_chunk(None) marks the end
+
+Answers are cached by a normalised (question, context, model) key: case,
+Unicode form, runs of whitespace and trailing punctuation don't change the key,
+and the system prompt is part of it, so editing the prompt starts a fresh cache.
+The cache is a SQLite file shared by all workers (ASK_AI_CACHE_TTL seconds,
+least recently used entries pruned past ASK_AI_CACHE_MAX).
+
+Identical questions asked while an answer is still being generated join that
+generation instead of starting another: late subscribers first get the text
+generated so far, then the remaining chunks as they arrive. Generations run to
+completion even if every client disconnects, so the answer still reaches the
+cache. Failed or empty answers are never cached.
+
+The API shares one service per worker (shared_service) and relays a
+generation to its client with answer_chunks, as JSON or as SSE events.
+
+ASK_AI_BACKEND=fake swaps Gemini for FakeLLM, a local stand-in with fixed,
+configurable latency for offline cache and streaming tests.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import BACKEND_DIR
+
+ASK_AI_BACKEND = os.getenv("ASK_AI_BACKEND", "gemini").lower()
+ASK_AI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+ASK_AI_WORKERS = int(os.getenv("ASK_AI_WORKERS", "4"))
+ASK_AI_CACHE_PATH = os.getenv("ASK_AI_CACHE_PATH") or os.path.join(BACKEND_DIR, ".ask_ai_cache.sqlite3")
+ASK_AI_CACHE_TTL = float(os.getenv("ASK_AI_CACHE_TTL", str(7 * 24 * 3600)))  # 0 disables the cache
+ASK_AI_CACHE_MAX = int(os.getenv("ASK_AI_CACHE_MAX", "5000"))
+ASK_AI_FAKE_FIRST_TOKEN_MS = float(os.getenv("ASK_AI_FAKE_FIRST_TOKEN_MS", "400"))
+ASK_AI_FAKE_TOKEN_MS = float(os.getenv("ASK_AI_FAKE_TOKEN_MS", "20"))
+ASK_AI_MAX_QUESTION_CHARS = int(os.getenv("ASK_AI_MAX_QUESTION_CHARS", "2000"))
+ASK_AI_MAX_CONTEXT_CHARS = int(os.getenv("ASK_AI_MAX_CONTEXT_CHARS", "8000"))
+ASK_AI_TIMEOUT_S = float(os.getenv("ASK_AI_TIMEOUT_S", "60"))  # longest wait for the next chunk
+
+SYSTEM_PROMPT = """You are a helpful medical imaging assistant for X-ray/MRI/CT results.
+- Provide general, educational explanations about conditions, imaging findings, and typical clinical workflows.
+- You may give high-level overviews of common treatment approaches (e.g., "antibiotics are often used", "immobilization is typical"), but never provide prescriptive medical advice or instructions specific to a person.
+- Always include a short disclaimer when discussing treatment and advise the user to consult a qualified clinician for diagnosis and treatment decisions.
+- If context is provided, use it to answer. Keep answers concise and clear."""
+
+
+class AskAIUnavailableError(RuntimeError):
+    """The configured LLM backend cannot be used (missing package or API key)"""
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text or "").lower().split())
+
+
+def cache_key(question: str, context: str, model: str) -> str:
+    payload = [model, SYSTEM_PROMPT, normalize_text(question).rstrip(" ?!."), normalize_text(context)]
+    return hashlib.sha256(json.dumps(payload).encode("utf-8")).hexdigest()
+
+
+# ---- LLM backends ----
+
+class GeminiLLM:
+    """Google Gemini through google-generativeai, streamed chunk by chunk"""
+
+    def __init__(self, api_key: str, model_name: str = ASK_AI_MODEL):
+        try:
+            import google.generativeai as genai
+        except ImportError as e:
+            raise AskAIUnavailableError("google-generativeai is not installed") from e
+        genai.configure(api_key=api_key)
+        self.name = model_name
+        self.model = genai.GenerativeModel(model_name)
+
+    def stream(self, question: str, context: str):
+        parts = [SYSTEM_PROMPT]
+        if context and context.strip():
+            parts.append(f"Context (AI findings):\n{context}")
+        parts.append(f"Question: {question}")
+        for chunk in self.model.generate_content(parts, stream=True):
+            try:
+                text = chunk.text
+            except ValueError:
+                continue  # chunk without text (e.g. a safety stop)
+            if text:
+                yield text
+
+
+class FakeLLM:
+    """Offline stand-in: a canned answer after `first_token_ms`, then one word every `token_ms`"""
+
+    def __init__(self, first_token_ms: float = ASK_AI_FAKE_FIRST_TOKEN_MS, token_ms: float = ASK_AI_FAKE_TOKEN_MS,
+                 model_name: str = "fake"):
+        self.name = model_name
+        self.first_token_ms = first_token_ms
+        self.token_ms = token_ms
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def stream(self, question: str, context: str):
+        with self._lock:
+            self.calls += 1
+        answer = f"Offline test answer. You asked: {' '.join(question.split())}"
+        if context and context.strip():
+            answer += f" Context: {len(context.split())} words of findings."
+        answer += " Please consult a qualified clinician for diagnosis and treatment decisions."
+        time.sleep(self.first_token_ms / 1000)
+        for i, word in enumerate(answer.split(" ")):
+            if i:
+                time.sleep(self.token_ms / 1000)
+            yield word if i == 0 else " " + word
+
+
+def llm_from_env():
+    if ASK_AI_BACKEND == "fake":
+        return FakeLLM()
+    if ASK_AI_BACKEND != "gemini":
+        raise AskAIUnavailableError(f"Unknown ASK_AI_BACKEND {ASK_AI_BACKEND!r} (expected gemini or fake)")
+    api_key = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
+    if not api_key:
+        raise AskAIUnavailableError("GEMINI_API_KEY is not set")
+    return GeminiLLM(api_key)
+
+
+# ---- generations ----
+
+class Generation:
+    """One answer being produced (or replayed from the cache), shared by every request asking for it"""
+
+    def __init__(self, key: str, model: str, cached: bool = False, answer: str = None):
+        self.key = key
+        self.model = model
+        self.cached = cached
+        self.chunks = [answer] if answer else []
+        self.error = None
+        self.started = time.monotonic()
+        self.done = threading.Event()
+        self._listeners = []
+        self._lock = threading.Lock()
+        if cached:
+            self.done.set()
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    def subscribe(self, listener):
+        """Register listener(chunk) for new chunks (None once finished); returns (chunks so far, finished)"""
+        with self._lock:
+            if not self.done.is_set():
+                self._listeners.append(listener)
+            return list(self.chunks), self.done.is_set()
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def _notify(self, listeners: list, chunk):
+        for listener in listeners:
+            try:
+                listener(chunk)
+            except Exception:
+                self.unsubscribe(listener)  # e.g. the client's event loop has gone away
+
+    def _emit(self, chunk: str):
+        with self._lock:
+            self.chunks.append(chunk)
+            listeners = list(self._listeners)
+        self._notify(listeners, chunk)
+
+    def _finish(self, error: str = None):
+        with self._lock:
+            self.error = error
+            self.done.set()
+            listeners, self._listeners = self._listeners, []
+        self._notify(listeners, None)
+
+    def result(self, timeout: float = None) -> str:
+        """Block until finished; the full answer, or RuntimeError with the generation's error"""
+        if not self.done.wait(timeout):
+            raise TimeoutError("Answer is still being generated")
+        if self.error:
+            raise RuntimeError(self.error)
+        return self.text
+
+
+class AskAIService:
+    def __init__(self, llm, cache_path: str = ASK_AI_CACHE_PATH, cache_ttl: float = ASK_AI_CACHE_TTL,
+                 cache_max: int = ASK_AI_CACHE_MAX, workers: int = ASK_AI_WORKERS):
+        self.llm = llm
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
+        self.cache_max = cache_max
+        self.counters = {"requests": 0, "cache_hits": 0, "joined": 0, "generated": 0, "failed": 0,
+                         "first_token_ms_total": 0.0, "generation_ms_total": 0.0}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="ask-ai")
+
+    # ---- cache ----
+
+    def _store(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.cache_path, check_same_thread=False, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    used_at REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS idx_answers_used_at ON answers(used_at)")
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _cache_get(self, key: str):
+        if self.cache_ttl <= 0:
+            return None
+        now = time.time()
+        try:
+            with self._db_lock:
+                db = self._store()
+                row = db.execute("SELECT answer FROM answers WHERE key = ? AND created_at > ?",
+                                 (key, now - self.cache_ttl)).fetchone()
+                if row:
+                    db.execute("UPDATE answers SET used_at = ?, hits = hits + 1 WHERE key = ?", (now, key))
+                    db.commit()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            print(f"[ask-ai] Cache read failed: {e}")
+            return None
+
+    def _cache_put(self, key: str, answer: str):
+        if self.cache_ttl <= 0:
+            return
+        now = time.time()
+        try:
+            with self._db_lock:
+                db = self._store()
+                db.execute("INSERT OR REPLACE INTO answers (key, model, answer, created_at, used_at) VALUES (?, ?, ?, ?, ?)",
+                           (key, self.llm.name, answer, now, now))
+                db.execute("DELETE FROM answers WHERE created_at <= ?", (now - self.cache_ttl,))
+                db.execute("DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                           (self.cache_max,))
+                db.commit()
+        except sqlite3.Error as e:
+            print(f"[ask-ai] Cache write failed: {e}")
+
+    def clear_cache(self) -> int:
+        with self._db_lock:
+            db = self._store()
+            removed = db.execute("DELETE FROM answers").rowcount
+            db.commit()
+        return removed
+
+    # ---- answering ----
+
+    def ask(self, question: str, context: str = "") -> Generation:
+        """The cached answer, the generation already running for the same key, or a new one"""
+        key = cache_key(question, context, self.llm.name)
+        with self._lock:
+            self.counters["requests"] += 1
+            generation = self._inflight.get(key)
+            if generation is not None:
+                self.counters["joined"] += 1
+                return generation
+        answer = self._cache_get(key)
+        with self._lock:
+            if answer is not None:
+                self.counters["cache_hits"] += 1
+                return Generation(key, self.llm.name, cached=True, answer=answer)
+            # Another request may have started the same generation during the cache lookup
+            generation = self._inflight.get(key)
+            if generation is not None:
+                self.counters["joined"] += 1
+                return generation
+            generation = self._inflight[key] = Generation(key, self.llm.name)
+        self._pool.submit(self._generate, generation, question, context)
+        return generation
+
+    def _generate(self, generation: Generation, question: str, context: str):
+        error = None
+        first_token_ms = None
+        try:
+            for chunk in self.llm.stream(question, context):
+                if first_token_ms is None:
+                    first_token_ms = (time.monotonic() - generation.started) * 1000
+                generation._emit(chunk)
+            if not generation.text.strip():
+                error = "No response generated."
+            else:
+                self._cache_put(generation.key, generation.text)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            print(f"[ask-ai] Generation failed: {error}")
+        generation_ms = (time.monotonic() - generation.started) * 1000
+        with self._lock:
+            self._inflight.pop(generation.key, None)
+            if error:
+                self.counters["failed"] += 1
+            else:
+                self.counters["generated"] += 1
+                self.counters["first_token_ms_total"] += first_token_ms or 0.0
+                self.counters["generation_ms_total"] += generation_ms
+        generation._finish(error)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+            inflight = len(self._inflight)
+        generated = counters.pop("generated")
+        first_token_total = counters.pop("first_token_ms_total")
+        generation_total = counters.pop("generation_ms_total")
+        entries = None
+        if self.cache_ttl > 0:
+            try:
+                with self._db_lock:
+                    entries = self._store().execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            except sqlite3.Error:
+                pass
+        return {
+            "backend": type(self.llm).__name__,
+            "model": self.llm.name,
+            "inflight": inflight,
+            "generated": generated,
+            **counters,
+            "hit_rate": round(counters["cache_hits"] / counters["requests"], 3) if counters["requests"] else None,
+            "avg_first_token_ms": round(first_token_total / generated, 1) if generated else None,
+            "avg_generation_ms": round(generation_total / generated, 1) if generated else None,
+            "cache_entries": entries,
+            "cache_ttl_s": self.cache_ttl,
+        }
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+# ---- serving the API ----
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def shared_service() -> AskAIService:
+    """This worker's service, built from the environment on first use"""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = AskAIService(llm_from_env())
+        return _service
+
+
+def service_stats():
+    return _service.stats() if _service is not None else None
+
+
+def close_shared_service():
+    if _service is not None:
+        _service.close()
+
+
+async def answer_chunks(generation: Generation, timeout: float = ASK_AI_TIMEOUT_S):
+    """Yield the generation's text as it arrives; the first chunk is everything generated so far"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    listener = lambda chunk: loop.call_soon_threadsafe(queue.put_nowait, chunk)
+    chunks, done = generation.subscribe(listener)
+    try:
+        if chunks:
+            yield "".join(chunks)
+        while not done:
+            chunk = await asyncio.wait_for(queue.get(), timeout=timeout)
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        generation.unsubscribe(listener)
+    if generation.error:
+        raise RuntimeError(generation.error)
+
+
+def sse_event(name: str, data: dict) -> str:
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
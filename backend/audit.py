@@ -0,0 +1,253 @@
+"""
+Audit trail writer for the system_logs table.
+
+    audit = AuditLog(supabase)
+    audit.log("admin.user_role_changed", actor_id, {"target": user_id, "role": role})
+
+log() only appends to an in-memory queue; a background thread writes the
+queue in batched inserts once AUDIT_BATCH_SIZE events are waiting or every
+AUDIT_FLUSH_INTERVAL seconds. Rows carry their own id and timestamp, and
+inserts ignore ids that already exist, so a batch can be re-sent safely.
+
+While the database is unreachable, batches are appended to a local spill file
+(JSON lines, fsynced) and retried with backoff; spilled events are replayed
+before newer ones once writes succeed again. The queue is bounded: when it is
+full the oldest events are spilled rather than dropped. Rows the database
+rejects (e.g. a user_id that no longer exists) are dropped one by one so they
+can't block the rest of their batch. close() flushes what is left at shutdown.
+"""
+import collections
+import contextlib
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from storage import BACKEND_DIR
+
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "100"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "2"))
+AUDIT_MAX_QUEUE = int(os.getenv("AUDIT_MAX_QUEUE", "10000"))
+AUDIT_SPILL_DIR = os.getenv("AUDIT_SPILL_DIR") or os.path.join(BACKEND_DIR, ".audit_spill")
+AUDIT_SPILL_MB = float(os.getenv("AUDIT_SPILL_MB", "256"))
+AUDIT_MAX_BACKOFF = 60.0
+AUDIT_TABLE = "system_logs"
+
+
+class AuditLog:
+    def __init__(self, client, batch_size: int = AUDIT_BATCH_SIZE, flush_interval: float = AUDIT_FLUSH_INTERVAL,
+                 max_queue: int = AUDIT_MAX_QUEUE, spill_dir: str = AUDIT_SPILL_DIR,
+                 spill_max_bytes: int = int(AUDIT_SPILL_MB * 1024 * 1024)):
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        # One spill file per process; replay claims files from any process by renaming them
+        self.spill_path = os.path.join(spill_dir, f"spill-{os.getpid()}.jsonl")
+        self.counters = {"logged": 0, "written": 0, "batches": 0, "spilled": 0, "replayed": 0,
+                         "rejected": 0, "dropped": 0, "write_errors": 0}
+        self._queue = collections.deque()
+        self._lock = threading.Lock()          # queue and counters
+        self._write_lock = threading.Lock()    # one writer (flusher thread or close()) at a time
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        self._last_error = None
+        self._thread = threading.Thread(target=self._run, name="audit-flusher", daemon=True)
+        self._thread.start()
+
+    # ---- producers ----
+
+    def log(self, action: str, user_id: str = None, details: dict = None, ip_address: str = None,
+            user_agent: str = None):
+        """Queue one event; never blocks on the database"""
+        row = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "action": action,
+            "details": details,
+            "ip_address": ip_address,
+            "user_agent": user_agent,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+        overflow = None
+        with self._lock:
+            self._queue.append(row)
+            self.counters["logged"] += 1
+            if len(self._queue) > self.max_queue:
+                overflow = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            wake = len(self._queue) >= self.batch_size
+        if overflow:
+            self._spill(overflow)
+        if wake:
+            self._wake.set()
+
+    # ---- spill file ----
+
+    def _spill(self, rows: list):
+        """Append rows to this process' spill file (dropped, and counted, past the size cap)"""
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            spilled = sum(os.path.getsize(p) for p in glob.glob(os.path.join(self.spill_dir, "*.jsonl*")))
+            if spilled >= self.spill_max_bytes:
+                raise OSError(f"spill directory is full ({spilled / 1024 / 1024:.0f} MB)")
+            with open(self.spill_path, "a") as f:
+                f.write("".join(json.dumps(row) + "\n" for row in rows))
+                f.flush()
+                os.fsync(f.fileno())
+            with self._lock:
+                self.counters["spilled"] += len(rows)
+        except OSError as e:
+            with self._lock:
+                self.counters["dropped"] += len(rows)
+            print(f"[audit] Dropped {len(rows)} events, could not spill them: {e}")
+
+    def _replayable(self) -> list:
+        """Unclaimed spill files, plus claims left behind by processes that have died"""
+        paths = []
+        for path in glob.glob(os.path.join(self.spill_dir, "*.jsonl*")):
+            _, _, owner = path.partition(".jsonl.replaying-")
+            if owner and owner != str(os.getpid()):
+                try:
+                    os.kill(int(owner), 0)
+                    continue  # still being replayed by a live process
+                except (OSError, ValueError):
+                    pass
+            paths.append(path)
+        return sorted(paths, key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0)
+
+    def _replay_spill(self) -> bool:
+        """Write spilled events back to the table, oldest file first; False if the database is still down"""
+        for path in self._replayable():
+            claimed = f"{path.partition('.jsonl')[0]}.jsonl.replaying-{os.getpid()}"
+            try:
+                os.replace(path, claimed)
+                with open(claimed) as f:
+                    rows = [json.loads(line) for line in f if line.strip()]
+            except FileNotFoundError:
+                continue  # another process claimed it
+            except (OSError, ValueError) as e:
+                print(f"[audit] Skipping unreadable spill file {path}: {e}")
+                continue
+            for offset in range(0, len(rows), self.batch_size):
+                if not self._write(rows[offset:offset + self.batch_size]):
+                    # Hand what is left back as an unclaimed file for the next replay
+                    remaining = os.path.join(self.spill_dir, f"spill-{os.getpid()}-{time.time_ns()}.jsonl")
+                    with open(remaining, "w") as f:
+                        f.write("".join(json.dumps(row) + "\n" for row in rows[offset:]))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.remove(claimed)
+                    return False
+                with self._lock:
+                    self.counters["replayed"] += len(rows[offset:offset + self.batch_size])
+            os.remove(claimed)
+            print(f"[audit] Replayed {len(rows)} spilled events from {os.path.basename(path)}")
+        return True
+
+    # ---- writing ----
+
+    def _insert(self, rows: list):
+        self.client.table(AUDIT_TABLE).upsert(rows, on_conflict="id", ignore_duplicates=True).execute()
+
+    def _write(self, rows: list) -> bool:
+        """Insert one batch; False when the database is unreachable (the rows are not written)"""
+        written = len(rows)
+        try:
+            self._insert(rows)
+        except Exception as e:
+            if getattr(e, "code", None) is None:
+                self._last_error = str(e)
+                with self._lock:
+                    self.counters["write_errors"] += 1
+                return False
+            # The database answered but rejected the batch: write row by row to isolate the bad ones
+            written = 0
+            for row in rows:
+                try:
+                    self._insert([row])
+                    written += 1
+                except Exception as row_error:
+                    if getattr(row_error, "code", None) is None:
+                        # Lost the connection mid-batch; the caller spills the whole batch and
+                        # the upsert skips rows that already made it when it is replayed
+                        self._last_error = str(row_error)
+                        with self._lock:
+                            self.counters["write_errors"] += 1
+                        return False
+                    with self._lock:
+                        self.counters["rejected"] += 1
+                    print(f"[audit] Rejected {row['action']} event: {row_error}")
+        with self._lock:
+            self.counters["written"] += written
+            self.counters["batches"] += 1
+        return True
+
+    def _take(self) -> list:
+        with self._lock:
+            return [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+
+    def flush(self):
+        """Write (or, while the database is down, spill) everything queued so far"""
+        with self._write_lock:
+            if time.monotonic() < self._retry_at:
+                while True:
+                    rows = self._take()
+                    if not rows:
+                        return
+                    self._spill(rows)
+            healthy = self._replay_spill() if os.path.isdir(self.spill_dir) else True
+            while True:
+                rows = self._take()
+                if not rows:
+                    break
+                if not healthy or not self._write(rows):
+                    healthy = False
+                    self._spill(rows)
+            if healthy:
+                self._backoff = 0.0
+                self._retry_at = 0.0
+            else:
+                self._backoff = min(max(self._backoff * 2, self.flush_interval), AUDIT_MAX_BACKOFF)
+                self._retry_at = time.monotonic() + self._backoff
+                print(f"[audit] Database unreachable ({self._last_error}); spilling, next retry in {self._backoff:.1f}s")
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[audit] Flush failed: {e}")
+
+    def close(self, timeout: float = 10.0):
+        """Stop the flusher and write out (or spill) the remaining events"""
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self._retry_at = 0.0
+        with contextlib.suppress(Exception):
+            self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            queued = len(self._queue)
+            counters = dict(self.counters)
+        spill_files = glob.glob(os.path.join(self.spill_dir, "*.jsonl*"))
+        return {
+            "queued": queued,
+            "batch_size": self.batch_size,
+            "flush_interval_s": self.flush_interval,
+            "spill_files": len(spill_files),
+            "spill_bytes": sum(os.path.getsize(p) for p in spill_files if os.path.exists(p)),
+            "retry_in_s": round(max(self._retry_at - time.monotonic(), 0.0), 1),
+            "last_error": self._last_error,
+            **counters,
+        }
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Re-score historical diagnoses after a model change.
+
+    # re-score every completed diagnosis with the serving version, 2 images/s
+    python backfill.py --rate 2
+
+    # a specific registry version, bigger batches; Ctrl-C pauses, re-running resumes
+    python backfill.py --version v2 --batch-size 32 --rate 10
+
+Diagnoses are walked in keyset order (by id) and only rows whose model_version
+differs from the target are read. Images come through the storage cache and
+its model-resolution derivative, inference is batched, and each batch of new
+predictions is written with one apply_prediction_backfill call
+(add-model-version-to-diagnoses.sql). The checkpoint (last id written plus
+counters) is saved after every write, so a paused or killed job resumes
+without skipping rows; at most the batch in flight is scored twice.
+
+Super admins can run the same job inside the API via /api/admin/backfill. There
+it runs at a lower priority (BACKFILL_NICE) on its own threads, including a
+private single-threaded ONNX session, and pins the model one batch at a time.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.append(os.path.dirname(__file__))
+
+from inference import ModelVersion, Predictor, apply_thread_budget, registry  # noqa: E402
+from storage import BACKEND_DIR  # noqa: E402
+
+BACKFILL_DIR = os.getenv("BACKFILL_DIR") or os.path.join(BACKEND_DIR, ".backfill")
+BACKFILL_RATE = float(os.getenv("BACKFILL_RATE", "2"))  # images per second, 0 = unthrottled
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "16"))
+BACKFILL_FETCH_WORKERS = int(os.getenv("BACKFILL_FETCH_WORKERS", "4"))
+BACKFILL_NICE = int(os.getenv("BACKFILL_NICE", "10"))
+BACKFILL_THREADS = int(os.getenv("BACKFILL_THREADS", "1"))  # ONNX threads of the background job's own session
+BACKFILL_KEEP_ERRORS = 50
+
+
+def _lower_thread_priority():
+    # Linux applies nice values per thread; every thread the background job runs on calls this
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), BACKFILL_NICE)
+    except (AttributeError, OSError) as e:
+        print(f"[backfill] Could not lower worker priority: {e}")
+
+
+class _RateLimiter:
+    """Spaces work out to `rate` items per second on average"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.next_at = time.monotonic()
+
+    def wait(self, items: int, stop: threading.Event):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        if self.next_at > now:
+            stop.wait(self.next_at - now)
+        self.next_at = max(self.next_at, now) + items / self.rate
+
+
+class BackfillJob:
+    """
+    One re-score pass towards `model`. `derivatives` supplies model-resolution
+    tensors (derivatives.DerivativeStore); `should_yield()` lets the host pause
+    between batches, e.g. while interactive requests are queued.
+    """
+
+    def __init__(self, supabase, derivatives, model, batch_size: int = BACKFILL_BATCH_SIZE,
+                 rate: float = BACKFILL_RATE, status: str = "completed", should_yield=None,
+                 checkpoint_dir: str = BACKFILL_DIR):
+        self.supabase = supabase
+        self.derivatives = derivatives
+        self.model = model
+        self.batch_size = batch_size
+        self.rate = rate
+        self.status_filter = status
+        self.should_yield = should_yield
+        self.checkpoint_path = os.path.join(checkpoint_dir, f"{model.name}.json")
+        self._stop = threading.Event()
+        self._thread = None
+        self._background = False
+        self.state = self._load_checkpoint()
+
+    # ---- checkpoint ----
+
+    def _load_checkpoint(self) -> dict:
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"model_version": self.model.name, "last_id": None, "scored": 0, "updated": 0,
+                    "failed": 0, "errors": [], "started_at": None, "finished_at": None, "updated_at": None}
+
+    def _save_checkpoint(self):
+        self.state["updated_at"] = datetime.now().isoformat()
+        os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.checkpoint_path), suffix=".part")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def reset(self):
+        """Start over from the first diagnosis on the next run"""
+        self.state = {**self._load_checkpoint(), "last_id": None, "scored": 0, "updated": 0, "failed": 0,
+                      "errors": [], "started_at": None, "finished_at": None}
+        self._save_checkpoint()
+
+    # ---- work ----
+
+    def _next_page(self) -> list:
+        query = (self.supabase.table("diagnoses").select("id, image_path")
+                 .or_(f"model_version.is.null,model_version.neq.{self.model.name}"))
+        if self.status_filter:
+            query = query.eq("status", self.status_filter)
+        if self.state["last_id"]:
+            query = query.gt("id", self.state["last_id"])
+        return query.order("id").limit(self.batch_size).execute().data or []
+
+    def _record_error(self, row: dict, error: str):
+        self.state["failed"] += 1
+        self.state["errors"] = (self.state["errors"] + [{"id": row["id"], "error": error}])[-BACKFILL_KEEP_ERRORS:]
+        print(f"[backfill] {row['id']} ({row.get('image_path')}): {error}")
+
+    def _scoring_model(self) -> ModelVersion:
+        """
+        In the background, ONNX versions are scored on a private session with
+        BACKFILL_THREADS threads, so inference runs on the job's own deprioritised
+        threads rather than the shared ORT pool, and retiring the served version
+        never waits for the job. TorchScript versions share the registry's model
+        (torch thread pools are process-wide) and are pinned one batch at a time.
+        """
+        if not self._background or not self.model.use_onnx:
+            return self.model
+        model = ModelVersion(self.model.name, self.model.path, labels=self.model.labels,
+                             input_size=self.model.input_size, preprocessing=self.model.preprocessing,
+                             clahe=self.model.clahe, variant=self.model.requested_variant,
+                             session_threads=BACKFILL_THREADS)
+        model.load()
+        if not model.loaded:
+            raise RuntimeError(f"Model {model.name} failed to load: {model.error}")
+        return model
+
+    def _score_page(self, rows: list, pool: ThreadPoolExecutor, scorer: ModelVersion) -> list:
+        import numpy as np
+
+        def load(row):
+            if not row.get("image_path"):
+                raise ValueError("no image_path")
+            return self.derivatives.model_tensor(row["image_path"], self.model)
+
+        futures = [(row, pool.submit(load, row)) for row in rows]
+        scored, tensors = [], []
+        for row, future in futures:
+            try:
+                tensors.append(future.result())
+                scored.append(row)
+            except Exception as e:
+                self._record_error(row, str(e))
+        if not scored:
+            return []
+        if not scorer.loaded:
+            scorer.load()  # a shared version may have been retired since the last batch
+        # predict_tensors pins the version for this batch only
+        predictions = Predictor(model=scorer).predict_tensors(np.concatenate(tensors, axis=0))
+        rescored_at = datetime.now().isoformat()
+        return [
+            {"id": row["id"], "model_version": self.model.name,
+             "predictions": {**prediction.to_dict(), "rescored_at": rescored_at}}
+            for row, prediction in zip(scored, predictions)
+        ]
+
+    def run(self):
+        """Process pages until done or stopped; safe to call again to resume"""
+        self._stop.clear()
+        self.state["started_at"] = self.state["started_at"] or datetime.now().isoformat()
+        self.state["finished_at"] = None
+        limiter = _RateLimiter(self.rate)
+        print(f"[backfill] Re-scoring towards {self.model.name} from {self.state['last_id'] or 'the start'} "
+              f"(batch {self.batch_size}, {self.rate or 'unlimited'} img/s)")
+        scorer = self._scoring_model()
+        initializer = _lower_thread_priority if self._background else None
+        try:
+            with ThreadPoolExecutor(max_workers=max(BACKFILL_FETCH_WORKERS, 1), thread_name_prefix="backfill-fetch",
+                                    initializer=initializer) as pool:
+                while not self._stop.is_set():
+                    while self.should_yield is not None and self.should_yield() and not self._stop.is_set():
+                        self._stop.wait(0.5)
+                    rows = self._next_page()
+                    if not rows:
+                        self.state["finished_at"] = datetime.now().isoformat()
+                        break
+                    limiter.wait(len(rows), self._stop)
+                    if self._stop.is_set():
+                        break
+                    updates = self._score_page(rows, pool, scorer)
+                    if updates:
+                        result = self.supabase.rpc("apply_prediction_backfill", {"updates": updates}).execute()
+                        self.state["updated"] += int(result.data or 0)
+                    self.state["scored"] += len(updates)
+                    self.state["last_id"] = rows[-1]["id"]
+                    self._save_checkpoint()
+                    print(f"[backfill] {self.state['scored']} scored, {self.state['failed']} failed, at {self.state['last_id']}")
+        finally:
+            if scorer is not self.model:
+                scorer.unload()
+            self._save_checkpoint()
+        print(f"[backfill] {'Finished' if self.state['finished_at'] else 'Paused'}: "
+              f"{self.state['scored']} scored, {self.state['updated']} rows updated, {self.state['failed']} failed")
+        return self.state
+
+    def _run_background(self):
+        self._background = True
+        _lower_thread_priority()
+        try:
+            self.run()
+        except Exception as e:
+            self.state["last_error"] = str(e)
+            print(f"[backfill] Stopped by error: {e}")
+
+    def start(self):
+        """Run in a low-priority background thread"""
+        if self.running:
+            return
+        self._thread = threading.Thread(target=self._run_background, name="backfill", daemon=True)
+        self._thread.start()
+
+    def pause(self):
+        """Stop after the batch in flight; its checkpoint is written first"""
+        self._stop.set()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def info(self) -> dict:
+        return {**self.state, "running": self.running, "batch_size": self.batch_size, "rate": self.rate}
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Re-score historical diagnoses with a new model version")
+    parser.add_argument("--version", help="Registry version to score with (defaults to the serving one)")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+    parser.add_argument("--rate", type=float, default=BACKFILL_RATE, help="Images per second (0 = unthrottled)")
+    parser.add_argument("--status", default="completed", help="Only diagnoses with this status ('' for all)")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start from the beginning")
+    args = parser.parse_args()
+
+    from supabase import create_client
+    from derivatives import DerivativeStore
+    from storage import ImageCache, bucket_from_env
+
+    apply_thread_budget()
+    supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY"))
+    registry.load_model_if_needed()
+    model = registry.get_version(args.version) if args.version else registry.get_active_model()
+    if model is None:
+        raise SystemExit(f"Model version {args.version} not found (available: {', '.join(registry.list_versions()) or 'none'})")
+    model.load()
+    if not model.loaded:
+        raise SystemExit(f"Model {model.name} failed to load: {model.error}")
+
+    job = BackfillJob(supabase, DerivativeStore(ImageCache(bucket_from_env(supabase))), model,
+                      batch_size=args.batch_size, rate=args.rate, status=args.status)
+    if args.restart:
+        job.reset()
+    try:
+        job.run()
+    except KeyboardInterrupt:
+        # run() saved the last completed batch; the interrupted one is re-scored on resume
+        print("[backfill] Interrupted; re-run the same command to resume")
+
+
+if __name__ == "__main__":
+    main_cli()
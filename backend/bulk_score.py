@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+Score a directory (or manifest) of archived X-rays offline, without the HTTP API.
+
+    # every image/DICOM under ./archive, 4 decode processes, batches of 32
+    python bulk_score.py ./archive --output scores.csv --workers 4 --batch-size 32
+
+    # a manifest: one path per line (.txt) or a CSV with a `path` column
+    python bulk_score.py studies.csv --output scores.jsonl --version v2
+
+    # Parquet output is a directory of part files, one per flush
+    python bulk_score.py ./archive --output scores.parquet
+
+Sniffing, decoding, preprocessing, model loading and postprocessing come from
+the `inference` package the API serves with, so scores match the API. The
+output doubles as the checkpoint: re-running the same command skips every path
+already written (add --retry-errors to re-attempt failed files; the newer row
+for a path supersedes its earlier error row). Parquet needs
+pyarrow. Model settings are read from backend/.env like the API's.
+"""
+import os
+import sys
+import csv
+import io
+import json
+import time
+import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+# The parent process only runs the model, so give it the cores not used for decoding
+os.environ.setdefault("THREAD_POLICY", "latency")
+
+sys.path.append(os.path.dirname(__file__))
+
+import cv2  # noqa: E402
+from inference import Predictor, SNIFF_BYTES, apply_thread_budget, decode_image, preprocess, sniff_format  # noqa: E402
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".dcm", ".dicom")
+
+
+def _quiet():
+    """The pipeline logs every image; keep the progress report readable"""
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def _list_inputs(source: str, all_files: bool = False):
+    if os.path.isdir(source):
+        paths = []
+        for root, _, files in os.walk(source):
+            for fname in files:
+                if all_files or fname.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.append(os.path.join(root, fname))
+        return sorted(paths)
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, newline="") as f:
+        if source.lower().endswith(".csv"):
+            paths = [row["path"] for row in csv.DictReader(f) if row.get("path")]
+        else:
+            paths = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    return [p if os.path.isabs(p) else os.path.join(base, p) for p in paths]
+
+
+# ---------------- decode workers ----------------
+
+_worker_spec = None
+
+
+def _worker_init(input_size, clahe):
+    global _worker_spec
+    _worker_spec = (tuple(input_size), clahe)
+    # Parallelism comes from the process pool
+    cv2.setNumThreads(1)
+
+
+def _load_tensor(path: str):
+    """Decode + preprocess one file in a worker. Returns (path, tensor, shape, error)."""
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+        kind = sniff_format(raw[:SNIFF_BYTES], path)
+        if kind is None:
+            return path, None, None, "unsupported file type"
+        with _quiet():
+            image_np = decode_image(raw, kind)
+        del raw
+        tensor = preprocess(image_np, _worker_spec[0], _worker_spec[1])
+        return path, tensor, list(image_np.shape), None
+    except Exception as e:
+        return path, None, None, str(e)
+
+
+# ---------------- output writers ----------------
+
+class _RowWriter:
+    """Appends result rows; also reports which paths a previous run already wrote"""
+
+    def __init__(self, path: str, columns: list):
+        self.path = path
+        self.columns = columns
+
+    def done(self, retry_errors: bool) -> set:
+        raise NotImplementedError
+
+    def write(self, rows: list):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def _truncate_partial_line(path: str):
+    """Drop a half-written last line left by an interrupted run"""
+    with open(path, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(max(size - 1, 0))
+        if f.read(1) == b"\n":
+            return
+        chunk = 64 * 1024
+        pos = size
+        while pos > 0:
+            start = max(pos - chunk, 0)
+            f.seek(start)
+            idx = f.read(pos - start).rfind(b"\n")
+            if idx >= 0:
+                f.truncate(start + idx + 1)
+                return
+            pos = start
+        f.truncate(0)
+
+
+class _CsvWriter(_RowWriter):
+    def __init__(self, path, columns):
+        super().__init__(path, columns)
+        if os.path.exists(path):
+            _truncate_partial_line(path)
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, "a", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=columns, extrasaction="ignore")
+        if new_file:
+            self._writer.writeheader()
+            self._file.flush()
+
+    def done(self, retry_errors):
+        with open(self.path, newline="") as f:
+            return {row["path"] for row in csv.DictReader(f) if not (retry_errors and row.get("error"))}
+
+    def write(self, rows):
+        for row in rows:
+            row = dict(row)
+            row["findings"] = json.dumps(row["findings"]) if row["findings"] is not None else ""
+            row["image_shape"] = "x".join(map(str, row["image_shape"])) if row["image_shape"] else ""
+            self._writer.writerow(row)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class _JsonlWriter(_RowWriter):
+    def __init__(self, path, columns):
+        super().__init__(path, columns)
+        if os.path.exists(path):
+            _truncate_partial_line(path)
+        self._file = open(path, "a")
+
+    def done(self, retry_errors):
+        done = set()
+        with open(self.path) as f:
+            for line in f:
+                row = json.loads(line)
+                if not (retry_errors and row.get("error")):
+                    done.add(row["path"])
+        return done
+
+    def write(self, rows):
+        for row in rows:
+            self._file.write(json.dumps(row) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetWriter(_RowWriter):
+    """A directory of part-NNNNN.parquet files; each part is written atomically"""
+
+    _text_columns = ("path", "model_version", "top_finding", "findings", "error")
+
+    def __init__(self, path, columns):
+        super().__init__(path, columns)
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow (pip install pyarrow)")
+        os.makedirs(path, exist_ok=True)
+        self._next_part = len([f for f in os.listdir(path) if f.endswith(".parquet")])
+
+    def done(self, retry_errors):
+        import pyarrow.parquet as pq
+        done = set()
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith(".parquet"):
+                table = pq.read_table(os.path.join(self.path, name), columns=["path", "error"])
+                for path, error in zip(table.column("path").to_pylist(), table.column("error").to_pylist()):
+                    if not (retry_errors and error):
+                        done.add(path)
+        return done
+
+    def write(self, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        types = {"top_confidence": pa.float64(), "image_shape": pa.list_(pa.int64())}
+        # Fixed schema so parts with only error rows still line up with the rest
+        schema = pa.schema([
+            (col, types.get(col, pa.string() if col in self._text_columns else pa.float64())) for col in self.columns
+        ])
+        table = pa.Table.from_pylist([
+            {**row, "findings": json.dumps(row["findings"]) if row["findings"] is not None else None}
+            for row in rows
+        ], schema=schema)
+        final = os.path.join(self.path, f"part-{self._next_part:05d}.parquet")
+        tmp = final + ".tmp"
+        pq.write_table(table, tmp)
+        os.replace(tmp, final)
+        self._next_part += 1
+
+
+def _open_writer(path: str, fmt: str, columns: list) -> _RowWriter:
+    if fmt == "auto":
+        ext = os.path.splitext(path)[1].lower()
+        fmt = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl", ".parquet": "parquet"}.get(ext)
+        if fmt is None:
+            raise SystemExit(f"Can't infer the output format from {path}; pass --format")
+    return {"csv": _CsvWriter, "jsonl": _JsonlWriter, "parquet": _ParquetWriter}[fmt](path, columns)
+
+
+# ---------------- scoring ----------------
+
+def _resolve_predictor(version: str = None) -> Predictor:
+    from inference import registry
+    predictor = Predictor(version)
+    model = predictor.model
+    if model is None:
+        available = ", ".join(registry.list_versions()) or "none"
+        raise SystemExit(f"Model version {version or registry.active_version()} not found (available: {available})")
+    if not model.loaded:
+        raise SystemExit(f"Model {model.name} failed to load: {model.error}")
+    # Pin the version so a registry switch mid-run can't mix models in one output
+    return Predictor(model=model)
+
+
+def _score_batch(predictor: Predictor, items: list) -> list:
+    tensors = np.concatenate([tensor for _, tensor, _ in items], axis=0)
+    rows = []
+    for (path, _, shape), prediction in zip(items, predictor.predict_tensors(tensors)):
+        findings = prediction.findings
+        row = {
+            "path": path,
+            "model_version": prediction.model_version,
+            "top_finding": findings[0]["label"] if findings else None,
+            "top_confidence": round(findings[0]["confidence"], 6) if findings else None,
+            "findings": findings,
+            "image_shape": shape,
+            "error": None,
+        }
+        row.update({label: round(float(p), 6) for label, p in zip(prediction.model.labels, prediction.probabilities)})
+        rows.append(row)
+    return rows
+
+
+def _error_row(model, path: str, error: str) -> dict:
+    row = {"path": path, "model_version": model.name, "top_finding": None, "top_confidence": None,
+           "findings": None, "image_shape": None, "error": error}
+    row.update({label: None for label in model.labels})
+    return row
+
+
+class _Progress:
+    def __init__(self, total: int, every: float):
+        self.total = total
+        self.every = every
+        self.done = 0
+        self.errors = 0
+        self.started = time.perf_counter()
+        self._last = self.started
+
+    def update(self, done: int, errors: int, force: bool = False):
+        self.done += done
+        self.errors += errors
+        now = time.perf_counter()
+        if not force and now - self._last < self.every:
+            return
+        self._last = now
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else float("inf")
+        eta_text = time.strftime("%H:%M:%S", time.gmtime(eta)) if eta != float("inf") else "--:--:--"
+        print(f"[bulk] {self.done}/{self.total} ({100 * self.done / max(self.total, 1):.1f}%) "
+              f"{rate:.1f} img/s, {self.errors} errors, elapsed {time.strftime('%H:%M:%S', time.gmtime(elapsed))}, "
+              f"eta {eta_text}", flush=True)
+
+
+def score(args):
+    predictor = _resolve_predictor(args.version)
+    model = predictor.model
+    paths = _list_inputs(args.source, args.all_files)
+    if args.limit:
+        paths = paths[:args.limit]
+    columns = ["path", "model_version", "top_finding", "top_confidence", "findings", "image_shape", "error"] + list(model.labels)
+    writer = _open_writer(args.output, args.format, columns)
+    done = writer.done(args.retry_errors)
+    pending = [p for p in paths if p not in done]
+    print(f"[bulk] {len(paths)} inputs, {len(paths) - len(pending)} already scored, {len(pending)} to go "
+          f"(model {model.name}, {args.workers} decode workers, batch {args.batch_size})")
+    if not pending:
+        writer.close()
+        return
+
+    progress = _Progress(len(pending), args.progress_every)
+    batch, out_rows = [], []
+    window = max(args.workers * 4, args.batch_size * 2)
+    queue = iter(pending)
+
+    def flush_rows():
+        if out_rows:
+            writer.write(out_rows)
+            out_rows.clear()
+
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_worker_init,
+                                 initargs=(model.input_size, model.clahe)) as pool:
+            in_flight = set()
+            while True:
+                # Bounded read-ahead: decoded tensors wait in memory for the model
+                while len(in_flight) < window:
+                    path = next(queue, None)
+                    if path is None:
+                        break
+                    in_flight.add(pool.submit(_load_tensor, path))
+                if not in_flight:
+                    break
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                errors = 0
+                for future in finished:
+                    path, tensor, shape, error = future.result()
+                    if error:
+                        out_rows.append(_error_row(model, path, error))
+                        errors += 1
+                    else:
+                        batch.append((path, tensor, shape))
+                progress.update(errors, errors)
+                while len(batch) >= args.batch_size:
+                    items, batch = batch[:args.batch_size], batch[args.batch_size:]
+                    out_rows.extend(_score_batch(predictor, items))
+                    progress.update(len(items), 0)
+                if len(out_rows) >= args.flush_every:
+                    flush_rows()
+            if batch:
+                out_rows.extend(_score_batch(predictor, batch))
+                progress.update(len(batch), 0)
+                batch = []
+    finally:
+        # Everything scored so far is kept, so an interrupted run resumes from here
+        flush_rows()
+        writer.close()
+    progress.update(0, 0, force=True)
+    print(f"[bulk] Wrote {args.output}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Offline bulk scoring for the Clarix model")
+    parser.add_argument("source", help="Directory to walk, or a manifest (.txt paths or .csv with a path column)")
+    parser.add_argument("--output", required=True, help="Results file (.csv, .jsonl) or directory (.parquet)")
+    parser.add_argument("--format", choices=["auto", "csv", "jsonl", "parquet"], default="auto")
+    parser.add_argument("--version", help="Registry version to score with (defaults to the active one)")
+    parser.add_argument("--workers", type=int, default=max((os.cpu_count() or 2) - 1, 1), help="Decode processes")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--flush-every", type=int, default=256, help="Rows buffered between writes")
+    parser.add_argument("--progress-every", type=float, default=10.0, help="Seconds between progress lines")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--all-files", action="store_true", help="Sniff every file, not just known extensions")
+    parser.add_argument("--retry-errors", action="store_true", help="Re-score paths that failed in a previous run")
+    args = parser.parse_args()
+    apply_thread_budget()
+    score(args)
+
+
+if __name__ == "__main__":
+    main_cli()
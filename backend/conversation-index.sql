@@ -0,0 +1,104 @@
+-- Per-conversation summary of direct messages, maintained by a trigger.
+-- Each pair of users has one row per participant (user_id = the owner of the
+-- inbox), so an inbox is read with one indexed query whose cost depends on the
+-- number of conversations, not messages. Run after contact-messages-schema.sql.
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id UUID REFERENCES auth.users(id) ON DELETE CASCADE NOT NULL,
+    peer_id UUID REFERENCES auth.users(id) ON DELETE CASCADE NOT NULL,
+    last_message_id UUID,
+    last_message_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    last_message_preview TEXT,
+    last_message_from_me BOOLEAN NOT NULL DEFAULT FALSE,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    last_read_at TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (user_id, peer_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_conversations_inbox ON conversations(user_id, last_message_at DESC, peer_id DESC);
+
+ALTER TABLE conversations ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS "Users can view own conversations" ON conversations;
+CREATE POLICY "Users can view own conversations" ON conversations
+    FOR SELECT USING (auth.uid() = user_id);
+
+-- History of one conversation, newest first, in both directions
+CREATE INDEX IF NOT EXISTS idx_messages_pair_created ON messages(from_user_id, to_user_id, created_at DESC, id DESC);
+
+-- Keep the summary in step with every inserted message (backend or supabase-js)
+CREATE OR REPLACE FUNCTION public.index_message()
+RETURNS TRIGGER AS $$
+DECLARE
+    preview TEXT := LEFT(NEW.content, 200);
+BEGIN
+    -- Sender's side: newest message, nothing unread
+    INSERT INTO conversations (user_id, peer_id, last_message_id, last_message_at, last_message_preview, last_message_from_me)
+    VALUES (NEW.from_user_id, NEW.to_user_id, NEW.id, NEW.created_at, preview, TRUE)
+    ON CONFLICT (user_id, peer_id) DO UPDATE SET
+        last_message_id = EXCLUDED.last_message_id,
+        last_message_at = EXCLUDED.last_message_at,
+        last_message_preview = EXCLUDED.last_message_preview,
+        last_message_from_me = TRUE
+    WHERE conversations.last_message_at <= EXCLUDED.last_message_at;
+
+    IF NEW.to_user_id <> NEW.from_user_id THEN
+        -- Recipient's side: one more unread, newest message if it is the latest
+        INSERT INTO conversations (user_id, peer_id, last_message_id, last_message_at, last_message_preview, last_message_from_me, unread_count)
+        VALUES (NEW.to_user_id, NEW.from_user_id, NEW.id, NEW.created_at, preview, FALSE, 1)
+        ON CONFLICT (user_id, peer_id) DO UPDATE SET
+            unread_count = conversations.unread_count + 1,
+            last_message_id = CASE WHEN conversations.last_message_at <= EXCLUDED.last_message_at
+                THEN EXCLUDED.last_message_id ELSE conversations.last_message_id END,
+            last_message_preview = CASE WHEN conversations.last_message_at <= EXCLUDED.last_message_at
+                THEN EXCLUDED.last_message_preview ELSE conversations.last_message_preview END,
+            last_message_from_me = CASE WHEN conversations.last_message_at <= EXCLUDED.last_message_at
+                THEN FALSE ELSE conversations.last_message_from_me END,
+            last_message_at = GREATEST(conversations.last_message_at, EXCLUDED.last_message_at);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
+
+DROP TRIGGER IF EXISTS index_message_after_insert ON messages;
+CREATE TRIGGER index_message_after_insert
+    AFTER INSERT ON messages
+    FOR EACH ROW EXECUTE FUNCTION public.index_message();
+
+-- One page of a conversation's history, newest first, strictly before the
+-- (before_at, before_id) cursor when given
+CREATE OR REPLACE FUNCTION public.conversation_messages(
+    me UUID,
+    peer UUID,
+    before_at TIMESTAMP WITH TIME ZONE DEFAULT NULL,
+    before_id UUID DEFAULT NULL,
+    page_size INTEGER DEFAULT 50
+)
+RETURNS SETOF messages AS $$
+    SELECT * FROM (
+        (SELECT * FROM messages
+         WHERE from_user_id = me AND to_user_id = peer
+           AND (before_at IS NULL OR (created_at, id) < (before_at, before_id))
+         ORDER BY created_at DESC, id DESC LIMIT page_size)
+        UNION ALL
+        (SELECT * FROM messages
+         WHERE from_user_id = peer AND to_user_id = me AND me <> peer
+           AND (before_at IS NULL OR (created_at, id) < (before_at, before_id))
+         ORDER BY created_at DESC, id DESC LIMIT page_size)
+    ) page
+    ORDER BY created_at DESC, id DESC
+    LIMIT page_size;
+$$ LANGUAGE sql STABLE SECURITY DEFINER;
+
+REVOKE ALL ON FUNCTION public.conversation_messages(UUID, UUID, TIMESTAMP WITH TIME ZONE, UUID, INTEGER) FROM PUBLIC;
+REVOKE ALL ON FUNCTION public.conversation_messages(UUID, UUID, TIMESTAMP WITH TIME ZONE, UUID, INTEGER) FROM anon, authenticated;
+
+-- Build the summary for messages sent before this file was run (history counts as read)
+INSERT INTO conversations (user_id, peer_id, last_message_id, last_message_at, last_message_preview, last_message_from_me)
+SELECT DISTINCT ON (owner, peer) owner, peer, id, created_at, LEFT(content, 200), owner = from_user_id
+FROM (
+    SELECT from_user_id AS owner, to_user_id AS peer, * FROM messages
+    UNION ALL
+    SELECT to_user_id AS owner, from_user_id AS peer, * FROM messages WHERE to_user_id <> from_user_id
+) m
+ORDER BY owner, peer, created_at DESC, id DESC
+ON CONFLICT (user_id, peer_id) DO NOTHING;
@@ -0,0 +1,231 @@
+"""
+Derivatives of diagnosis images, built once per original and kept on disk:
+
+    thumb    JPEG, longest side THUMBNAIL_SIZE (list views)
+    preview  JPEG, longest side PREVIEW_SIZE (reports, detail views)
+    model    the preprocessed NCHW float32 tensor for a model's input spec,
+             so re-analysis runs the model without decoding the film again
+
+Originals are read through storage.ImageCache and decoded once for all
+derivatives, with the same decode plan (and memory-budget downsampling) a live
+request would get, so a cached model tensor gives the same prediction as the
+upload did. Each tensor records the reduction it was decoded at and is rebuilt
+if the budget settings would now decode that original differently. Files are keyed by the original's content hash; a small JSON
+manifest per bucket path records which hash (and derivatives) it has. Writes
+are atomic renames, so a concurrent reader sees a whole file or none.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+from inference import SNIFF_BYTES, DecodePlan, decode_image, preprocess, read_image_header, sniff_format
+from storage import BACKEND_DIR, ImageCache, normalize_path
+
+DERIVATIVE_DIR = os.getenv("DERIVATIVE_DIR") or os.path.join(BACKEND_DIR, ".derivatives")
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "256"))
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", "1024"))
+DERIVATIVE_JPEG_QUALITY = int(os.getenv("DERIVATIVE_JPEG_QUALITY", "85"))
+DERIVATIVE_WORKERS = int(os.getenv("DERIVATIVE_WORKERS", "1"))
+IMAGE_SIZES = {"thumb": THUMBNAIL_SIZE, "preview": PREVIEW_SIZE}
+
+
+def model_spec_key(model) -> str:
+    """Derivative name for a model's preprocessing spec (input size + CLAHE)"""
+    height, width = model.input_size
+    return f"model-{height}x{width}-{'clahe' if model.clahe else 'plain'}"
+
+
+def _to_uint8(image_np: np.ndarray) -> np.ndarray:
+    """Display copy: non-uint8 data (DICOM) gets the same min-max stretch preprocess uses"""
+    if image_np.dtype == np.uint8:
+        return image_np
+    lo, hi = float(image_np.min()), float(image_np.max())
+    scratch = image_np.astype(np.float32)
+    scratch -= lo
+    scratch /= (hi - lo) if hi > lo else 1.0
+    scratch *= 255
+    return scratch.astype(np.uint8)
+
+
+class DerivativeStore:
+    def __init__(self, cache: ImageCache, root: str = DERIVATIVE_DIR, workers: int = DERIVATIVE_WORKERS):
+        self.cache = cache
+        self.root = root
+        self.workers = workers
+        os.makedirs(os.path.join(root, "paths"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._executor = None
+        self.counters = {"built": 0, "served": 0, "tensor_hits": 0, "tensor_misses": 0, "failed": 0}
+
+    # ---- files ----
+
+    def _manifest_path(self, path: str) -> str:
+        return os.path.join(self.root, "paths", hashlib.sha1(path.encode()).hexdigest() + ".json")
+
+    def _file_path(self, digest: str, name: str) -> str:
+        ext = "npy" if name.startswith("model-") else "jpg"
+        return os.path.join(self.root, digest[:2], f"{digest}.{name}.{ext}")
+
+    def _write_atomic(self, final_path: str, write):
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(final_path), suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp_path, final_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    def manifest(self, path: str):
+        try:
+            with open(self._manifest_path(normalize_path(path))) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _usable(self, manifest, names) -> bool:
+        return manifest is not None and all(
+            name in manifest["files"] and os.path.exists(self._file_path(manifest["digest"], name))
+            and (not name.startswith("model-") or manifest["files"][name].get("decode_scale") == self._live_scale(manifest))
+            for name in names
+        )
+
+    def _live_scale(self, manifest) -> int:
+        """Reduction a live request would decode this original at under the current budget settings"""
+        if "plan" not in manifest:
+            return None
+        plan = DecodePlan(**manifest["plan"])
+        plan.fit_budget()
+        return plan.scale
+
+    # ---- building ----
+
+    def _build(self, path: str, models: list, names: list) -> dict:
+        start = time.perf_counter()
+        blob_path = self.cache.fetch(path)
+        digest = os.path.basename(blob_path)
+        manifest = self.manifest(path)
+        if manifest is None or manifest["digest"] != digest:
+            manifest = {"path": path, "digest": digest, "files": {}}
+        with self.cache.open(path) as f:
+            kind = sniff_format(f.read(SNIFF_BYTES), path)
+            if kind is None:
+                raise ValueError(f"{path} is not a supported image")
+            plan = DecodePlan.from_header(read_image_header(f, kind), kind, os.path.getsize(blob_path))
+            manifest["plan"] = plan.header()
+            plan.fit_budget()
+            image_np = decode_image(f, kind, plan.scale)
+        manifest.update({"kind": kind, "shape": list(image_np.shape)})
+
+        display = None
+        for name in names:
+            if name in IMAGE_SIZES:
+                if display is None:
+                    display = Image.fromarray(_to_uint8(image_np))
+                    if display.mode not in ("L", "RGB"):
+                        display = display.convert("RGB")
+                derived = display.copy()
+                derived.thumbnail((IMAGE_SIZES[name], IMAGE_SIZES[name]), Image.LANCZOS)
+                self._write_atomic(self._file_path(digest, name),
+                                   lambda f: derived.save(f, format="JPEG", quality=DERIVATIVE_JPEG_QUALITY))
+                manifest["files"][name] = {"width": derived.width, "height": derived.height, "media_type": "image/jpeg"}
+        for model in models:
+            name = model_spec_key(model)
+            if name in names:
+                tensor = preprocess(image_np, model.input_size, model.clahe)
+                self._write_atomic(self._file_path(digest, name), lambda f: np.save(f, tensor))
+                manifest["files"][name] = {"shape": list(tensor.shape), "dtype": str(tensor.dtype),
+                                           "decode_scale": plan.scale}
+        del image_np, display
+
+        manifest["updated_at"] = datetime.now().isoformat()
+        self._write_atomic(self._manifest_path(path), lambda f: f.write(json.dumps(manifest).encode()))
+        with self._lock:
+            self.counters["built"] += 1
+        print(f"[derivatives] Built {', '.join(names)} for {path} in {(time.perf_counter() - start) * 1000:.0f} ms")
+        return manifest
+
+    def ensure(self, path: str, models: list = (), sizes=tuple(IMAGE_SIZES)) -> dict:
+        """
+        Manifest for `path` with the requested image sizes and model tensors
+        present, building whatever is missing. Concurrent calls for one path
+        share a build.
+        """
+        path = normalize_path(path)
+        wanted = list(sizes) + [model_spec_key(m) for m in models]
+        while True:
+            manifest = self.manifest(path)
+            if self._usable(manifest, wanted):
+                return manifest
+            with self._lock:
+                future = self._inflight.get(path)
+                owner = future is None
+                if owner:
+                    future = self._inflight[path] = Future()
+            if not owner:
+                # Another build may have been for different derivatives; re-check afterwards
+                future.result()
+                continue
+            try:
+                missing = [n for n in wanted if not self._usable(manifest, [n])]
+                manifest = self._build(path, list(models), missing)
+                future.set_result(manifest)
+                return manifest
+            except BaseException as e:
+                with self._lock:
+                    self.counters["failed"] += 1
+                future.set_exception(e)
+                raise
+            finally:
+                with self._lock:
+                    self._inflight.pop(path, None)
+
+    def schedule(self, path: str, models: list = ()):
+        """Build every derivative for `path` in the background (ingest)"""
+        def run():
+            try:
+                self.ensure(path, models)
+            except Exception as e:
+                print(f"[derivatives] Building derivatives for {path} failed: {e}")
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=max(self.workers, 1), thread_name_prefix="derivatives")
+        return self._executor.submit(run)
+
+    # ---- reading ----
+
+    def image(self, path: str, size: str):
+        """(file path, content digest, manifest entry) of the `size` derivative of `path`"""
+        if size not in IMAGE_SIZES:
+            raise ValueError(f"Unknown derivative size: {size}")
+        manifest = self.ensure(path, sizes=(size,))
+        with self._lock:
+            self.counters["served"] += 1
+        return self._file_path(manifest["digest"], size), manifest["digest"], manifest["files"][size]
+
+    def model_tensor(self, path: str, model) -> np.ndarray:
+        """Preprocessed input for `model`, straight from the derivative when it exists"""
+        manifest = self.manifest(path)
+        name = model_spec_key(model)
+        hit = self._usable(manifest, [name])
+        with self._lock:
+            self.counters["tensor_hits" if hit else "tensor_misses"] += 1
+        if not hit:
+            manifest = self.ensure(path, [model], sizes=())
+        return np.load(self._file_path(manifest["digest"], name))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"root": self.root, "building": len(self._inflight), **self.counters}
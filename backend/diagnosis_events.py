@@ -0,0 +1,133 @@
+"""
+Status transitions of a user's diagnoses (pending -> processing ->
+completed/failed), pushed to the dashboard over SSE (/api/diagnoses/events)
+instead of being polled.
+
+    publish_diagnosis(diagnosis, predictions=result)          # any thread
+    queue, replay, resync = events.subscribe(user_id, last_event_id)
+
+Events go through an in-process pub/sub. Each user's recent events are kept,
+so a reconnecting EventSource replays what it missed after its Last-Event-ID.
+Ids carry a per-process epoch. An id from before a restart, or one that fell
+out of the buffer, gets a "resync" event telling the client to reload its list once.
+"""
+import asyncio
+import collections
+import json
+import os
+import threading
+import uuid
+from datetime import datetime
+
+EVENT_BUFFER_PER_USER = int(os.getenv("EVENT_BUFFER_PER_USER", "100"))
+EVENT_HEARTBEAT_S = float(os.getenv("EVENT_HEARTBEAT_S", "15"))
+EVENT_RETRY_MS = int(os.getenv("EVENT_RETRY_MS", "3000"))
+EVENT_SUBSCRIBER_QUEUE = int(os.getenv("EVENT_SUBSCRIBER_QUEUE", "256"))
+
+
+class DiagnosisEvents:
+    def __init__(self, buffer_size: int):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.buffer_size = buffer_size
+        self.seq = 0
+        self.history = {}      # user_id -> deque of (seq, event, data)
+        self.evicted = {}      # user_id -> newest seq dropped from the history
+        self.subscribers = {}  # user_id -> set of asyncio.Queue
+        self.loop = None
+        self.counters = {"published": 0, "delivered": 0, "replayed": 0, "resyncs": 0, "overflows": 0}
+        self._lock = threading.Lock()
+
+    def publish(self, user_id: str, event: str, data: dict):
+        """Safe to call from worker threads; delivery happens on the event loop"""
+        with self._lock:
+            self.seq += 1
+            item = (self.seq, event, data)
+            history = self.history.setdefault(user_id, collections.deque(maxlen=self.buffer_size))
+            if len(history) == history.maxlen:
+                self.evicted[user_id] = history[0][0]
+            history.append(item)
+            self.counters["published"] += 1
+            queues = list(self.subscribers.get(user_id, ()))
+            loop = self.loop
+        if queues and loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._deliver, queues, item)
+
+    def _deliver(self, queues: list, item: tuple):
+        for queue in queues:
+            try:
+                queue.put_nowait(item)
+                self.counters["delivered"] += 1
+            except Exception:
+                # A stalled client: drop its backlog and have it resync instead of growing without bound
+                self.counters["overflows"] += 1
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def subscribe(self, user_id: str, last_event_id: str = None):
+        """(queue, events to replay, resync needed); replay and live delivery never overlap"""
+        queue = asyncio.Queue(EVENT_SUBSCRIBER_QUEUE)
+        with self._lock:
+            self.loop = asyncio.get_running_loop()
+            self.subscribers.setdefault(user_id, set()).add(queue)
+            history = list(self.history.get(user_id, ()))
+            evicted = self.evicted.get(user_id, 0)
+        if not last_event_id:
+            return queue, [], False
+        epoch, _, seq = last_event_id.partition("-")
+        if epoch != self.epoch or not seq.isdigit() or int(seq) < evicted:
+            self.counters["resyncs"] += 1
+            return queue, [], True
+        replay = [item for item in history if item[0] > int(seq)]
+        self.counters["replayed"] += len(replay)
+        return queue, replay, False
+
+    def unsubscribe(self, user_id: str, queue):
+        with self._lock:
+            queues = self.subscribers.get(user_id)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self.subscribers[user_id]
+
+    def format(self, item: tuple) -> str:
+        seq, event, data = item
+        return f"id: {self.epoch}-{seq}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+    def format_resync(self) -> str:
+        with self._lock:
+            seq = self.seq
+        return self.format((seq, "resync", {"reason": "events were missed, reload the diagnoses list"}))
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "epoch": self.epoch,
+                "last_id": self.seq,
+                "subscribers": sum(len(q) for q in self.subscribers.values()),
+                "users_buffered": len(self.history),
+                **self.counters,
+            }
+
+
+events = DiagnosisEvents(EVENT_BUFFER_PER_USER)
+
+
+def publish_diagnosis(diagnosis: dict, predictions: dict = None, error: str = None):
+    """Push a diagnosis' current status (and a short result summary) to its owner's streams"""
+    data = {
+        "diagnosis_id": diagnosis["id"],
+        "status": diagnosis.get("status"),
+        "updated_at": diagnosis.get("updated_at") or datetime.now().isoformat(),
+    }
+    if predictions:
+        data["summary"] = {
+            "top_findings": predictions.get("predictions", [])[:3],
+            "model_version": predictions.get("model_version"),
+        }
+    if error:
+        data["error"] = error
+    try:
+        events.publish(diagnosis["user_id"], "status", data)
+    except Exception as e:
+        print(f"[events] Could not publish {diagnosis['id']}: {e}")
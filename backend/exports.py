@@ -0,0 +1,182 @@
+"""
+Streaming exports of a table (diagnoses, profiles) as NDJSON or CSV, for
+/api/admin/export/diagnoses and /api/admin/export/users.
+
+    return stream_export(supabase, "diagnoses", "diagnoses", fmt, compression, filters)
+
+Rows are read in keyset pages of EXPORT_PAGE_SIZE, ordered by (created_at, id)
+(add-export-indexes.sql). The next page is fetched while the current one is
+sent, and output is gzip-compressed as it is produced, so an export holds at
+most two pages in memory whatever the table size. At most
+EXPORT_MAX_CONCURRENT exports run per worker; more get 429.
+"""
+import asyncio
+import csv
+import io
+import json
+import os
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+EXPORT_GZIP_LEVEL = int(os.getenv("EXPORT_GZIP_LEVEL", "6"))
+EXPORT_MAX_CONCURRENT = int(os.getenv("EXPORT_MAX_CONCURRENT", "2"))
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_CSV_COLUMNS = {
+    "diagnoses": ["id", "user_id", "status", "image_path", "model_version", "predictions", "report",
+                  "created_at", "updated_at"],
+    "profiles": ["id", "email", "username", "first_name", "last_name", "role", "approved",
+                 "created_at", "updated_at"],
+}
+DIAGNOSIS_STATUSES = {"pending", "processing", "completed", "failed"}
+PROFILE_ROLES = {"user", "doctor", "super_admin"}
+_running = 0
+_lock = threading.Lock()
+
+
+def timestamp_param(value: Optional[str], name: str) -> Optional[str]:
+    if not value:
+        return None
+    try:
+        at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        return (at if at.tzinfo else at.replace(tzinfo=timezone.utc)).isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be an ISO 8601 date or timestamp")
+
+
+def choices_param(value: Optional[str], allowed: set, name: str) -> Optional[List[str]]:
+    """Comma-separated filter values, checked against the allowed set"""
+    if not value:
+        return None
+    choices = [v.strip() for v in value.split(",") if v.strip()]
+    invalid = [v for v in choices if v not in allowed]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}: {', '.join(invalid)} (expected {', '.join(sorted(allowed))})")
+    return choices
+
+
+def _page(client, table: str, filters, after) -> list:
+    query = client.table(table).select("*").not_.is_("created_at", "null")
+    query = filters(query)
+    if after:
+        at, row_id = after
+        query = query.or_(f'created_at.gt."{at}",and(created_at.eq."{at}",id.gt.{row_id})')
+    return query.order("created_at").order("id").limit(EXPORT_PAGE_SIZE).execute().data or []
+
+
+async def _pages(client, table: str, filters):
+    """Keyset pages of the table, fetching the next page while the caller handles the current one"""
+    page = asyncio.ensure_future(run_in_threadpool(_page, client, table, filters, None))
+    try:
+        while page is not None:
+            rows = await page
+            page = None
+            if len(rows) == EXPORT_PAGE_SIZE:
+                after = (rows[-1]["created_at"], rows[-1]["id"])
+                page = asyncio.ensure_future(run_in_threadpool(_page, client, table, filters, after))
+            if rows:
+                yield rows
+    finally:
+        if page is not None:
+            page.cancel()
+
+
+def _csv_cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if not isinstance(value, str):
+        return value
+    # Keep spreadsheet apps from evaluating user-supplied text as a formula
+    return "'" + value if value[:1] in ("=", "+", "-", "@", "\t", "\r") else value
+
+
+def _encoder(fmt: str, table: str):
+    """page of rows -> text; the CSV header goes out with the first page"""
+    if fmt == "ndjson":
+        return lambda rows: "".join(json.dumps(row, default=str) + "\n" for row in rows)
+    columns = EXPORT_CSV_COLUMNS[table]
+    header = [True]
+
+    def encode(rows):
+        out = io.StringIO()
+        writer = csv.writer(out)
+        if header[0]:
+            writer.writerow(columns)
+            header[0] = False
+        writer.writerows([_csv_cell(row.get(column)) for column in columns] for row in rows)
+        return out.getvalue()
+    return encode
+
+
+def reserve_export():
+    """Take one of the EXPORT_MAX_CONCURRENT slots (or 429); returns release(), safe to call twice"""
+    global _running
+    with _lock:
+        if _running >= EXPORT_MAX_CONCURRENT:
+            raise HTTPException(status_code=429, detail="Too many exports running, try again shortly",
+                                headers={"Retry-After": "30"})
+        _running += 1
+    released = []
+
+    def release():
+        global _running
+        with _lock:
+            if not released:
+                released.append(True)
+                _running -= 1
+    return release
+
+
+def stream_export(client, table: str, name: str, fmt: str, compression: str, filters) -> StreamingResponse:
+    """
+    The export as a streaming download; `filters(query)` narrows the table query.
+    Raises 400 for an unknown format/compression and 429 when no slot is free.
+    """
+    if fmt not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_MEDIA_TYPES)}")
+    if compression not in ("gzip", "none"):
+        raise HTTPException(status_code=400, detail="compression must be gzip or none")
+    release = reserve_export()
+
+    encode = _encoder(fmt, table)
+    compressor = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31) if compression == "gzip" else None
+
+    async def stream():
+        started, exported = time.perf_counter(), 0
+        try:
+            async for rows in _pages(client, table, filters):
+                data = encode(rows).encode("utf-8")
+                exported += len(rows)
+                # Sync-flush each page so the client receives it now, not when the export ends
+                yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else data
+            if not exported and fmt == "csv":
+                data = encode([]).encode("utf-8")
+                yield compressor.compress(data) if compressor else data
+            if compressor:
+                yield compressor.flush()
+            print(f"[export] {table}: {exported} rows as {fmt} in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            # Headers are already sent; aborting the response leaves the client with a truncated download
+            print(f"[export] {table} export failed after {exported} rows: {e}")
+            raise
+        finally:
+            release()
+
+    filename = f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}" + (".gz" if compressor else "")
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"', "Cache-Control": "no-store",
+               "X-Accel-Buffering": "no"}
+    media_type = "application/gzip" if compressor else f"{EXPORT_MEDIA_TYPES[fmt]}; charset=utf-8"
+    # The background task frees the slot if the body is never streamed (client gone before it started)
+    return StreamingResponse(stream(), media_type=media_type, headers=headers, background=BackgroundTask(release))
@@ -0,0 +1,115 @@
+"""
+Idempotency keys for POST /api/diagnoses/predict, which runs the model and
+stores the diagnosis in one request.
+
+    keys = IdempotencyKeys(supabase)
+    diagnosis, existing = keys.claim(row)      # row carries idempotency_key
+    if diagnosis is None:
+        return keys.stored_response(existing, digest)
+
+A client-supplied Idempotency-Key is claimed by inserting the row before
+inference (unique per user, add-idempotency-key-to-diagnoses.sql), so a retry
+gets the stored result back instead of a second inference or a duplicate row.
+Duplicates racing in this worker wait for the first request (begin/finish);
+ones on another worker get 409 until it has finished. A failed attempt, or a
+claim left in "processing" longer than IDEMPOTENCY_STALE_S by a worker that
+died, is taken over by the next retry.
+"""
+import asyncio
+import contextlib
+import json
+import os
+import re
+from datetime import datetime
+
+from fastapi import HTTPException
+
+from admission import admission
+
+IDEMPOTENCY_STALE_S = float(os.getenv("IDEMPOTENCY_STALE_S", "300"))
+IDEMPOTENCY_KEY_PATTERN = re.compile(r"^[A-Za-z0-9._:-]{8,128}$")
+
+
+def claim_is_stale(row: dict, stale_s: float = IDEMPOTENCY_STALE_S) -> bool:
+    """Whether a retry may take over the attempt in `row` (failed, or processing for too long)"""
+    if row.get("status") == "failed":
+        return True
+    if row.get("status") != "processing":
+        return False
+    try:
+        updated_at = datetime.fromisoformat(str(row.get("updated_at")).replace("Z", "+00:00"))
+    except ValueError:
+        return False
+    now = datetime.now(updated_at.tzinfo) if updated_at.tzinfo else datetime.now()
+    return (now - updated_at).total_seconds() > stale_s
+
+
+class IdempotencyKeys:
+    def __init__(self, client):
+        self.client = client
+        self.inflight = {}  # (user_id, key) -> Future resolving to the finished row
+
+    def find(self, user_id: str, key: str):
+        response = (self.client.table("diagnoses").select("*")
+                    .eq("user_id", user_id).eq("idempotency_key", key).limit(1).execute())
+        return response.data[0] if response.data else None
+
+    def claim(self, row: dict):
+        """
+        (claimed row, None) when this request should run the model, or
+        (None, existing row) when the key already belongs to another attempt
+        """
+        key = row.get("idempotency_key")
+        try:
+            response = self.client.table("diagnoses").insert(row).execute()
+            return response.data[0], None
+        except Exception as e:
+            if not key or not (getattr(e, "code", None) == "23505" or "23505" in str(e)):
+                raise
+        existing = self.find(row["user_id"], key)
+        if existing is None or not claim_is_stale(existing):
+            return None, existing
+        # Take over the failed/abandoned attempt; matching updated_at makes the takeover single-winner
+        takeover = {k: row[k] for k in ("status", "request_digest", "image_path", "updated_at")}
+        response = (self.client.table("diagnoses").update(takeover)
+                    .eq("id", existing["id"]).eq("updated_at", existing["updated_at"]).execute())
+        if response.data:
+            print(f"[AI] Taking over {existing['status']} attempt {existing['id']} for key {key}")
+            return response.data[0], None
+        return None, self.find(row["user_id"], key)
+
+    def stored_response(self, row: dict, digest: str) -> dict:
+        """Response for a repeated key: the stored result, or why it can't be served yet"""
+        if row.get("request_digest") and row["request_digest"] != digest:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different image")
+        if row.get("status") == "completed":
+            result = row.get("predictions") or {}
+            if isinstance(result, str):  # rows saved before predictions were stored as objects
+                result = json.loads(result)
+            return {**result, "diagnosis_id": row["id"], "replayed": True}
+        if row.get("status") == "failed":
+            raise HTTPException(status_code=409, detail="The original request failed; retry to run it again",
+                                headers={"Retry-After": "1"})
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still being processed",
+                            headers={"Retry-After": str(max(1, int(admission.service_time_s)))})
+
+    # ---- requests with the same key in this worker ----
+
+    def running(self, user_id: str, key: str):
+        """Future of the request already running with this key in this worker, if any"""
+        return self.inflight.get((user_id, key))
+
+    def begin(self, user_id: str, key: str) -> asyncio.Future:
+        future = self.inflight[(user_id, key)] = asyncio.get_running_loop().create_future()
+        return future
+
+    def finish(self, user_id: str, key: str, row: dict = None):
+        """Hand the finished row to waiting duplicates (re-read from the table when the request failed)"""
+        future = self.inflight.pop((user_id, key), None)
+        if future is None or future.done():
+            return
+        if row is None:
+            # Waiters re-read the row: a failed attempt is reported as such, not re-run
+            with contextlib.suppress(Exception):
+                row = self.find(user_id, key)
+        future.set_result(row or {"status": "failed"})
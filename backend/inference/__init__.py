@@ -0,0 +1,53 @@
+"""
+The X-ray inference pipeline as an importable package, shared by the API
+(main.py) and the offline tools (bulk_score.py, quantize_model.py).
+
+    from inference import Predictor
+    predictions = Predictor().predict_batch(images)
+"""
+from .decode_plan import MB, DecodePlan
+from .model import ModelVersion
+from .predictor import ModelUnavailableError, Prediction, Predictor
+from .processing import (
+    DEFAULT_LABELS,
+    NORMAL_LABEL,
+    SNIFF_BYTES,
+    ImageDecodeError,
+    UnsupportedImageError,
+    decode_image,
+    postprocess,
+    postprocess_batch,
+    postprocess_probs,
+    postprocess_probs_batch,
+    preprocess,
+    read_image_header,
+    sigmoid,
+    sniff_format,
+)
+from .threads import apply_thread_budget, effective_threads, thread_budget
+
+__all__ = [
+    "DEFAULT_LABELS",
+    "MB",
+    "NORMAL_LABEL",
+    "SNIFF_BYTES",
+    "DecodePlan",
+    "ImageDecodeError",
+    "ModelUnavailableError",
+    "ModelVersion",
+    "Prediction",
+    "Predictor",
+    "UnsupportedImageError",
+    "apply_thread_budget",
+    "decode_image",
+    "effective_threads",
+    "postprocess",
+    "postprocess_batch",
+    "postprocess_probs",
+    "postprocess_probs_batch",
+    "preprocess",
+    "read_image_header",
+    "sigmoid",
+    "sniff_format",
+    "thread_budget",
+]
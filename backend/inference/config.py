@@ -0,0 +1,74 @@
+"""
+Environment settings for the inference pipeline, read once at import.
+backend/.env is loaded here so tools importing the package see the same
+configuration as the API.
+"""
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODELS_DIR = os.path.join(BACKEND_DIR, "models")
+
+INFERENCE_MODEL_PATH = os.getenv("MODEL_PATH")
+# Which precision to serve: fp32 (default) or int8 (built with quantize_model.py)
+MODEL_VARIANT = os.getenv("MODEL_VARIANT", "fp32").lower()
+INT8_MODEL_PATH = os.getenv("INT8_MODEL_PATH")
+INT8_SUFFIX = ".int8.onnx"
+
+# Model registry: named versions loaded side by side, one of them serving
+MODEL_REGISTRY_PATH = os.getenv("MODEL_REGISTRY_PATH") or os.path.join(MODELS_DIR, "registry.json")
+MODEL_ACTIVE_VERSION = os.getenv("MODEL_ACTIVE_VERSION")
+MODEL_DRAIN_TIMEOUT = float(os.getenv("MODEL_DRAIN_TIMEOUT", "30"))
+MODEL_KEEP_RETIRED = os.getenv("MODEL_KEEP_RETIRED", "false").lower() == "true"
+MODEL_REGISTRY_POLL_SECONDS = float(os.getenv("MODEL_REGISTRY_POLL_SECONDS", "5"))
+
+# ONNX Runtime session tuning (thread counts come from the thread budget)
+ORT_EXECUTION_MODE = os.getenv("ORT_EXECUTION_MODE", "sequential").lower()  # sequential | parallel
+ORT_GRAPH_OPT_LEVEL = os.getenv("ORT_GRAPH_OPT_LEVEL", "all").lower()        # disable | basic | extended | all
+ORT_ENABLE_MEM_ARENA = os.getenv("ORT_ENABLE_MEM_ARENA", "true").lower() == "true"
+ORT_ENABLE_MEM_PATTERN = os.getenv("ORT_ENABLE_MEM_PATTERN", "true").lower() == "true"
+ORT_CACHE_ENABLED = os.getenv("ORT_CACHE_ENABLED", "true").lower() == "true"
+ORT_CACHE_DIR = os.getenv("ORT_CACHE_DIR") or os.path.join(MODELS_DIR, ".ort_cache")
+
+# CPU thread budget: cores are split between uvicorn workers, then between the
+# concurrent inference slots of a worker, and every library (OpenCV, ONNX
+# Runtime, torch) is sized to one slot's share instead of to the whole machine.
+#   throughput: one core per slot, as many slots as cores
+#   balanced:   half as many slots, two cores each (default)
+#   latency:    a single slot gets all of the worker's cores
+#   off:        leave library defaults alone, one inference slot per worker
+THREAD_POLICY = os.getenv("THREAD_POLICY", "balanced").lower()
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))  # worker processes sharing this machine
+
+# .pt/.pth checkpoints are compiled once into <name>.compiled-<hash>.{pt,onnx}
+COMPILE_FORMAT = os.getenv("COMPILE_FORMAT", "torchscript").lower()  # torchscript | onnx | none
+COMPILED_MARKER = ".compiled-"
+
+# Extra registry versions that are fused with the active model when ensembling.
+ENSEMBLE_MEMBERS = [m.strip() for m in os.getenv("ENSEMBLE_MEMBERS", "").split(",") if m.strip()]
+# Weights: active model first, then ENSEMBLE_MEMBERS in order (default 1.0 each)
+ENSEMBLE_WEIGHTS = [float(w) for w in os.getenv("ENSEMBLE_WEIGHTS", "").split(",") if w.strip()]
+ENSEMBLE_FUSION = os.getenv("ENSEMBLE_FUSION", "mean").lower()  # mean | max
+ENSEMBLE_DEFAULT = os.getenv("ENSEMBLE_DEFAULT", "false").lower() == "true"
+
+# Per-request decode memory budget (see decode_plan.py)
+INFERENCE_MEMORY_BUDGET_MB = float(os.getenv("INFERENCE_MEMORY_BUDGET_MB", "2048"))
+MEMORY_OVER_BUDGET = os.getenv("MEMORY_OVER_BUDGET", "downsample").lower()  # downsample | queue | reject
+DOWNSAMPLE_MAX_SIDE = int(os.getenv("DOWNSAMPLE_MAX_SIDE", "2048"))
+
+# Per-request profiles (see profiling.py)
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(BACKEND_DIR, "profiles"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+# tracemalloc is process-wide: while a profiled request runs, every allocation in the worker is traced
+PROFILE_MEMORY = os.getenv("PROFILE_MEMORY", "true").lower() == "true"
+
+# Shadow evaluation of a candidate registry version (see shadow.py)
+SHADOW_MODEL_VERSION = os.getenv("SHADOW_MODEL_VERSION")
+SHADOW_SAMPLE_RATE = float(os.getenv("SHADOW_SAMPLE_RATE", "0"))
+SHADOW_THRESHOLD = float(os.getenv("SHADOW_THRESHOLD", "0.5"))
+SHADOW_MAX_PENDING = int(os.getenv("SHADOW_MAX_PENDING", "32"))
+SHADOW_NICE = int(os.getenv("SHADOW_NICE", "10"))
+SHADOW_DB_PATH = os.getenv("SHADOW_DB_PATH") or os.path.join(BACKEND_DIR, "shadow_eval.sqlite3")
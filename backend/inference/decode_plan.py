@@ -0,0 +1,102 @@
+"""
+Decode cost estimates read from image headers alone, and the reduction the
+memory budget asks for. The API plans every upload with these before
+decoding it, and derivatives.py builds cached model inputs with the same
+plan, so a cached tensor matches what a live request would have computed.
+"""
+import numpy as np
+from PIL import Image
+
+from .config import DOWNSAMPLE_MAX_SIDE, INFERENCE_MEMORY_BUDGET_MB, MEMORY_OVER_BUDGET
+
+MB = 1024 * 1024
+
+
+def _bytes_per_pixel(mode: str) -> int:
+    if mode in ("I;16", "I;16B", "I;16L"):
+        return 2
+    if mode in ("I", "F"):
+        return 4
+    return Image.getmodebands(mode)
+
+
+def _preprocess_footprint(height: int, width: int, channels: int, stretch: bool) -> int:
+    """Largest working copies preprocess makes at full resolution"""
+    plane = height * width * channels
+    # float32 min-max stretch for non-uint8 input, then the uint8 result and CLAHE output
+    return (plane * 4 if stretch else 0) + 2 * plane
+
+
+class DecodePlan:
+    """What decoding an image will cost, read from its headers only"""
+
+    def __init__(self, kind: str, height: int, width: int, channels: int, frames: int,
+                 sample_bytes: int, raw_bytes: int, estimate: int):
+        self.kind = kind
+        self.height = height
+        self.width = width
+        self.channels = channels
+        self.frames = frames
+        self.sample_bytes = sample_bytes
+        self.raw_bytes = raw_bytes
+        self.estimate = estimate
+        self.scale = 1
+
+    @classmethod
+    def from_header(cls, header: dict, kind: str, raw_bytes: int) -> "DecodePlan":
+        """Plan for a full-resolution decode; `header` is what read_image_header returns"""
+        height, width, channels = header["height"], header["width"], header["channels"]
+        if kind == "dicom":
+            frames, sample_bytes = header["frames"], header["sample_bytes"]
+            decoded = height * width * channels * frames * sample_bytes
+            return cls("dicom", height, width, channels, frames, sample_bytes, raw_bytes,
+                       raw_bytes + decoded + _preprocess_footprint(height, width, channels, True))
+        # PIL's own buffer plus the uint8 numpy copy
+        decoded = height * width * _bytes_per_pixel(header["mode"]) + height * width * channels
+        return cls(kind, height, width, channels, 1, 1, raw_bytes,
+                   raw_bytes + decoded + _preprocess_footprint(height, width, channels, False))
+
+    @property
+    def over_budget(self) -> bool:
+        return self.estimate > INFERENCE_MEMORY_BUDGET_MB * MB
+
+    def fit_budget(self) -> bool:
+        """Downsample when the budget policy would for this image; True if it did"""
+        if not self.over_budget or MEMORY_OVER_BUDGET != "downsample":
+            return False
+        self.downsample_to(DOWNSAMPLE_MAX_SIDE, int(INFERENCE_MEMORY_BUDGET_MB * MB))
+        return True
+
+    def downsample_to(self, max_side: int, budget: int):
+        """Pick an integer reduction factor so the longest side and the estimate both fit"""
+        longest = max(self.height, self.width)
+        scale = max(1, int(np.ceil(longest / max_side)))
+        estimate = self.estimate
+        while scale < longest:
+            h, w = self.height // scale, self.width // scale
+            # Decoders still materialise the full frame before reducing it
+            estimate = (self.raw_bytes + self._full_decode_bytes() + h * w * self.channels * self.sample_bytes
+                        + _preprocess_footprint(h, w, self.channels, self.kind == "dicom"))
+            if estimate <= budget or scale >= 64:
+                break
+            scale *= 2
+        self.scale = scale
+        self.estimate = estimate
+
+    def _full_decode_bytes(self) -> int:
+        if self.kind == "jpeg":
+            # JPEG draft mode decodes straight to the reduced size
+            return 0
+        return self.height * self.width * self.channels * self.frames * self.sample_bytes
+
+    def header(self) -> dict:
+        """The fields from_header needs, e.g. to re-plan later without the file"""
+        return {"kind": self.kind, "height": self.height, "width": self.width, "channels": self.channels,
+                "frames": self.frames, "sample_bytes": self.sample_bytes, "raw_bytes": self.raw_bytes,
+                "estimate": self.estimate}
+
+    def info(self) -> dict:
+        return {
+            "kind": self.kind, "height": self.height, "width": self.width, "frames": self.frames,
+            "estimated_mb": round(self.estimate / MB, 1), "downsample": self.scale,
+        }
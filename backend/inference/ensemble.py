@@ -0,0 +1,111 @@
+"""Fusing the serving model with extra registry versions (ENSEMBLE_MEMBERS)"""
+import threading
+import time
+
+import numpy as np
+
+from .config import ENSEMBLE_FUSION, ENSEMBLE_MEMBERS, ENSEMBLE_WEIGHTS
+from .model import ModelVersion
+from .processing import sigmoid
+from .registry import get_version, pin_version
+
+_ensemble_executor = None
+_ensemble_executor_lock = threading.Lock()
+
+
+def ensemble_members(primary: ModelVersion) -> list:
+    """
+    Loaded ensemble members other than the primary, paired with their fusion
+    weight and pinned (release() each one). Members are loaded and warmed in the
+    background with the registry (they are preloaded); one that isn't ready yet
+    is left out rather than loaded on the request path.
+    """
+    members = []
+    for idx, name in enumerate(ENSEMBLE_MEMBERS):
+        if name == primary.name:
+            continue
+        member = pin_version(name)
+        if member is None:
+            if get_version(name) is None:
+                print(f"[ensemble] Member {name} not in registry, skipping")
+            continue
+        weight = ENSEMBLE_WEIGHTS[idx + 1] if idx + 1 < len(ENSEMBLE_WEIGHTS) else 1.0
+        members.append((member, weight))
+    return members
+
+
+def run_ensemble(primary: ModelVersion, image_np: np.ndarray, inp: np.ndarray):
+    """
+    Run the primary and every member concurrently and fuse their sigmoid outputs.
+    Members sharing the primary's input spec reuse its tensor; others get one
+    preprocess per distinct spec. Returns (fused_probs, primary_logits, timings_ms).
+    """
+    global _ensemble_executor
+    members = ensemble_members(primary)
+    if not members:
+        logits = primary.run(inp)
+        return sigmoid(logits.reshape(-1)), logits, {}
+
+    def timed_run(model, tensor):
+        start = time.perf_counter()
+        out = model.run(tensor)
+        return out, (time.perf_counter() - start) * 1000
+
+    def member_run(member, tensor):
+        try:
+            return timed_run(member, tensor)
+        finally:
+            member.release()
+
+    futures = []
+    try:
+        with _ensemble_executor_lock:
+            if _ensemble_executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _ensemble_executor = ThreadPoolExecutor(max_workers=max(len(ENSEMBLE_MEMBERS), 1), thread_name_prefix="ensemble")
+
+        tensors = {(primary.input_size, primary.clahe): inp}
+        for member, _ in members:
+            spec = (member.input_size, member.clahe)
+            if spec not in tensors:
+                tensors[spec] = member.preprocess(image_np)
+
+        for member, weight in members:
+            futures.append((member, weight, _ensemble_executor.submit(
+                member_run, member, tensors[(member.input_size, member.clahe)])))
+    finally:
+        # Members whose run was never submitted (preprocess or submit failed) are released here
+        for member, _ in members[len(futures):]:
+            member.release()
+    primary_logits, primary_ms = timed_run(primary, inp)
+
+    primary_weight = ENSEMBLE_WEIGHTS[0] if ENSEMBLE_WEIGHTS else 1.0
+    primary_probs = sigmoid(primary_logits.reshape(-1))
+    stacked = [primary_probs * primary_weight]
+    weights = [np.full(len(primary_probs), primary_weight)]
+    timings = {primary.name: round(primary_ms, 2)}
+    label_index = {label: i for i, label in enumerate(primary.labels)}
+    for member, weight, future in futures:
+        try:
+            logits, ms = future.result()
+        except Exception as e:
+            print(f"[ensemble] Member {member.name} failed: {e}")
+            continue
+        timings[member.name] = round(ms, 2)
+        # Align member outputs to the primary's label order by name
+        probs = np.zeros(len(primary_probs))
+        mask = np.zeros(len(primary_probs))
+        for j, p in enumerate(sigmoid(logits.reshape(-1))):
+            if j < len(member.labels) and member.labels[j] in label_index:
+                i = label_index[member.labels[j]]
+                if i < len(probs):
+                    probs[i] = p
+                    mask[i] = weight
+        stacked.append(probs * mask)
+        weights.append(mask)
+
+    if ENSEMBLE_FUSION == "max":
+        fused = np.max([s / np.where(w > 0, w, 1) for s, w in zip(stacked, weights)], axis=0)
+    else:
+        fused = np.sum(stacked, axis=0) / np.maximum(np.sum(weights, axis=0), 1e-12)
+    return fused, primary_logits, timings
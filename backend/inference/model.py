@@ -0,0 +1,204 @@
+"""A servable model version: loading, warm-up, the forward pass and request draining"""
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from .processing import DEFAULT_LABELS, postprocess, postprocess_batch, preprocess
+from .runtime import (
+    bind_onnx_io,
+    compile_checkpoint,
+    compiled_artifact_path,
+    create_onnx_session,
+    load_torch_checkpoint,
+    resolve_model_variant,
+)
+from .threads import thread_budget
+
+
+class ModelVersion:
+    """
+    One named model in the registry, with the metadata needed to serve it.
+    Tracks in-flight requests so a retired version can be drained before unloading.
+    """
+
+    def __init__(self, name: str, path: str, labels: list = None, input_size=(224, 224),
+                 preprocessing: str = "ImageNet normalization with CLAHE", clahe: bool = True,
+                 variant: str = None, session_threads: int = None):
+        self.name = name
+        self.path = path
+        self.labels = labels or list(DEFAULT_LABELS)
+        self.input_size = (int(input_size[0]), int(input_size[1]))
+        self.preprocessing = preprocessing
+        self.clahe = clahe
+        self.requested_variant = variant
+        self.session_threads = session_threads  # ORT threads for this version's session (None = thread budget)
+        self.variant = None
+        self.active_path = None
+        self.use_onnx = False
+        self.onnx_session = None
+        self.io_bindings = 0
+        self.torch_model = None
+        self.loaded_at = None
+        self.warmed = False
+        self.error = None
+        self._load_lock = threading.Lock()
+        self._bindings = []  # free (binding, input buffer, output buffer) sets
+        self._bindings_lock = threading.Lock()
+        self._inflight = 0
+        self._inflight_cond = threading.Condition()
+
+    @property
+    def loaded(self) -> bool:
+        return self.onnx_session is not None or self.torch_model is not None
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    def load(self):
+        with self._load_lock:
+            if self.loaded:
+                return
+            self.error = None
+            model_path, self.variant = resolve_model_variant(self.path, self.requested_variant)
+            self.active_path = model_path
+            try:
+                if model_path.lower().endswith(".onnx"):
+                    self._load_onnx(model_path)
+                else:
+                    import torch
+                    checkpoint = None
+                    artifact = compiled_artifact_path(model_path)
+                    if artifact and os.path.exists(artifact):
+                        print(f"[inference] Using compiled artifact: {artifact}")
+                    else:
+                        checkpoint = load_torch_checkpoint(model_path)
+                        artifact = compile_checkpoint(checkpoint, artifact)
+
+                    if artifact and artifact.endswith(".onnx"):
+                        self._load_onnx(artifact)
+                    else:
+                        if artifact:
+                            checkpoint = torch.jit.load(artifact, map_location="cpu")
+                            checkpoint.eval()
+                        self.torch_model = checkpoint
+                        self.use_onnx = False
+                    if artifact:
+                        self.active_path = artifact
+                self.loaded_at = datetime.now().isoformat()
+                print(f"[inference] Loaded model {self.name}: {model_path} (onnx={self.use_onnx}, variant={self.variant})")
+            except Exception as e:
+                self.error = str(e)
+                print(f"[inference] Failed to load model {self.name} ({model_path}): {e}")
+
+    def _load_onnx(self, path: str):
+        self.onnx_session = create_onnx_session(path, self.session_threads)
+        # One bound buffer set per inference slot, so concurrent single-image runs don't wait on each other
+        bindings = []
+        for _ in range(max(thread_budget["inference_slots"], 1)):
+            bound = bind_onnx_io(self.onnx_session, self.input_size)
+            if bound[0] is None:
+                break
+            bindings.append(bound)
+        with self._bindings_lock:
+            self._bindings = bindings
+        self.io_bindings = len(bindings)
+        self.use_onnx = True
+
+    def warm_up(self):
+        """Run one dummy batch so the first real request doesn't pay for lazy allocation"""
+        if not self.loaded:
+            return
+        self.run(np.zeros((1, 3, self.input_size[0], self.input_size[1]), dtype=np.float32))
+        self.warmed = True
+
+    def unload(self):
+        with self._load_lock:
+            self.onnx_session = None
+            with self._bindings_lock:
+                self._bindings = []
+            self.io_bindings = 0
+            self.torch_model = None
+            self.warmed = False
+        print(f"[inference] Unloaded model {self.name}")
+
+    def preprocess(self, image_np: np.ndarray) -> np.ndarray:
+        return preprocess(image_np, self.input_size, self.clahe)
+
+    def postprocess(self, logits: np.ndarray):
+        return postprocess(logits, self.labels)
+
+    def postprocess_batch(self, logits: np.ndarray, top_k: int = 5) -> list:
+        return postprocess_batch(logits, self.labels, top_k)
+
+    def run(self, inp: np.ndarray) -> np.ndarray:
+        """Run the model on a preprocessed NCHW tensor (any batch size) and return raw logits"""
+        if self.use_onnx:
+            session = self.onnx_session
+            bound = self._checkout_binding(inp.shape)
+            if bound is not None:
+                binding, input_buffer, output_buffer = bound
+                try:
+                    np.copyto(input_buffer, inp)
+                    session.run_with_iobinding(binding)
+                    return output_buffer.copy()
+                finally:
+                    with self._bindings_lock:
+                        if self.onnx_session is session:
+                            self._bindings.append(bound)
+            # Batches, odd shapes, or every binding busy
+            input_name = session.get_inputs()[0].name
+            return session.run(None, {input_name: inp})[0]
+
+        import torch
+        with torch.inference_mode():
+            tensor = torch.from_numpy(inp).contiguous(memory_format=torch.channels_last)
+            logits_tensor = self.torch_model(tensor)
+            if hasattr(logits_tensor, 'detach'):
+                return logits_tensor.detach().cpu().numpy()
+            return np.array(logits_tensor)
+
+    def _checkout_binding(self, shape):
+        with self._bindings_lock:
+            if self._bindings and self._bindings[-1][1].shape == shape:
+                return self._bindings.pop()
+        return None
+
+    def acquire(self):
+        with self._inflight_cond:
+            self._inflight += 1
+
+    def release(self):
+        with self._inflight_cond:
+            self._inflight -= 1
+            if self._inflight == 0:
+                self._inflight_cond.notify_all()
+
+    def drain(self, timeout: float) -> bool:
+        """Wait until no request is using this version; False if the timeout expired"""
+        with self._inflight_cond:
+            return self._inflight_cond.wait_for(lambda: self._inflight == 0, timeout=timeout)
+
+    def info(self) -> dict:
+        info = {
+            "version": self.name,
+            "loaded": self.loaded,
+            "warmed": self.warmed,
+            "model_type": "onnx" if self.use_onnx else "pytorch",
+            "variant": self.variant,
+            "model_file": os.path.basename(self.active_path or self.path),
+            "io_bindings": self.io_bindings,
+            "labels": self.labels,
+            "num_classes": len(self.labels),
+            "input_size": list(self.input_size),
+            "preprocessing": self.preprocessing,
+            "loaded_at": self.loaded_at,
+            "inflight": self._inflight,
+        }
+        if self.torch_model is not None:
+            info["architecture"] = str(type(self.torch_model).__name__)
+        if self.error:
+            info["error"] = self.error
+        return info
@@ -0,0 +1,200 @@
+"""
+Predictor: the whole pipeline (preprocess, forward pass, ensemble fusion,
+postprocess) behind one object, for single images or batches.
+
+    from inference import Predictor
+
+    predictor = Predictor()                      # follows the registry's serving version
+    predictor.predict(image_np).findings
+    predictor.predict_batch([img_a, img_b, ...])  # one forward pass per batch
+"""
+import os
+import time
+
+import numpy as np
+
+from .config import ENSEMBLE_DEFAULT, ENSEMBLE_FUSION, ENSEMBLE_MEMBERS
+from .ensemble import run_ensemble
+from .model import ModelVersion
+from .processing import postprocess_probs, sigmoid
+from .profiling import stage
+from . import registry
+
+
+class ModelUnavailableError(RuntimeError):
+    """No model is loaded (nothing discovered, or it failed to load)"""
+
+
+class Prediction:
+    """Result for one image"""
+
+    def __init__(self, findings: list, logits: np.ndarray, model: ModelVersion, degraded: bool = False,
+                 ensemble: dict = None, model_ms: float = 0.0, tensor: np.ndarray = None,
+                 probabilities: np.ndarray = None):
+        self.findings = findings
+        self.logits = logits
+        self.model = model
+        self.degraded = degraded
+        self.ensemble = ensemble  # per-member latency when the ensemble ran
+        self.model_ms = model_ms
+        self.tensor = tensor
+        self._probabilities = probabilities
+
+    @property
+    def model_version(self) -> str:
+        return self.model.name
+
+    @property
+    def probabilities(self) -> np.ndarray:
+        """Per-label probabilities (fused ones when the ensemble ran)"""
+        if self._probabilities is None:
+            self._probabilities = sigmoid(np.asarray(self.logits).reshape(-1))
+        return self._probabilities
+
+    def to_dict(self) -> dict:
+        result = {"predictions": self.findings, "model_version": self.model.name}
+        if self.degraded:
+            result["degraded"] = True
+        if self.ensemble:
+            result["ensemble"] = {"members": list(self.ensemble), "fusion": ENSEMBLE_FUSION, "latency_ms": self.ensemble}
+        return result
+
+
+class _Pinned:
+    """Holds one fixed ModelVersion for a request, like registry.ActiveModel does for the serving one"""
+
+    degraded = False
+
+    def __init__(self, model: ModelVersion):
+        self.model = model
+
+    def __enter__(self) -> ModelVersion:
+        if self.model is not None:
+            registry.pin_model(self.model)
+        return self.model
+
+    def __exit__(self, *exc):
+        if self.model is not None:
+            self.model.release()
+        return False
+
+
+class Predictor:
+    """
+    Runs images through a model version. With no version it follows the
+    registry's serving version, so activations and reloads apply immediately.
+    """
+
+    def __init__(self, version: str = None, model: ModelVersion = None):
+        self.version = version
+        self._model = model
+
+    @classmethod
+    def from_path(cls, path: str, name: str = None, **kwargs) -> "Predictor":
+        """A predictor for a model file outside the registry; kwargs go to ModelVersion"""
+        model = ModelVersion(name or os.path.splitext(os.path.basename(path))[0], path, **kwargs)
+        model.load()
+        if not model.loaded:
+            raise ModelUnavailableError(f"Model {model.name} failed to load: {model.error}")
+        model.warm_up()
+        return cls(model=model)
+
+    @property
+    def model(self) -> ModelVersion:
+        """The version a request would run on right now"""
+        if self._model is not None:
+            return self._model
+        if self.version is None:
+            return registry.get_active_model()
+        registry.load_model_if_needed()
+        model = registry.get_version(self.version)
+        if model is not None and not model.loaded:
+            model.load()
+        return model
+
+    def _pin(self, fallback_version: str = None):
+        if self._model is None and self.version is None:
+            return registry.ActiveModel(fallback_version)
+        return _Pinned(self.model)
+
+    def predict(self, image: np.ndarray, ensemble: bool = None, fallback_version: str = None,
+                checkpoint=None) -> Prediction:
+        """
+        Score one decoded image. `fallback_version` is served instead of the
+        active version when it is loaded (load shedding; the ensemble is skipped
+        then). `checkpoint(stage)` is called before preprocess and inference
+        and may raise to abandon the request.
+        """
+        print(f"[inference] Starting inference for image shape: {image.shape}")
+        pinned = self._pin(fallback_version)
+        with pinned as model:
+            if model is None or not model.loaded:
+                print("[inference] No model available")
+                raise ModelUnavailableError("Model not available on server")
+
+            print(f"[inference] Model {model.name} loaded, using ONNX: {model.use_onnx}")
+            if checkpoint is not None:
+                checkpoint("preprocess")
+            with stage("preprocess"):
+                inp = model.preprocess(image)
+            print(f"[inference] Preprocessed input shape: {inp.shape}")
+            if checkpoint is not None:
+                checkpoint("inference")
+
+            # Ensembles are the opposite of shedding load
+            use_ensemble = (ENSEMBLE_DEFAULT if ensemble is None else ensemble) and not pinned.degraded
+            timings, probs = None, None
+            start = time.perf_counter()
+            if use_ensemble and ENSEMBLE_MEMBERS:
+                with stage("ensemble"):
+                    probs, logits, timings = run_ensemble(model, image, inp)
+                model_ms = timings.get(model.name, (time.perf_counter() - start) * 1000)
+                with stage("postprocess"):
+                    findings = postprocess_probs(probs, model.labels)
+            else:
+                with stage("inference"):
+                    logits = model.run(inp)
+                model_ms = (time.perf_counter() - start) * 1000
+                with stage("postprocess"):
+                    findings = model.postprocess(logits)
+            print(f"[inference] Model output shape: {logits.shape} (io_bindings={model.io_bindings})")
+        print(f"[inference] Postprocessed predictions: {findings}")
+        return Prediction(findings, logits, model, degraded=pinned.degraded, ensemble=timings,
+                          model_ms=model_ms, tensor=inp, probabilities=probs)
+
+    def _score(self, model: ModelVersion, batch: np.ndarray, top_k: int) -> list:
+        start = time.perf_counter()
+        with stage("inference"):
+            logits = model.run(np.ascontiguousarray(batch, dtype=np.float32))
+        per_image_ms = (time.perf_counter() - start) * 1000 / max(len(batch), 1)
+        logits = logits.reshape(len(batch), -1)
+        with stage("postprocess"):
+            probs = sigmoid(logits)
+            findings = model.postprocess_batch(logits, top_k)
+        return [
+            Prediction(findings[i], logits[i], model, model_ms=per_image_ms, tensor=batch[i:i + 1], probabilities=probs[i])
+            for i in range(len(batch))
+        ]
+
+    def predict_tensors(self, batch: np.ndarray, top_k: int = 5) -> list:
+        """Score an already preprocessed (N, 3, H, W) batch in one forward pass"""
+        with self._pin() as model:
+            if model is None or not model.loaded:
+                raise ModelUnavailableError("Model not available on server")
+            return self._score(model, batch, top_k)
+
+    def predict_batch(self, images: list, batch_size: int = 16, top_k: int = 5) -> list:
+        """
+        Score decoded images in batches of `batch_size`: one forward pass and one
+        vectorised postprocess per batch. The ensemble and load shedding are
+        single-request features and don't apply here.
+        """
+        results = []
+        with self._pin() as model:
+            if model is None or not model.loaded:
+                raise ModelUnavailableError("Model not available on server")
+            for offset in range(0, len(images), batch_size):
+                with stage("preprocess"):
+                    batch = np.concatenate([model.preprocess(image) for image in images[offset:offset + batch_size]], axis=0)
+                results.extend(self._score(model, batch, top_k))
+        return results
@@ -0,0 +1,314 @@
+"""
+Image handling shared by the API and offline tools: format sniffing, decoding,
+preprocessing to the model's input tensor and turning logits into findings.
+"""
+import io
+
+import numpy as np
+from PIL import Image
+
+from .profiling import stage
+
+SNIFF_BYTES = 132  # DICOM puts "DICM" after a 128-byte preamble
+NORMAL_LABEL = "Normal - No significant findings detected"
+
+_IMAGE_MAGIC = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+    (b"BM", "bmp"),
+)
+
+
+class ImageDecodeError(ValueError):
+    """The file is not a readable image"""
+
+
+class UnsupportedImageError(ImageDecodeError):
+    """The format is recognised but this server can't decode it (e.g. pydicom missing)"""
+
+
+def sniff_format(head: bytes, filename: str = None):
+    """Identify an image from its first bytes; None when it isn't one we decode"""
+    head = bytes(head[:SNIFF_BYTES])
+    if head[128:132] == b"DICM":
+        return "dicom"
+    for magic, kind in _IMAGE_MAGIC:
+        if head.startswith(magic):
+            return kind
+    # DICOM written without the preamble starts directly with a group 0002 or 0008 tag
+    if filename and filename.lower().endswith(".dcm") and head[:2] in (b"\x02\x00", b"\x08\x00"):
+        return "dicom"
+    return None
+
+
+def _as_file(source):
+    if hasattr(source, "read"):
+        source.seek(0)
+        return source
+    return io.BytesIO(source)
+
+
+def read_image_header(source, kind: str) -> dict:
+    """Dimensions and sample layout of an image from its header, without decoding any pixels"""
+    if kind == "dicom":
+        import pydicom
+        ds = pydicom.dcmread(_as_file(source), stop_before_pixels=True, force=True)
+        return {
+            "height": int(ds.Rows),
+            "width": int(ds.Columns),
+            "channels": int(getattr(ds, "SamplesPerPixel", 1)),
+            "frames": int(getattr(ds, "NumberOfFrames", 1) or 1),
+            "sample_bytes": max(int(getattr(ds, "BitsAllocated", 16)) // 8, 1),
+            "mode": None,
+        }
+    img = Image.open(_as_file(source))  # lazy: reads the header only
+    width, height = img.size
+    return {"height": height, "width": width, "channels": 1 if img.mode == "L" else 3,
+            "frames": 1, "sample_bytes": 1, "mode": img.mode}
+
+
+def _first_frame(ds) -> np.ndarray:
+    """Frame 0 of a multi-frame dataset; pydicom 3 decodes just that frame"""
+    try:
+        from pydicom.pixels import pixel_array
+    except ImportError:
+        return ds.pixel_array[0]
+    return pixel_array(ds, index=0)
+
+
+def decode_image(source, kind: str, scale: int = 1) -> np.ndarray:
+    """
+    Decode a DICOM or raster image (bytes or a seekable file object) into a numpy
+    array, reduced by an integer `scale`. Multi-frame DICOMs yield their first frame.
+    Grayscale rasters stay 2-D uint8; DICOM keeps its native integer dtype.
+    """
+    with stage("decode"):
+        if kind == "dicom":
+            try:
+                import pydicom
+            except Exception as e:
+                print(f"[AI] DICOM import error: {e}")
+                raise UnsupportedImageError("DICOM not supported on server (install pydicom)")
+        try:
+            if kind == "dicom":
+                ds = pydicom.dcmread(_as_file(source), force=True)
+                if int(getattr(ds, "NumberOfFrames", 1) or 1) > 1:
+                    pixels = _first_frame(ds)
+                else:
+                    pixels = ds.pixel_array
+                if scale > 1:
+                    pixels = pixels[::scale, ::scale]
+                # uint8 DICOMs keep getting the min-max stretch preprocess gives non-uint8 input
+                image_np = np.ascontiguousarray(pixels, dtype=np.uint16 if pixels.dtype == np.uint8 else None)
+                del pixels, ds
+                print(f"[AI] DICOM loaded, shape: {image_np.shape}")
+            else:
+                img = Image.open(_as_file(source))
+                mode = 'L' if img.mode == 'L' else 'RGB'
+                if scale > 1:
+                    target = (max(img.size[0] // scale, 1), max(img.size[1] // scale, 1))
+                    img.draft(mode, target)  # JPEG decodes directly at 1/2, 1/4 or 1/8 scale
+                    img = img.convert(mode)
+                    if img.size[0] > target[0]:
+                        img = img.reduce(max(img.size[0] // target[0], 1))
+                else:
+                    img = img.convert(mode)
+                image_np = np.array(img)
+                del img
+                print(f"[AI] Image loaded, shape: {image_np.shape}")
+            return image_np
+        except Exception as e:
+            print(f"[AI] Image loading error: {e}")
+            raise ImageDecodeError(f"Invalid image file: {str(e)}") from e
+
+
+def sigmoid(x: np.ndarray) -> np.ndarray:
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def preprocess(image_np: np.ndarray, input_size=(224, 224), clahe: bool = True) -> np.ndarray:
+    # Resize to the model's input size, normalize to ImageNet stats; adjust per your training
+    try:
+        import cv2
+    except Exception:
+        raise RuntimeError("OpenCV not installed on server")
+    
+    # Grayscale stays a single plane through CLAHE and resize; the 3-channel
+    # copy is only made at model resolution. The caller's array is never modified.
+    img = image_np
+    if img.ndim == 3 and img.shape[2] == 1:
+        img = img[:, :, 0]
+    
+    # Apply CLAHE (Contrast Limited Adaptive Histogram Equalization) for medical images
+    if img.dtype != np.uint8:
+        # Convert to uint8 for CLAHE, using one float32 scratch buffer instead of float64 temporaries
+        lo, hi = float(img.min()), float(img.max())
+        scratch = img.astype(np.float32)
+        scratch -= lo
+        scratch /= (hi - lo) if hi > lo else 1.0
+        scratch *= 255
+        img_uint8 = scratch.astype(np.uint8)
+        del scratch
+    elif clahe:
+        img_uint8 = img.copy()  # CLAHE below writes in place
+    else:
+        img_uint8 = img
+    
+    # Apply CLAHE to improve contrast
+    if clahe:
+        clahe_op = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+        if img_uint8.ndim == 3:
+            # Apply to each channel
+            for i in range(3):
+                img_uint8[:,:,i] = clahe_op.apply(img_uint8[:,:,i])
+        else:
+            img_uint8 = clahe_op.apply(img_uint8)
+    
+    # Resize (cv2 takes width, height)
+    img = cv2.resize(img_uint8, (input_size[1], input_size[0]))
+    if img.ndim == 2:
+        img = np.stack([img, img, img], axis=-1)
+    
+    # Convert to float and normalize
+    img = img.astype(np.float32) / 255.0
+    
+    # ImageNet normalization (standard for pretrained models)
+    mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+    std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+    img = (img - mean) / std
+    
+    img = np.transpose(img, (2, 0, 1))  # CHW
+    img = np.expand_dims(img, 0)        # NCHW
+    
+    return np.ascontiguousarray(img)
+
+
+# Fixed: Position 10 (was "Emphysema") is actually "No Finding"
+DEFAULT_LABELS = [
+    "Atelectasis", "Cardiomegaly", "Effusion", "Infiltration", 
+    "Mass", "Nodule", "Pneumonia", "Consolidation", 
+    "Edema", "Pneumothorax", "No Finding", "Fibrosis", 
+    "Pleural_Thickening", "Hernia"
+]
+
+
+def postprocess(logits: np.ndarray, labels: list = None):
+    default_labels = labels or DEFAULT_LABELS
+    
+    # Now we need to find where "Emphysema" actually is
+    # It might be at position 11 (currently "Fibrosis") or another position
+    
+    # If normal X-rays still show as pathology, try this:
+    # Comment out the above and uncomment this (replaces "Hernia" with "No Finding"):
+    # default_labels = [
+    #     "Atelectasis", "Cardiomegaly", "Effusion", "Infiltration", 
+    #     "Mass", "Nodule", "Pneumonia", "Consolidation", 
+    #     "Edema", "Pneumothorax", "Emphysema", "Fibrosis", 
+    #     "Pleural_Thickening", "No Finding"
+    # ]
+    
+    # If above doesn't work, try these alternatives by uncommenting one of these:
+    
+    # Option A - NIH ChestX-ray14 Standard Order:
+    # default_labels = [
+    #     "Atelectasis", "Cardiomegaly", "Effusion", "Infiltration",
+    #     "Mass", "Nodule", "Pneumonia", "Pneumothorax",
+    #     "Consolidation", "Edema", "Emphysema", "Fibrosis",
+    #     "Pleural_Thickening", "Hernia"
+    # ]
+    
+    # Option B - Alphabetical Order:
+    # default_labels = [
+    #     "Atelectasis", "Cardiomegaly", "Consolidation", "Edema",
+    #     "Effusion", "Emphysema", "Fibrosis", "Hernia",
+    #     "Infiltration", "Mass", "Nodule", "Pleural_Thickening",
+    #     "Pneumonia", "Pneumothorax"
+    # ]
+    
+    # Option C - Alternative Common Order:
+    # default_labels = [
+    #     "Pneumonia", "Pneumothorax", "Consolidation", "Edema",
+    #     "Atelectasis", "Cardiomegaly", "Effusion", "Infiltration",
+    #     "Mass", "Nodule", "Emphysema", "Fibrosis",
+    #     "Pleural_Thickening", "Hernia"
+    # ]
+    
+    x = logits.squeeze()
+    # If single value, wrap
+    if x.ndim == 0:
+        x = np.array([x])
+    
+    # Debug: Print raw logits for analysis
+    # Use sigmoid for multi-label classification (common for medical imaging)
+    probs = sigmoid(x)
+    return postprocess_probs(probs, default_labels)
+
+
+def postprocess_probs(probs: np.ndarray, labels: list = None):
+    """Turn per-label sigmoid probabilities into the ranked findings list"""
+    default_labels = labels or DEFAULT_LABELS
+    probs = np.asarray(probs).reshape(1, -1)
+    no_finding = [i for i, label in enumerate(default_labels[:probs.shape[1]]) if "No Finding" in label]
+    if no_finding:
+        pathology = np.delete(probs[0], no_finding)
+        max_pathology_confidence = float(pathology.max()) if pathology.size else 0
+        no_finding_confidence = float(probs[0, no_finding].min())
+        print(f"[DEBUG] No Finding: {no_finding_confidence:.3f}, Max pathology: {max_pathology_confidence:.3f}")
+        if no_finding_confidence > 0.75 and max_pathology_confidence < 0.4:
+            print(f"[INFO] High confidence normal: No Finding ({no_finding_confidence:.3f}) > pathologies ({max_pathology_confidence:.3f})")
+        else:
+            print(f"[INFO] Showing pathology results instead of normal")
+    return postprocess_probs_batch(probs, default_labels)[0]
+
+
+def postprocess_batch(logits: np.ndarray, labels: list = None, top_k: int = 5) -> list:
+    """Findings for every row of an (N, C) logit matrix; row i equals postprocess(logits[i])"""
+    logits = np.asarray(logits)
+    logits = logits.reshape(logits.shape[0] if logits.ndim > 1 else 1, -1)
+    return postprocess_probs_batch(sigmoid(logits), labels, top_k)
+
+
+def postprocess_probs_batch(probs: np.ndarray, labels: list = None, top_k: int = 5) -> list:
+    """
+    Vectorised ranking/threshold rules over an (N, C) probability matrix:
+    "Normal" when No Finding > 0.75 and every pathology < 0.4; otherwise
+    pathologies above 0.25, highest first, tagged Low (< 0.4) / High (> 0.7)
+    confidence, at most top_k per row.
+    """
+    default_labels = labels or DEFAULT_LABELS
+    probs = np.asarray(probs)
+    n, c = probs.shape
+    names = [default_labels[i] if i < len(default_labels) else f"Finding_{i}" for i in range(c)]
+    is_no_finding = np.array(["No Finding" in name for name in names], dtype=bool)
+
+    normal = np.zeros(n, dtype=bool)
+    no_finding_conf = np.zeros(n, dtype=probs.dtype)
+    if is_no_finding.any():
+        # With several "No Finding" columns the least confident one decides
+        no_finding_conf = np.where(is_no_finding, probs, np.inf).min(axis=1)
+        max_pathology = np.where(is_no_finding, -np.inf, probs).max(axis=1) if (~is_no_finding).any() else np.zeros(n)
+        normal = (no_finding_conf > 0.75) & (max_pathology < 0.4)
+
+    # Stable descending sort keeps equal confidences in label order
+    order = np.argsort(-probs, axis=1, kind="stable")
+    ranked = np.take_along_axis(probs, order, axis=1)
+    keep = ~is_no_finding[order] & (ranked > 0.25)
+    keep &= np.cumsum(keep, axis=1) <= top_k
+    suffix = np.where(ranked < 0.4, " (Low Confidence)", np.where(ranked > 0.7, " (High Confidence)", ""))
+
+    results = []
+    for i in range(n):
+        if normal[i]:
+            results.append([{"label": NORMAL_LABEL, "confidence": float(no_finding_conf[i])}])
+            continue
+        cols = np.flatnonzero(keep[i])
+        if cols.size == 0:
+            results.append([{"label": NORMAL_LABEL, "confidence": 0.8}])
+            continue
+        results.append([
+            {"label": names[order[i, j]] + suffix[i, j], "confidence": float(ranked[i, j])}
+            for j in cols
+        ])
+    return results
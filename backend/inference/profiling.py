@@ -0,0 +1,183 @@
+"""
+Per-request profiling of the pipeline stages. A request opts in by setting
+`current_profile` to a RequestProfile; each stage is then timed (wall and
+thread CPU) and run under cProfile when the profiler is free. With
+PROFILE_MEMORY on, tracemalloc runs from the request's first stage until its
+profile is saved; it is process-wide, so other requests running in that
+window pay for it too. Unprofiled requests otherwise only pay for one
+ContextVar lookup per stage.
+"""
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from .config import PROFILE_DIR, PROFILE_KEEP, PROFILE_MEMORY
+
+current_profile = contextvars.ContextVar("request_profile", default=None)
+# cProfile (sys.monitoring on 3.12+) allows one active profiler per process, so a
+# stage that finds it taken (another request, or a stage nested in a profiled one)
+# is timed and traced without it rather than waiting
+_profiler_lock = threading.Lock()
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_started = False
+
+
+def trace_memory_acquire():
+    """Start tracemalloc for the first user; refcounted so tracing stops when the last one is done"""
+    global _tracemalloc_users, _tracemalloc_started
+    import tracemalloc
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracemalloc_started = True
+        _tracemalloc_users += 1
+
+
+def trace_memory_release():
+    """Stop tracemalloc after the last user, unless it was already running (e.g. PYTHONTRACEMALLOC)"""
+    global _tracemalloc_users, _tracemalloc_started
+    import tracemalloc
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0 and _tracemalloc_started:
+            tracemalloc.stop()
+            _tracemalloc_started = False
+
+
+class RequestProfile:
+    def __init__(self, endpoint: str, user_id: str, filename: str = None):
+        self.id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.endpoint = endpoint
+        self.user_id = user_id
+        self.filename = filename
+        self.created_at = datetime.now().isoformat()
+        self.stages = []
+        self._started = time.perf_counter()
+        self._stats = None
+        self._stats_lock = threading.Lock()
+        self._tracing = False
+        self._tracing_lock = threading.Lock()
+
+    def _trace_memory(self):
+        """Tracing starts with the request's first stage and stops in save()"""
+        with self._tracing_lock:
+            if PROFILE_MEMORY and not self._tracing:
+                trace_memory_acquire()
+                self._tracing = True
+            return self._tracing
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        import cProfile
+        import tracemalloc
+        tracing = self._trace_memory()
+        profiler = None
+        if _profiler_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:  # another profiling tool is active
+                profiler = None
+                _profiler_lock.release()
+        # tracemalloc's peak is process-wide and never reset here, so a stage only
+        # reports a peak when it raised the high-water mark itself
+        mem_before, peak_before = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            if profiler is not None:
+                profiler.disable()
+                _profiler_lock.release()
+            record = {
+                "stage": name,
+                "wall_ms": round(wall * 1000, 2),
+                "cpu_ms": round(cpu * 1000, 2),
+                "cprofile": profiler is not None,
+            }
+            if tracing:
+                current, peak = tracemalloc.get_traced_memory()
+                record["alloc_net_kb"] = round((current - mem_before) / 1024, 1)
+                record["alloc_peak_kb"] = round((peak - mem_before) / 1024, 1) if peak > peak_before else None
+            self.stages.append(record)
+            if profiler is not None:
+                import pstats
+                with self._stats_lock:
+                    if self._stats is None:
+                        self._stats = pstats.Stats(profiler)
+                    else:
+                        self._stats.add(profiler)
+
+    def _top_allocations(self, limit: int = 10) -> list:
+        """Largest live allocation sites at the end of the request (one snapshot per request)"""
+        import tracemalloc
+        stats = tracemalloc.take_snapshot().statistics("lineno")
+        return [
+            {"site": f"{os.path.basename(s.traceback[0].filename)}:{s.traceback[0].lineno}",
+             "size_kb": round(s.size / 1024, 1), "count": s.count}
+            for s in stats[:limit]
+        ]
+
+    def _top_functions(self, limit: int = 25) -> list:
+        if self._stats is None:
+            return []
+        rows = []
+        for (path, line, func), (calls, _, own, cumulative, _) in self._stats.stats.items():
+            rows.append({
+                "function": f"{os.path.basename(path)}:{line}({func})",
+                "calls": calls,
+                "own_ms": round(own * 1000, 3),
+                "cumulative_ms": round(cumulative * 1000, 3),
+            })
+        rows.sort(key=lambda r: r["cumulative_ms"], reverse=True)
+        return rows[:limit]
+
+    def save(self, status: int = 200) -> dict:
+        """Write <id>.json (summary) and <id>.prof (pstats, e.g. for snakeviz) and prune old ones"""
+        summary = {
+            "id": self.id,
+            "endpoint": self.endpoint,
+            "user_id": self.user_id,
+            "filename": self.filename,
+            "created_at": self.created_at,
+            "status": status,
+            "total_ms": round((time.perf_counter() - self._started) * 1000, 2),
+            "stages": self.stages,
+            "top_functions": self._top_functions(),
+        }
+        with self._tracing_lock:
+            if self._tracing:
+                summary["top_allocations"] = self._top_allocations()
+                trace_memory_release()
+                self._tracing = False
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, f"{self.id}.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+        if self._stats is not None:
+            self._stats.dump_stats(os.path.join(PROFILE_DIR, f"{self.id}.prof"))
+        prune_profiles()
+        print(f"[profile] Saved {self.id}: {summary['total_ms']} ms over {len(self.stages)} stages")
+        return summary
+
+
+def prune_profiles():
+    summaries = sorted(f for f in os.listdir(PROFILE_DIR) if f.endswith(".json"))
+    for name in summaries[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else []:
+        for ext in (".json", ".prof"):
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(PROFILE_DIR, name[:-5] + ext))
+
+
+def stage(name: str):
+    """Time a pipeline stage when the current request is being profiled"""
+    request_profile = current_profile.get()
+    if request_profile is None:
+        return contextlib.nullcontext()
+    return request_profile.stage(name)
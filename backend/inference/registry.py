@@ -0,0 +1,304 @@
+"""
+Model registry: named versions loaded side by side, one of them serving.
+Versions come from models/registry.json, or a single discovered model file.
+"""
+import json
+import os
+import threading
+import time
+
+from .config import (
+    ENSEMBLE_MEMBERS,
+    MODEL_ACTIVE_VERSION,
+    MODEL_DRAIN_TIMEOUT,
+    MODEL_KEEP_RETIRED,
+    MODEL_REGISTRY_PATH,
+    MODEL_REGISTRY_POLL_SECONDS,
+)
+from .model import ModelVersion
+from .runtime import discover_model_path
+
+_model_loaded = False
+_registry = {}
+_active_version = None
+_registry_lock = threading.RLock()
+_registry_mtime = None
+_registry_checked_at = 0.0
+_registry_sync_lock = threading.Lock()  # held while a background sync runs
+_preload = set(ENSEMBLE_MEMBERS)  # versions kept loaded and warm next to the serving one
+
+
+def _version_from_spec(name: str, spec: dict) -> ModelVersion:
+    path = spec["path"]
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(MODEL_REGISTRY_PATH)), path)
+    return ModelVersion(
+        name=name,
+        path=path,
+        labels=spec.get("labels"),
+        input_size=spec.get("input_size", (224, 224)),
+        preprocessing=spec.get("preprocessing", "ImageNet normalization with CLAHE"),
+        clahe=spec.get("clahe", True),
+        variant=spec.get("variant"),
+    )
+
+
+def _read_registry_manifest():
+    """
+    Read models/registry.json:
+        {"active": "v2", "versions": {"v1": {"path": "best_densenet.onnx"},
+                                      "v2": {"path": "densenet_v2.onnx", "labels": [...], "input_size": [224, 224]}}}
+    Returns (versions, active) or (None, None) when there is no manifest.
+    """
+    global _registry_mtime
+    if not os.path.exists(MODEL_REGISTRY_PATH):
+        return None, None
+    with open(MODEL_REGISTRY_PATH) as f:
+        manifest = json.load(f)
+    _registry_mtime = os.path.getmtime(MODEL_REGISTRY_PATH)
+    versions = {name: _version_from_spec(name, spec) for name, spec in manifest.get("versions", {}).items()}
+    return versions, manifest.get("active")
+
+
+def _write_registry_active(name: str):
+    """Persist the active version so other workers and restarts pick it up"""
+    global _registry_mtime
+    if not os.path.exists(MODEL_REGISTRY_PATH):
+        return
+    with open(MODEL_REGISTRY_PATH) as f:
+        manifest = json.load(f)
+    manifest["active"] = name
+    tmp_path = f"{MODEL_REGISTRY_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, MODEL_REGISTRY_PATH)
+    _registry_mtime = os.path.getmtime(MODEL_REGISTRY_PATH)
+
+
+def load_model_if_needed():
+    global _model_loaded, _active_version
+    if _model_loaded:
+        return
+    with _registry_lock:
+        if _model_loaded:
+            return
+        try:
+            versions, active = _read_registry_manifest()
+        except Exception as e:
+            print(f"[inference] Could not read model registry {MODEL_REGISTRY_PATH}: {e}")
+            versions, active = None, None
+        if not versions:
+            model_path = discover_model_path()
+            if not model_path:
+                print("[inference] No model file found. Set MODEL_PATH or place file under backend/models/")
+                _model_loaded = True
+                return
+            name = os.getenv("MODEL_VERSION") or os.path.splitext(os.path.basename(model_path))[0]
+            versions, active = {name: ModelVersion(name, model_path)}, name
+        active = MODEL_ACTIVE_VERSION or active or next(iter(versions))
+        if active not in versions:
+            print(f"[inference] Active version {active} not in registry, using {next(iter(versions))}")
+            active = next(iter(versions))
+        _registry.update(versions)
+        model = _registry[active]
+        model.load()
+        try:
+            model.warm_up()
+        except Exception as e:
+            print(f"[inference] Warm-up failed for {active}: {e}")
+        _active_version = active
+        _model_loaded = True
+        for name in _preload:
+            if name in _registry and name != active:
+                threading.Thread(target=preload_version, args=(name,), daemon=True).start()
+
+
+def preload_version(name: str):
+    """Load and warm a non-serving version in the background (e.g. the load-shedding fallback)"""
+    with _registry_lock:
+        model = _registry.get(name)
+    if model is None:
+        return
+    model.load()
+    try:
+        model.warm_up()
+    except Exception as e:
+        print(f"[inference] Warm-up failed for {name}: {e}")
+
+
+def register_preload(name: str):
+    """Keep `name` loaded and warm next to the serving version (e.g. the load-shedding fallback)"""
+    _preload.add(name)
+    if _model_loaded and name in _registry:
+        threading.Thread(target=preload_version, args=(name,), daemon=True).start()
+
+
+def get_version(name: str) -> ModelVersion:
+    with _registry_lock:
+        return _registry.get(name)
+
+
+def pin_version(name: str) -> ModelVersion:
+    """`name` with one request pinned on it (call release() when done), or None unless it is loaded"""
+    with _registry_lock:
+        model = _registry.get(name)
+        if model is None or not model.loaded:
+            return None
+        model.acquire()
+        return model
+
+
+def list_versions() -> dict:
+    """Snapshot of the registry: version name -> ModelVersion"""
+    with _registry_lock:
+        return dict(_registry)
+
+
+def active_version() -> str:
+    return _active_version
+
+
+def get_active_model() -> ModelVersion:
+    load_model_if_needed()
+    maybe_sync_registry()
+    with _registry_lock:
+        return _registry.get(_active_version)
+
+
+class ActiveModel:
+    """
+    Context manager pinning the serving version for the duration of one request.
+    With a fallback_version that is loaded (e.g. the load-shedding model), that
+    version is served instead and `degraded` is set.
+    """
+
+    def __init__(self, fallback_version: str = None):
+        self.fallback_version = fallback_version
+        self.degraded = False
+
+    def __enter__(self) -> ModelVersion:
+        load_model_if_needed()
+        maybe_sync_registry()
+        with _registry_lock:
+            self.model = _registry.get(_active_version)
+            if self.fallback_version:
+                fallback = _registry.get(self.fallback_version)
+                if fallback is not None and fallback.loaded:
+                    self.model = fallback
+                    self.degraded = True
+            if self.model is not None:
+                self.model.acquire()
+        return self.model
+
+    def __exit__(self, *exc):
+        if self.model is not None:
+            self.model.release()
+        return False
+
+
+def pin_model(model: ModelVersion):
+    """
+    Count a request against `model` under the registry lock, so a concurrent
+    retire can't unload it between lookup and pin; reloads it if that already happened
+    """
+    with _registry_lock:
+        model.acquire()
+    if not model.loaded:
+        model.load()
+
+
+def _retire_model(model: ModelVersion):
+    if not model.drain(MODEL_DRAIN_TIMEOUT):
+        print(f"[inference] {model.name} still has {model.inflight} in-flight requests after {MODEL_DRAIN_TIMEOUT}s")
+        return
+    with _registry_lock:
+        # Preloaded versions stay warm, and a request may have pinned it again since the drain
+        if model.name != _active_version and model.name not in _preload and model.inflight == 0 \
+                and not MODEL_KEEP_RETIRED:
+            model.unload()
+
+
+def switch_model_version(name: str, persist: bool = True) -> ModelVersion:
+    """
+    Load and warm `name`, then atomically make it the serving version.
+    Requests already running keep the version they started with; the old
+    version is drained and unloaded in the background.
+    """
+    global _active_version
+    load_model_if_needed()
+    with _registry_lock:
+        candidate = _registry.get(name)
+        if candidate is None:
+            raise KeyError(name)
+    while True:
+        candidate.load()
+        if not candidate.loaded:
+            raise RuntimeError(f"Model {name} failed to load: {candidate.error}")
+        candidate.warm_up()
+        with _registry_lock:
+            # A retire can unload it while we warm it outside the lock; only a version
+            # that is still warm becomes active, after that it is never retired
+            if candidate.loaded and candidate.warmed:
+                previous = _registry.get(_active_version)
+                _active_version = name
+                break
+        print(f"[inference] {name} was unloaded while warming up, loading it again")
+    if persist:
+        try:
+            _write_registry_active(name)
+        except Exception as e:
+            print(f"[inference] Could not persist active version: {e}")
+    print(f"[inference] Active model switched {previous.name if previous else None} -> {name}")
+
+    if previous is not None and previous is not candidate:
+        threading.Thread(target=_retire_model, args=(previous,), daemon=True).start()
+    return candidate
+
+
+def reload_registry() -> dict:
+    """Re-read the manifest: register new versions and follow its active pointer"""
+    versions, active = _read_registry_manifest()
+    if not versions:
+        return {"added": [], "active": _active_version}
+    added = []
+    with _registry_lock:
+        for name, version in versions.items():
+            current = _registry.get(name)
+            if current is None or (not current.loaded and name != _active_version):
+                _registry[name] = version
+                if current is None:
+                    added.append(name)
+    if active and active != _active_version and active in versions:
+        switch_model_version(active, persist=False)
+    return {"added": added, "active": _active_version}
+
+
+def _sync_registry_worker():
+    try:
+        reload_registry()
+    except Exception as e:
+        print(f"[inference] Registry sync failed: {e}")
+    finally:
+        _registry_sync_lock.release()
+
+
+def maybe_sync_registry():
+    """
+    Cheap mtime poll so every worker process follows a switch made through
+    another worker. The reload itself happens off the request path.
+    """
+    global _registry_checked_at
+    now = time.monotonic()
+    if now - _registry_checked_at < MODEL_REGISTRY_POLL_SECONDS or _registry_sync_lock.locked():
+        return
+    _registry_checked_at = now
+    try:
+        mtime = os.path.getmtime(MODEL_REGISTRY_PATH)
+    except OSError:
+        return
+    if mtime != _registry_mtime and _registry_sync_lock.acquire(blocking=False):
+        try:
+            threading.Thread(target=_sync_registry_worker, daemon=True).start()
+        except Exception:
+            _registry_sync_lock.release()
+            raise
@@ -0,0 +1,260 @@
+"""
+Model files and runtimes: locating the model, ONNX Runtime sessions (with the
+optimised-graph cache and IO binding) and compiling torch checkpoints.
+"""
+import hashlib
+import os
+import platform
+
+import numpy as np
+
+from .config import (
+    COMPILE_FORMAT, COMPILED_MARKER, INFERENCE_MODEL_PATH, INT8_MODEL_PATH, INT8_SUFFIX, MODEL_VARIANT, MODELS_DIR,
+    ORT_CACHE_DIR, ORT_CACHE_ENABLED, ORT_ENABLE_MEM_ARENA, ORT_ENABLE_MEM_PATTERN, ORT_EXECUTION_MODE,
+    ORT_GRAPH_OPT_LEVEL,
+)
+from .threads import thread_budget
+
+
+def discover_model_path() -> str:
+    if INFERENCE_MODEL_PATH and os.path.exists(INFERENCE_MODEL_PATH):
+        return INFERENCE_MODEL_PATH
+    # Try to find a model under ./models
+    candidate_dir = MODELS_DIR
+    if os.path.isdir(candidate_dir):
+        for fname in os.listdir(candidate_dir):
+            lower = fname.lower()
+            if lower.endswith(INT8_SUFFIX) or COMPILED_MARKER in lower:
+                continue
+            if ("best" in lower or "densenet" in lower) and (lower.endswith(".onnx") or lower.endswith(".pt") or lower.endswith(".pth")):
+                return os.path.join(candidate_dir, fname)
+    # Fallback to default names
+    for fallback in [
+        os.path.join(MODELS_DIR, "best densenet.onnx"),
+        os.path.join(MODELS_DIR, "best densenet.pt"),
+        os.path.join(MODELS_DIR, "best_densenet.onnx"),
+        os.path.join(MODELS_DIR, "best_densenet.pt"),
+    ]:
+        if os.path.exists(fallback):
+            return fallback
+    return None
+
+
+def quantized_model_path(model_path: str) -> str:
+    if INT8_MODEL_PATH:
+        return INT8_MODEL_PATH
+    return os.path.splitext(model_path)[0] + INT8_SUFFIX
+
+
+def resolve_model_variant(model_path: str, variant: str = None):
+    """Pick the FP32 or INT8 file to serve according to the version's variant or MODEL_VARIANT"""
+    if (variant or MODEL_VARIANT).lower() != "int8":
+        return model_path, "fp32"
+    quantized = quantized_model_path(model_path)
+    if os.path.exists(quantized):
+        return quantized, "int8"
+    print(f"[inference] int8 variant requested but {quantized} not found; serving fp32 (run quantize_model.py)")
+    return model_path, "fp32"
+
+
+def file_checksum(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def ort_session_options(ort, threads: int = None):
+    """
+    Build SessionOptions from the ORT_* environment settings and the thread budget;
+    `threads` overrides the budget (threads=1 runs entirely on the calling thread)
+    """
+    opts = ort.SessionOptions()
+    intra_op, inter_op = (threads, 1) if threads else (thread_budget["ort_intra_op"], thread_budget["ort_inter_op"])
+    if intra_op > 0:
+        opts.intra_op_num_threads = intra_op
+    if inter_op > 0:
+        opts.inter_op_num_threads = inter_op
+    opts.execution_mode = (
+        ort.ExecutionMode.ORT_PARALLEL if ORT_EXECUTION_MODE == "parallel"
+        else ort.ExecutionMode.ORT_SEQUENTIAL
+    )
+    opt_levels = {
+        "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }
+    opts.graph_optimization_level = opt_levels.get(ORT_GRAPH_OPT_LEVEL, ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+    opts.enable_cpu_mem_arena = ORT_ENABLE_MEM_ARENA
+    opts.enable_mem_pattern = ORT_ENABLE_MEM_PATTERN
+    return opts
+
+
+def ort_cache_path(model_path: str, ort) -> str:
+    # Optimised graphs are only valid for the same model bytes, ORT build, level and CPU arch
+    stem = os.path.splitext(os.path.basename(model_path))[0].replace(" ", "_")
+    key = f"{file_checksum(model_path)[:16]}-ort{ort.__version__}-{ORT_GRAPH_OPT_LEVEL}-{platform.machine()}"
+    return os.path.join(ORT_CACHE_DIR, f"{stem}-{key}.onnx")
+
+
+def create_onnx_session(model_path: str, threads: int = None):
+    """
+    Create an ONNX Runtime session, reusing a previously optimised graph when available.
+    On a cache miss the optimised graph is written next to the other cached graphs
+    so the next process start skips graph optimisation.
+    """
+    import onnxruntime as ort
+    opts = ort_session_options(ort, threads)
+    providers = ["CPUExecutionProvider"]
+    if not ORT_CACHE_ENABLED or ORT_GRAPH_OPT_LEVEL == "disable":
+        return ort.InferenceSession(model_path, sess_options=opts, providers=providers)
+
+    try:
+        cache_path = ort_cache_path(model_path, ort)
+    except OSError as e:
+        print(f"[inference] ORT cache unavailable: {e}")
+        return ort.InferenceSession(model_path, sess_options=opts, providers=providers)
+
+    if os.path.exists(cache_path):
+        try:
+            # Graph is already optimised; don't pay for it again
+            opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            session = ort.InferenceSession(cache_path, sess_options=opts, providers=providers)
+            print(f"[inference] Loaded optimised graph from cache: {cache_path}")
+            return session
+        except Exception as e:
+            print(f"[inference] Cached graph unusable ({e}), rebuilding")
+            opts = ort_session_options(ort, threads)
+
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(ORT_CACHE_DIR, exist_ok=True)
+        opts.optimized_model_filepath = tmp_path
+        session = ort.InferenceSession(model_path, sess_options=opts, providers=providers)
+        os.replace(tmp_path, cache_path)
+        print(f"[inference] Saved optimised graph to cache: {cache_path}")
+        return session
+    except Exception as e:
+        print(f"[inference] Could not write ORT cache: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return ort.InferenceSession(model_path, sess_options=ort_session_options(ort, threads), providers=providers)
+
+
+def bind_onnx_io(session, input_size=(224, 224)):
+    """
+    Pre-allocate input/output buffers and bind them once, so each call only copies
+    the preprocessed tensor in and runs. Returns (binding, input_buffer, output_buffer)
+    or (None, None, None) when the model's signature can't be bound statically.
+    """
+    try:
+        inp_meta = session.get_inputs()[0]
+        out_meta = session.get_outputs()[0]
+        if inp_meta.type != "tensor(float)" or out_meta.type != "tensor(float)":
+            return None, None, None
+        # Dynamic dims (batch etc.) are pinned to a single image of the model's input size
+        default_in = [1, 3, input_size[0], input_size[1]]
+        in_shape = [d if isinstance(d, int) and d > 0 else default_in[i] for i, d in enumerate(inp_meta.shape)]
+        out_shape = [d if isinstance(d, int) and d > 0 else 1 for d in out_meta.shape]
+        if len(out_shape) == 2 and not (isinstance(out_meta.shape[1], int) and out_meta.shape[1] > 0):
+            # Unknown class count; probe once to size the output buffer
+            probe = session.run(None, {inp_meta.name: np.zeros(in_shape, dtype=np.float32)})[0]
+            out_shape = list(probe.shape)
+        input_buffer = np.zeros(in_shape, dtype=np.float32)
+        output_buffer = np.zeros(out_shape, dtype=np.float32)
+        binding = session.io_binding()
+        binding.bind_input(inp_meta.name, "cpu", 0, np.float32, in_shape, input_buffer.ctypes.data)
+        binding.bind_output(out_meta.name, "cpu", 0, np.float32, out_shape, output_buffer.ctypes.data)
+        return binding, input_buffer, output_buffer
+    except Exception as e:
+        print(f"[inference] IO binding unavailable, using session.run: {e}")
+        return None, None, None
+
+
+def load_torch_checkpoint(model_path: str):
+    """Load a TorchScript file or a DenseNet121 state dict as an eval-mode, channels-last module"""
+    import torch
+    # Try torch.jit.load first, then fallback to torch.load
+    try:
+        model = torch.jit.load(model_path, map_location="cpu")
+        model.eval()
+    except Exception as jit_error:
+        print(f"[inference] torch.jit.load failed: {jit_error}, trying torch.load...")
+        # Fallback to regular torch.load for state dict
+        state_dict = torch.load(model_path, map_location="cpu", weights_only=False)
+        # Create model with correct architecture
+        import torchvision.models as models
+        model = models.densenet121(pretrained=False)
+        
+        # Determine the number of classes from the state dict
+        if 'classifier.weight' in state_dict:
+            num_classes = state_dict['classifier.weight'].shape[0]
+            print(f"[inference] Detected {num_classes} classes from model")
+        else:
+            num_classes = 14  # Default fallback
+            print(f"[inference] Using default {num_classes} classes")
+        
+        # Adjust the classifier to match the saved model
+        model.classifier = torch.nn.Linear(model.classifier.in_features, num_classes)
+        model.load_state_dict(state_dict)
+        model.eval()
+    try:
+        model = model.to(memory_format=torch.channels_last)
+    except Exception as e:
+        print(f"[inference] channels_last not applied: {e}")
+    return model
+
+
+def compiled_artifact_path(model_path: str) -> str:
+    """Where the compiled form of a .pt/.pth checkpoint lives, keyed by its hash"""
+    if COMPILE_FORMAT not in ("torchscript", "onnx"):
+        return None
+    ext = ".onnx" if COMPILE_FORMAT == "onnx" else ".pt"
+    stem = os.path.splitext(model_path)[0]
+    return f"{stem}{COMPILED_MARKER}{file_checksum(model_path)[:16]}{ext}"
+
+
+def export_torch_to_onnx(model, onnx_path: str):
+    import inspect
+    import torch
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+    torch.onnx.export(
+        model, torch.randn(1, 3, 224, 224), onnx_path,
+        input_names=["input"], output_names=["logits"],
+        dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=17,
+        **kwargs,
+    )
+
+
+def compile_checkpoint(model, artifact_path: str) -> str:
+    """
+    Convert a loaded checkpoint to a frozen TorchScript or ONNX artifact.
+    Written to a temp file and renamed so concurrent workers never see a partial file.
+    Returns the artifact path, or None if compilation is disabled or failed.
+    """
+    if not artifact_path:
+        return None
+    import torch
+    tmp_path = f"{artifact_path}.{os.getpid()}.tmp"
+    try:
+        if artifact_path.endswith(".onnx"):
+            export_torch_to_onnx(model, tmp_path)
+        else:
+            example = torch.randn(1, 3, 224, 224).contiguous(memory_format=torch.channels_last)
+            with torch.inference_mode():
+                traced = model if isinstance(model, torch.jit.ScriptModule) else torch.jit.trace(model, example)
+            frozen = torch.jit.freeze(traced.eval())
+            torch.jit.save(frozen, tmp_path)
+        os.replace(tmp_path, artifact_path)
+        print(f"[inference] Compiled checkpoint to {artifact_path}")
+        return artifact_path
+    except Exception as e:
+        print(f"[inference] Checkpoint compilation failed, using eager model: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
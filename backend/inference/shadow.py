@@ -0,0 +1,190 @@
+"""
+Shadow evaluation: a sampled fraction of predictions is replayed through a
+candidate registry version (SHADOW_MODEL_VERSION) after the response is sent,
+and the agreement and latency delta land in a local SQLite store.
+
+    if shadow.should_sample(prediction.model_version):
+        shadow.submit(prediction.tensor, prediction.model, prediction.logits, prediction.model_ms)
+
+Jobs carry only the primary's preprocessed tensor, so the candidate must take
+the same input size and preprocessing; samples for one that doesn't are skipped.
+Runs go through one low-priority worker thread and are dropped, not queued,
+past SHADOW_MAX_PENDING.
+"""
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from .config import (
+    SHADOW_DB_PATH,
+    SHADOW_MAX_PENDING,
+    SHADOW_MODEL_VERSION,
+    SHADOW_NICE,
+    SHADOW_SAMPLE_RATE,
+    SHADOW_THRESHOLD,
+)
+from .model import ModelVersion
+from . import registry
+
+_executor = None
+_pending = 0
+_stats = {"scheduled": 0, "completed": 0, "dropped": 0, "skipped": 0, "failed": 0}
+_lock = threading.Lock()
+_db = None
+
+
+def _thread_init():
+    # Linux applies nice values per thread, so only the shadow worker is deprioritised
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), SHADOW_NICE)
+    except (AttributeError, OSError) as e:
+        print(f"[shadow] Could not lower worker priority: {e}")
+
+
+def _store():
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(SHADOW_DB_PATH, check_same_thread=False)
+        _db.execute("""
+            CREATE TABLE IF NOT EXISTS shadow_results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at TEXT NOT NULL,
+                primary_version TEXT NOT NULL,
+                candidate_version TEXT NOT NULL,
+                primary_ms REAL NOT NULL,
+                candidate_ms REAL NOT NULL,
+                top1_agree INTEGER NOT NULL,
+                disagreements TEXT NOT NULL,
+                max_abs_diff REAL NOT NULL
+            )
+        """)
+        _db.commit()
+    return _db
+
+
+def should_sample(primary_version: str) -> bool:
+    if not SHADOW_MODEL_VERSION or SHADOW_SAMPLE_RATE <= 0:
+        return False
+    if SHADOW_MODEL_VERSION == primary_version:
+        return False
+    return random.random() < SHADOW_SAMPLE_RATE
+
+
+def submit(inp, primary: ModelVersion, primary_logits, primary_ms: float):
+    """Queue a shadow run; drops the sample instead of queueing without bound"""
+    global _executor, _pending
+    candidate = registry.get_version(SHADOW_MODEL_VERSION)
+    with _lock:
+        if candidate is not None and (candidate.input_size != primary.input_size or candidate.clahe != primary.clahe):
+            if _stats["skipped"] == 0:
+                print(f"[shadow] {candidate.name} expects different input than {primary.name}; not shadowing it")
+            _stats["skipped"] += 1
+            return
+        if _pending >= SHADOW_MAX_PENDING:
+            _stats["dropped"] += 1
+            return
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shadow", initializer=_thread_init)
+        _pending += 1
+        _stats["scheduled"] += 1
+    _executor.submit(_run, inp, primary.name, primary.labels, primary.input_size, primary.clahe,
+                     primary_logits, primary_ms)
+
+
+def _run(inp, primary_version, primary_labels, input_size, clahe, primary_logits, primary_ms):
+    global _pending
+    try:
+        registry.load_model_if_needed()
+        candidate = registry.get_version(SHADOW_MODEL_VERSION)
+        if candidate is None:
+            raise KeyError(f"Shadow version {SHADOW_MODEL_VERSION} not in registry")
+        if candidate.input_size != input_size or candidate.clahe != clahe:
+            raise ValueError(f"Shadow version {candidate.name} expects different input than {primary_version}")
+        candidate.load()
+        candidate = registry.pin_version(SHADOW_MODEL_VERSION)
+        if candidate is None:
+            raise RuntimeError(f"Shadow version failed to load: {registry.get_version(SHADOW_MODEL_VERSION).error}")
+
+        try:
+            start = time.perf_counter()
+            candidate_logits = candidate.run(inp)
+            candidate_ms = (time.perf_counter() - start) * 1000
+        finally:
+            candidate.release()
+
+        primary_probs = dict(zip(primary_labels, 1.0 / (1.0 + np.exp(-primary_logits.reshape(-1)))))
+        candidate_probs = dict(zip(candidate.labels, 1.0 / (1.0 + np.exp(-candidate_logits.reshape(-1)))))
+        shared = [label for label in primary_labels if label in candidate_probs]
+        disagreements = [
+            label for label in shared
+            if (primary_probs[label] > SHADOW_THRESHOLD) != (candidate_probs[label] > SHADOW_THRESHOLD)
+        ]
+        max_abs_diff = max((abs(float(primary_probs[l] - candidate_probs[l])) for l in shared), default=0.0)
+        top1_agree = bool(shared) and max(shared, key=primary_probs.get) == max(shared, key=candidate_probs.get)
+
+        with _lock:
+            db = _store()
+            db.execute(
+                "INSERT INTO shadow_results (created_at, primary_version, candidate_version, primary_ms, candidate_ms, "
+                "top1_agree, disagreements, max_abs_diff) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (datetime.now().isoformat(), primary_version, candidate.name, primary_ms, candidate_ms,
+                 int(top1_agree), json.dumps(disagreements), max_abs_diff),
+            )
+            db.commit()
+            _stats["completed"] += 1
+    except Exception as e:
+        print(f"[shadow] Shadow run failed: {e}")
+        with _lock:
+            _stats["failed"] += 1
+    finally:
+        with _lock:
+            _pending -= 1
+
+
+def summary(candidate_version: str = None, limit: int = 1000) -> dict:
+    """Agreement and latency delta over the last `limit` runs of a candidate (default SHADOW_MODEL_VERSION)"""
+    candidate_version = candidate_version or SHADOW_MODEL_VERSION
+    with _lock:
+        stats = dict(_stats, pending=_pending)
+        rows = []
+        if os.path.exists(SHADOW_DB_PATH):
+            rows = _store().execute(
+                "SELECT primary_ms, candidate_ms, top1_agree, disagreements, max_abs_diff FROM shadow_results "
+                "WHERE candidate_version = ? ORDER BY id DESC LIMIT ?",
+                (candidate_version, limit),
+            ).fetchall()
+    result = {
+        "candidate_version": candidate_version,
+        "sample_rate": SHADOW_SAMPLE_RATE,
+        "threshold": SHADOW_THRESHOLD,
+        "counters": stats,
+        "samples": len(rows),
+    }
+    if not rows:
+        return result
+    deltas = np.array([r[1] - r[0] for r in rows])
+    label_counts = {}
+    for r in rows:
+        for label in json.loads(r[3]):
+            label_counts[label] = label_counts.get(label, 0) + 1
+    result.update({
+        "top1_agreement": round(float(np.mean([r[2] for r in rows])), 4),
+        "mean_max_abs_diff": round(float(np.mean([r[4] for r in rows])), 4),
+        "latency_delta_ms": {
+            "mean": round(float(deltas.mean()), 2),
+            "p50": round(float(np.percentile(deltas, 50)), 2),
+            "p95": round(float(np.percentile(deltas, 95)), 2),
+        },
+        "disagreement_rate": {
+            label: round(count / len(rows), 4)
+            for label, count in sorted(label_counts.items(), key=lambda kv: kv[1], reverse=True)
+        },
+    })
+    return result
@@ -0,0 +1,95 @@
+"""CPU thread budget shared by OpenCV, ONNX Runtime and torch (policy in config.py)"""
+import os
+
+import cv2
+import torch
+
+from .config import THREAD_POLICY, WEB_CONCURRENCY
+
+
+def _available_cores() -> int:
+    """Cores this process may use: CPU affinity, capped by a cgroup v2 quota, or THREAD_BUDGET_CORES"""
+    if os.getenv("THREAD_BUDGET_CORES"):
+        return max(int(os.getenv("THREAD_BUDGET_CORES")), 1)
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            cores = min(cores, max(int(int(quota) / int(period)), 1))
+    except (OSError, ValueError):
+        pass
+    return cores
+
+
+def _env_threads(name: str) -> int:
+    return int(os.getenv(name, "0") or 0)
+
+
+def plan_thread_budget() -> dict:
+    cores = _available_cores()
+    per_worker = max(cores // max(WEB_CONCURRENCY, 1), 1)
+    # With the policy off every library uses all cores per run, so one slot per worker
+    default_slots = {
+        "throughput": per_worker,
+        "latency": 1,
+        "off": 1,
+    }.get(THREAD_POLICY, max(per_worker // 2, 1))
+    slots = _env_threads("INFERENCE_CONCURRENCY") or default_slots
+    per_slot = max(per_worker // slots, 1)
+    managed = THREAD_POLICY != "off"
+    return {
+        "policy": THREAD_POLICY,
+        "cores": cores,
+        "workers": WEB_CONCURRENCY,
+        "cores_per_worker": per_worker,
+        "inference_slots": slots,
+        # 0 = library default; explicit env settings always win
+        "cv2": _env_threads("CV2_THREADS") or (per_slot if managed else 0),
+        "ort_intra_op": _env_threads("ORT_INTRA_OP_THREADS") or (per_slot if managed else 0),
+        "ort_inter_op": _env_threads("ORT_INTER_OP_THREADS") or (1 if managed else 0),
+        "torch_intra_op": _env_threads("TORCH_THREADS") or (per_slot if managed else 0),
+        "torch_inter_op": _env_threads("TORCH_INTEROP_THREADS") or (1 if managed else 0),
+    }
+
+
+def apply_thread_budget(budget: dict = None):
+    """
+    Size the OpenCV and torch pools; ORT picks its share up in runtime.ort_session_options.
+    Process-wide, so only entry points (the API, the CLIs) call it, before any model loads.
+    """
+    budget = budget or thread_budget
+    if budget["cv2"] > 0:
+        cv2.setNumThreads(budget["cv2"])
+    if budget["torch_intra_op"] > 0:
+        torch.set_num_threads(budget["torch_intra_op"])
+    if budget["torch_inter_op"] > 0:
+        try:
+            torch.set_num_interop_threads(budget["torch_inter_op"])
+        except RuntimeError as e:
+            # Only settable before torch starts any inter-op work
+            print(f"[inference] Could not set torch inter-op threads: {e}")
+    print(f"[inference] Thread budget ({budget['policy']}): {budget['cores']} cores, "
+          f"{budget['workers']} workers x {budget['inference_slots']} slots, "
+          f"cv2={budget['cv2']} ort={budget['ort_intra_op']}/{budget['ort_inter_op']} "
+          f"torch={budget['torch_intra_op']}/{budget['torch_inter_op']}")
+
+
+thread_budget = plan_thread_budget()
+
+
+def effective_threads(model=None) -> dict:
+    """What each library is actually running with, read back from the libraries"""
+    effective = {
+        "cv2": cv2.getNumThreads(),
+        "torch_intra_op": torch.get_num_threads(),
+        "torch_inter_op": torch.get_num_interop_threads(),
+    }
+    if model is not None and model.onnx_session is not None:
+        opts = model.onnx_session.get_session_options()
+        effective["ort_intra_op"] = opts.intra_op_num_threads
+        effective["ort_inter_op"] = opts.inter_op_num_threads
+    return effective
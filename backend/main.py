@@ -1,19 +1,21 @@
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Query
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Query, Body, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.concurrency import run_in_threadpool
 from supabase import create_client, Client
+import asyncio
 import os
 from dotenv import load_dotenv
 from typing import Optional, List
 import json
 from datetime import datetime
 import uuid
-import io
-from PIL import Image
 import numpy as np
-import cv2
-import torch
 import base64
+import threading
+import contextlib
+import re
 
 # Load environment variables
 load_dotenv()
@@ -38,272 +40,67 @@ supabase: Client = create_client(supabase_url, supabase_key)
 security = HTTPBearer()
 
 # ---------------- Inference Model (best densenet) ----------------
-INFERENCE_MODEL_PATH = os.getenv("MODEL_PATH")
-_model_loaded = False
-_use_onnx = False
-_onnx_session = None
-_torch_model = None
-
-def _discover_model_path() -> str:
-    if INFERENCE_MODEL_PATH and os.path.exists(INFERENCE_MODEL_PATH):
-        return INFERENCE_MODEL_PATH
-    # Try to find a model under ./models
-    candidate_dir = os.path.join(os.path.dirname(__file__), "models")
-    if os.path.isdir(candidate_dir):
-        for fname in os.listdir(candidate_dir):
-            lower = fname.lower()
-            if ("best" in lower or "densenet" in lower) and (lower.endswith(".onnx") or lower.endswith(".pt") or lower.endswith(".pth")):
-                return os.path.join(candidate_dir, fname)
-    # Fallback to default names
-    for fallback in [
-        os.path.join(os.path.dirname(__file__), "models", "best densenet.onnx"),
-        os.path.join(os.path.dirname(__file__), "models", "best densenet.pt"),
-        os.path.join(os.path.dirname(__file__), "models", "best_densenet.onnx"),
-        os.path.join(os.path.dirname(__file__), "models", "best_densenet.pt"),
-    ]:
-        if os.path.exists(fallback):
-            return fallback
-    return None
-
-def _load_model_if_needed():
-    global _model_loaded, _use_onnx, _onnx_session, _torch_model
-    if _model_loaded:
-        return
-    model_path = _discover_model_path()
-    if not model_path:
-        print("[inference] No model file found. Set MODEL_PATH or place file under backend/models/")
-        _model_loaded = True
-        return
-    try:
-        if model_path.lower().endswith(".onnx"):
-            import onnxruntime as ort
-            _onnx_session = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
-            _use_onnx = True
-        else:
-            import torch
-            # Try torch.jit.load first, then fallback to torch.load
-            try:
-                _torch_model = torch.jit.load(model_path, map_location="cpu")
-                _torch_model.eval()
-            except Exception as jit_error:
-                print(f"[inference] torch.jit.load failed: {jit_error}, trying torch.load...")
-                # Fallback to regular torch.load for state dict
-                state_dict = torch.load(model_path, map_location="cpu", weights_only=False)
-                # Create model with correct architecture
-                import torchvision.models as models
-                _torch_model = models.densenet121(pretrained=False)
-                
-                # Determine the number of classes from the state dict
-                if 'classifier.weight' in state_dict:
-                    num_classes = state_dict['classifier.weight'].shape[0]
-                    print(f"[inference] Detected {num_classes} classes from model")
-                else:
-                    num_classes = 14  # Default fallback
-                    print(f"[inference] Using default {num_classes} classes")
-                
-                # Adjust the classifier to match the saved model
-                _torch_model.classifier = torch.nn.Linear(_torch_model.classifier.in_features, num_classes)
-                _torch_model.load_state_dict(state_dict)
-                _torch_model.eval()
-            _use_onnx = False
-        print(f"[inference] Loaded model: {model_path} (onnx={_use_onnx})")
-    except Exception as e:
-        print(f"[inference] Failed to load model {model_path}: {e}")
-    finally:
-        _model_loaded = True
+# Model loading, the registry, pre/postprocessing and the thread budget live in
+# the `inference` package, shared with bulk_score.py and quantize_model.py.
+from inference import (
+    NORMAL_LABEL,
+    ModelUnavailableError,
+    Predictor,
+    apply_thread_budget,
+    effective_threads,
+    profiling,
+    registry,
+    shadow,
+    thread_budget,
+)
+from inference.config import PROFILE_DIR
+from storage import ImageCache, ObjectNotFound, StorageError, bucket_from_env
+from admission import RequestDeadline, admission, deadline_scope, degradation
+from uploads import MemoryLedger, UploadBuffer, UploadLimitMiddleware, decoded_upload, memory_budget, sniffed_upload
+from derivatives import DerivativeStore
+from backfill import BackfillJob
+from audit import AuditLog
+from diagnosis_events import EVENT_HEARTBEAT_S, EVENT_RETRY_MS, events, publish_diagnosis
+from idempotency import IDEMPOTENCY_KEY_PATTERN, IdempotencyKeys
+from exports import DIAGNOSIS_STATUSES, PROFILE_ROLES, choices_param, stream_export, timestamp_param
+from profiles import PROFILE_RESOLVE_MAX_IDS, UUID_PATTERN, ProfileCache
+from ask_ai import (
+    ASK_AI_MAX_CONTEXT_CHARS,
+    ASK_AI_MAX_QUESTION_CHARS,
+    AskAIUnavailableError,
+    answer_chunks,
+    close_shared_service,
+    service_stats,
+    shared_service,
+    sse_event,
+)
 
-def _preprocess(image_np: np.ndarray) -> np.ndarray:
-    # Resize to 224, normalize to ImageNet stats; adjust per your training
-    try:
-        import cv2
-    except Exception:
-        raise HTTPException(status_code=500, detail="OpenCV not installed on server")
-    
-    img = image_np.copy()
-    
-    # Handle different image types
-    if img.ndim == 2:
-        # Grayscale medical image
-        img = np.stack([img, img, img], axis=-1)
-    elif img.ndim == 3 and img.shape[2] == 1:
-        # Single channel
-        img = np.repeat(img, 3, axis=2)
-    
-    # Apply CLAHE (Contrast Limited Adaptive Histogram Equalization) for medical images
-    if img.dtype != np.uint8:
-        # Convert to uint8 for CLAHE
-        img_uint8 = ((img - img.min()) / (img.max() - img.min()) * 255).astype(np.uint8)
-    else:
-        img_uint8 = img.copy()
-    
-    # Apply CLAHE to improve contrast
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-    if len(img_uint8.shape) == 3:
-        # Apply to each channel
-        for i in range(3):
-            img_uint8[:,:,i] = clahe.apply(img_uint8[:,:,i])
-    else:
-        img_uint8 = clahe.apply(img_uint8)
-    
-    # Resize
-    img = cv2.resize(img_uint8, (224, 224))
-    
-    # Convert to float and normalize
-    img = img.astype(np.float32) / 255.0
-    
-    # ImageNet normalization (standard for pretrained models)
-    mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
-    std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
-    img = (img - mean) / std
-    
-    img = np.transpose(img, (2, 0, 1))  # CHW
-    img = np.expand_dims(img, 0)        # NCHW
-    
-    return img
-
-def _postprocess(logits: np.ndarray):
-    # Fixed: Position 10 (was "Emphysema") is actually "No Finding"
-    default_labels = [
-        "Atelectasis", "Cardiomegaly", "Effusion", "Infiltration", 
-        "Mass", "Nodule", "Pneumonia", "Consolidation", 
-        "Edema", "Pneumothorax", "No Finding", "Fibrosis", 
-        "Pleural_Thickening", "Hernia"
-    ]
-    
-    # Now we need to find where "Emphysema" actually is
-    # It might be at position 11 (currently "Fibrosis") or another position
-    
-    # If normal X-rays still show as pathology, try this:
-    # Comment out the above and uncomment this (replaces "Hernia" with "No Finding"):
-    # default_labels = [
-    #     "Atelectasis", "Cardiomegaly", "Effusion", "Infiltration", 
-    #     "Mass", "Nodule", "Pneumonia", "Consolidation", 
-    #     "Edema", "Pneumothorax", "Emphysema", "Fibrosis", 
-    #     "Pleural_Thickening", "No Finding"
-    # ]
-    
-    # If above doesn't work, try these alternatives by uncommenting one of these:
-    
-    # Option A - NIH ChestX-ray14 Standard Order:
-    # default_labels = [
-    #     "Atelectasis", "Cardiomegaly", "Effusion", "Infiltration",
-    #     "Mass", "Nodule", "Pneumonia", "Pneumothorax",
-    #     "Consolidation", "Edema", "Emphysema", "Fibrosis",
-    #     "Pleural_Thickening", "Hernia"
-    # ]
-    
-    # Option B - Alphabetical Order:
-    # default_labels = [
-    #     "Atelectasis", "Cardiomegaly", "Consolidation", "Edema",
-    #     "Effusion", "Emphysema", "Fibrosis", "Hernia",
-    #     "Infiltration", "Mass", "Nodule", "Pleural_Thickening",
-    #     "Pneumonia", "Pneumothorax"
-    # ]
-    
-    # Option C - Alternative Common Order:
-    # default_labels = [
-    #     "Pneumonia", "Pneumothorax", "Consolidation", "Edema",
-    #     "Atelectasis", "Cardiomegaly", "Effusion", "Infiltration",
-    #     "Mass", "Nodule", "Emphysema", "Fibrosis",
-    #     "Pleural_Thickening", "Hernia"
-    # ]
-    
-    x = logits.squeeze()
-    # If single value, wrap
-    if x.ndim == 0:
-        x = np.array([x])
-    
-    # Debug: Print raw logits for analysis
-    # Use sigmoid for multi-label classification (common for medical imaging)
-    probs = 1.0 / (1.0 + np.exp(-x))
-    
-    results = []
-    for idx, p in enumerate(probs):
-        if idx < len(default_labels):
-            label = default_labels[idx]
-        else:
-            label = f"Finding_{idx}"
-        results.append({"label": label, "confidence": float(p)})
-    
-    # Sort by confidence and return top 5
-    results.sort(key=lambda d: d["confidence"], reverse=True)
-    
-    # Find "No Finding" prediction
-    no_finding_result = None
-    pathology_results = []
-    
-    for result in results:
-        if "No Finding" in result["label"]:
-            no_finding_result = result
-        else:
-            pathology_results.append(result)
-    
-    # Only return "Normal" if "No Finding" has very high confidence (>75%)
-    # AND no pathology has significant confidence (>40%)
-    if no_finding_result:
-        max_pathology_confidence = max([r["confidence"] for r in pathology_results]) if pathology_results else 0
-        print(f"[DEBUG] No Finding: {no_finding_result['confidence']:.3f}, Max pathology: {max_pathology_confidence:.3f}")
-        
-        # Only call it normal if No Finding is very confident AND pathologies are low
-        if no_finding_result["confidence"] > 0.75 and max_pathology_confidence < 0.4:
-            print(f"[INFO] High confidence normal: No Finding ({no_finding_result['confidence']:.3f}) > pathologies ({max_pathology_confidence:.3f})")
-            return [{"label": "Normal - No significant findings detected", "confidence": no_finding_result["confidence"]}]
-        
-        # If No Finding has moderate confidence but pathologies are higher, show pathologies
-        print(f"[INFO] Showing pathology results instead of normal")
-    
-    # Process pathological findings
-    # Add confidence indicators
-    for result in pathology_results:
-        if result["confidence"] < 0.4:
-            result["label"] += " (Low Confidence)"
-        elif result["confidence"] > 0.7:
-            result["label"] += " (High Confidence)"
-    
-    # Filter out very low-confidence predictions (below 25%)
-    filtered_results = [r for r in pathology_results if r["confidence"] > 0.25]
-    
-    # If no significant pathological findings
-    if not filtered_results:
-        return [{"label": "Normal - No significant findings detected", "confidence": 0.8}]
-    
-    return filtered_results[:5]
-
-def run_inference(image_np: np.ndarray):
+# Size the OpenCV / torch / ONNX Runtime pools for this worker before any model loads
+apply_thread_budget(thread_budget)
+
+_predictor = Predictor()
+
+def run_inference(image_np: np.ndarray, background_tasks: BackgroundTasks = None, ensemble: bool = None,
+                  deadline: RequestDeadline = None, ledger: MemoryLedger = None):
     try:
-        print(f"[inference] Starting inference for image shape: {image_np.shape}")
-        _load_model_if_needed()
-        
-        if _onnx_session is None and _torch_model is None:
-            print("[inference] No model available")
-            raise HTTPException(status_code=500, detail="Model not available on server")
-        
-        print(f"[inference] Model loaded, using ONNX: {_use_onnx}")
-        inp = _preprocess(image_np)
-        print(f"[inference] Preprocessed input shape: {inp.shape}")
-        
-        if _use_onnx:
-            input_name = _onnx_session.get_inputs()[0].name
-            print(f"[inference] ONNX input name: {input_name}")
-            outputs = _onnx_session.run(None, {input_name: inp})
-            logits = outputs[0]
-            print(f"[inference] ONNX output shape: {logits.shape}")
-        else:
-            import torch
-            with torch.no_grad():
-                tensor = torch.from_numpy(inp)
-                print(f"[inference] PyTorch tensor shape: {tensor.shape}")
-                logits_tensor = _torch_model(tensor)
-                if hasattr(logits_tensor, 'detach'):
-                    logits = logits_tensor.detach().cpu().numpy()
-                else:
-                    logits = np.array(logits_tensor)
-                print(f"[inference] PyTorch output shape: {logits.shape}")
-
-        predictions = _postprocess(logits)
-        print(f"[inference] Postprocessed predictions: {predictions}")
-        return {"predictions": predictions}
+        prediction = _predictor.predict(
+            image_np,
+            ensemble=ensemble,
+            fallback_version=degradation.fallback_version if degradation.degraded else None,
+            checkpoint=deadline.check if deadline is not None else None,
+        )
+        if ledger is not None:
+            ledger.hold("tensor", prediction.tensor.nbytes)
+        client_gone = deadline is not None and deadline.cancelled.is_set()
+        if background_tasks is not None and not client_gone and not prediction.degraded and shadow.should_sample(prediction.model_version):
+            background_tasks.add_task(shadow.submit, prediction.tensor, prediction.model,
+                                  prediction.logits, prediction.model_ms)
+        return prediction.to_dict()
         
+    except HTTPException:
+        raise
+    except ModelUnavailableError as e:
+        raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
         print(f"[inference] Error during inference: {e}")
         import traceback
@@ -370,6 +167,19 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         print(f"Authentication error: {e}")
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
 
+async def get_stream_user(request: Request, access_token: Optional[str] = Query(None)):
+    """
+    get_current_user for EventSource streams: browsers can't set headers on
+    them, so the token may also come as ?access_token=
+    """
+    token = access_token
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return await get_current_user(HTTPAuthorizationCredentials(scheme="Bearer", credentials=token))
+
 # Helper function to get user profile
 async def get_user_profile(user_id: str):
     try:
@@ -394,6 +204,208 @@ async def require_active_account(user_id: str):
         raise HTTPException(status_code=403, detail="Doctor account awaiting super admin approval")
     return profile
 
+# ---------------- Admission control and uploads ----------------
+# Admission control, request deadlines and load shedding live in admission.py;
+# upload limits, the memory budget and decoding uploads in place in uploads.py.
+app.add_middleware(UploadLimitMiddleware)
+
+# ---------------- Request profiling ----------------
+# A super_admin can profile a single prediction with `X-Profile: 1` or
+# `?profile=true`. Stages are timed (wall and thread CPU), run under cProfile,
+# and allocations are traced (PROFILE_MEMORY); the artifact is kept under PROFILE_DIR.
+# Unprofiled requests only pay for one ContextVar lookup per stage.
+PROFILE_HEADER = "x-profile"
+
+def _profile_requested(request: Request) -> bool:
+    flag = request.headers.get(PROFILE_HEADER) or request.query_params.get("profile") or ""
+    return flag.lower() in ("1", "true", "yes")
+
+@contextlib.asynccontextmanager
+async def _profile_scope(request: Request, user_id: str, role: str, endpoint: str, filename: str = None):
+    """Yields a RequestProfile when a super_admin asked for one, else None"""
+    if not _profile_requested(request):
+        yield None
+        return
+    if role != "super_admin":
+        raise HTTPException(status_code=403, detail="Only super admins can profile requests")
+    request_profile = profiling.RequestProfile(endpoint, user_id, filename)
+    token = profiling.current_profile.set(request_profile)
+    status = 200
+    try:
+        yield request_profile
+    except HTTPException as e:
+        status = e.status_code
+        raise
+    except Exception:
+        status = 500
+        raise
+    finally:
+        profiling.current_profile.reset(token)
+        await run_in_threadpool(request_profile.save, status)
+
+def _profile_path(profile_id: str, ext: str) -> str:
+    if not re.fullmatch(r"[0-9A-Za-z-]+", profile_id):
+        raise HTTPException(status_code=400, detail="Invalid profile id")
+    path = os.path.join(PROFILE_DIR, f"{profile_id}{ext}")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return path
+
+# ---------------- Image storage ----------------
+# Diagnoses reference bucket objects by image_path. Server-side work reads them
+# through a size-bounded local cache (storage.py) instead of downloading each
+# time; images of newly queued diagnoses are prefetched into it.
+# At ingest a background stage also builds derivatives (derivatives.py): a
+# thumbnail, a preview and the model-resolution tensor, so list views don't
+# pull full films and re-analysis skips the decode.
+IMAGE_PREFETCH = os.getenv("IMAGE_PREFETCH", "true").lower() == "true"
+DERIVATIVES_AT_INGEST = os.getenv("DERIVATIVES_AT_INGEST", "true").lower() == "true"
+DERIVATIVE_MAX_AGE = int(os.getenv("DERIVATIVE_MAX_AGE", "86400"))  # Cache-Control max-age, seconds
+_image_cache = None
+_image_cache_lock = threading.Lock()
+_derivatives = None
+
+def _get_image_cache() -> ImageCache:
+    global _image_cache
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache(bucket_from_env(supabase))
+        return _image_cache
+
+def _get_derivatives() -> DerivativeStore:
+    global _derivatives
+    cache = _get_image_cache()
+    with _image_cache_lock:
+        if _derivatives is None:
+            _derivatives = DerivativeStore(cache)
+        return _derivatives
+
+def _ingest_image(image_path: str):
+    """Background ingest stage: fetch the original and build its derivatives for the serving model"""
+    try:
+        model = registry.get_active_model()
+        _get_derivatives().schedule(image_path, [model] if model is not None else [])
+    except Exception as e:
+        print(f"[derivatives] Could not queue ingest of {image_path}: {e}")
+
+# Extension and content type of the bucket object for each upload kind
+_UPLOAD_OBJECT_TYPES = {
+    "dicom": ("dcm", "application/dicom"),
+    "png": ("png", "image/png"),
+    "jpeg": ("jpg", "image/jpeg"),
+    "tiff": ("tif", "image/tiff"),
+    "bmp": ("bmp", "image/bmp"),
+}
+
+def _store_upload(user_id: str, upload: UploadBuffer) -> str:
+    """Put an upload in the bucket under <user>/<sha256>.<ext> (so a retry lands on the same object); returns the key"""
+    ext, content_type = _UPLOAD_OBJECT_TYPES[upload.kind]
+    image_path = f"{user_id}/{upload.digest}.{ext}"
+    try:
+        _get_image_cache().upload(image_path, upload.view.tobytes(), content_type)
+    except StorageError as e:
+        print(f"[storage] {e}")
+        raise HTTPException(status_code=503, detail="Could not store the image, try again shortly")
+    return image_path
+
+def _findings_report(predictions: dict) -> dict:
+    """Report for an analyzed diagnosis, worded from the model's findings only"""
+    findings = predictions.get("predictions") or []
+    if not findings:
+        impression = "No findings above the reporting threshold"
+    elif findings[0]["label"] == NORMAL_LABEL:
+        impression = "No significant abnormality detected"
+    else:
+        impression = "Suspicious for " + ", ".join(f["label"].split(" (")[0] for f in findings)
+    return {
+        "impression": impression,
+        "findings": [f"{f['label']}: {f['confidence']:.0%}" for f in findings],
+        "recommendations": ["Clinical correlation recommended"],
+        "model_version": predictions.get("model_version"),
+        "disclaimer": "This report is AI generated; please consult a doctor before acting on it",
+    }
+
+def _analyze_stored_image(image_path: str) -> dict:
+    """Score a stored image from its model-resolution derivative, skipping the decode when it exists"""
+    with registry.ActiveModel() as model:
+        if model is None or not model.loaded:
+            raise ModelUnavailableError("Model not available on server")
+        tensor = _get_derivatives().model_tensor(image_path, model)
+        prediction = Predictor(model=model).predict_tensors(tensor)[0]
+    return prediction.to_dict()
+
+_backfill_job = None
+
+def _prefetch_images(paths: list):
+    try:
+        _get_image_cache().prefetch(paths)
+    except Exception as e:
+        print(f"[storage] Could not queue prefetch: {e}")
+
+# ---------------- Audit log ----------------
+# Admin actions and predictions are recorded in system_logs through AuditLog
+# (audit.py): events are queued in memory and written in batches by a
+# background thread, so recording one costs no database round trip.
+AUDIT_ENABLED = os.getenv("AUDIT_ENABLED", "true").lower() == "true"
+_audit = None
+_audit_lock = threading.Lock()
+
+def _get_audit() -> AuditLog:
+    global _audit
+    with _audit_lock:
+        if _audit is None:
+            _audit = AuditLog(supabase)
+        return _audit
+
+def _audit_event(action: str, user_id: str = None, details: dict = None, request: Request = None):
+    """Queue an audit event; never fails the request"""
+    if not AUDIT_ENABLED:
+        return
+    try:
+        ip_address, user_agent = None, None
+        if request is not None:
+            import ipaddress
+            forwarded = request.headers.get("x-forwarded-for", "").split(",")[0].strip()
+            candidate = forwarded or (request.client.host if request.client else None)
+            with contextlib.suppress(ValueError, TypeError):
+                ip_address = str(ipaddress.ip_address(candidate))
+            user_agent = request.headers.get("user-agent")
+        _get_audit().log(action, user_id, details, ip_address, user_agent)
+    except Exception as e:
+        print(f"[audit] Could not queue {action}: {e}")
+
+def _prediction_details(result: dict, **extra) -> dict:
+    findings = result.get("predictions") or []
+    details = {"model_version": result.get("model_version"), "top_finding": findings[0] if findings else None}
+    if result.get("degraded"):
+        details["degraded"] = True
+    return {**details, **extra}
+
+@app.on_event("shutdown")
+async def _flush_audit_log():
+    if _audit is not None:
+        await run_in_threadpool(_audit.close)
+
+# ---------------- Profile resolution ----------------
+# Display fields for many users at once come from a per-worker cache that
+# batches misses into one query (profiles.py).
+_profile_cache = ProfileCache(supabase)
+
+# ---------------- Diagnosis events ----------------
+# Status transitions are published to the owner's SSE streams (diagnosis_events.py).
+def _set_diagnosis_status(diagnosis: dict, status: str, error: str = None):
+    """Record a status transition in the table and publish it; failures here never fail the request"""
+    try:
+        update_data = {"status": status, "updated_at": datetime.now().isoformat()}
+        response = supabase.table("diagnoses").update(update_data).eq("id", diagnosis["id"]).execute()
+        publish_diagnosis(response.data[0] if response.data else {**diagnosis, **update_data}, error=error)
+    except Exception as e:
+        print(f"[events] Could not set {diagnosis['id']} to {status}: {e}")
+
+# ---------------- Idempotent predictions ----------------
+# Idempotency-Key claims and replays for /api/diagnoses/predict (idempotency.py).
+_idempotency = IdempotencyKeys(supabase)
+
 @app.get("/")
 async def root():
     return {"message": "Clarix AI Radiology Assistant API", "version": "1.0.0"}
@@ -402,41 +414,313 @@ async def root():
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
+@app.get("/ready")
+async def readiness_check():
+    """Ready once the active model is loaded; reports the thread budget this worker runs with"""
+    model = await run_in_threadpool(registry.get_active_model)
+    ready = model is not None and model.loaded
+    body = {
+        "status": "ready" if ready else "not_ready",
+        "model_version": model.name if model is not None else None,
+        "threads": {"budget": thread_budget, "effective": effective_threads(model)},
+        "timestamp": datetime.now().isoformat(),
+    }
+    return JSONResponse(status_code=200 if ready else 503, content=body)
+
+@app.get("/api/inference/metrics")
+async def inference_metrics():
+    """Queue depth, admission, memory budget, event stream, audit log and profile cache counters for this worker"""
+    metrics = admission.metrics()
+    metrics["memory"] = memory_budget.metrics()
+    metrics["events"] = events.metrics()
+    metrics["audit"] = _audit.stats() if _audit is not None else None
+    metrics["profile_cache"] = _profile_cache.metrics()
+    metrics["ask_ai"] = service_stats()
+    return metrics
+
 @app.get("/api/model/info")
 async def model_info():
-    """Get information about the loaded model"""
+    """Get information about the active model version"""
     try:
-        _load_model_if_needed()
-        
-        # Get current labels
-        current_labels = [
-            "Atelectasis", "Cardiomegaly", "Effusion", "Infiltration", 
-            "Mass", "Nodule", "Pneumonia", "Pneumothorax", 
-            "Edema", "Consolidation", "Emphysema", "Fibrosis", 
-            "Pleural_Thickening", "Hernia"
-        ]
-        
-        # Get model info
-        model_info = {
-            "loaded": _onnx_session is not None or _torch_model is not None,
-            "model_type": "onnx" if _use_onnx else "pytorch",
-            "labels": current_labels,
-            "num_classes": 14,
-            "input_size": [224, 224],
-            "preprocessing": "ImageNet normalization with CLAHE"
-        }
-        
-        if _torch_model is not None:
-            # Get model architecture info
-            model_info["architecture"] = str(type(_torch_model).__name__)
-            
-        return model_info
+        model = await run_in_threadpool(registry.get_active_model)
+        if model is None:
+            return {"loaded": False, "version": None}
+        return model.info()
         
     except Exception as e:
         return {"error": str(e), "loaded": False}
 
-@app.post("/api/debug/raw-prediction")
+@app.get("/api/admin/models")
+async def list_model_versions(user: dict = Depends(get_current_user)):
+    """
+    List registered model versions and which one is serving (Super Admin only)
+    """
+    try:
+        profile = await get_user_profile(user['id'])
+        if not profile or profile.get("role") != "super_admin":
+            raise HTTPException(status_code=403, detail="Only super admins can manage models")
+
+        await run_in_threadpool(registry.load_model_if_needed)
+        versions = [v.info() for v in registry.list_versions().values()]
+        return {"active": registry.active_version(), "versions": versions}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error listing model versions: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/admin/models/activate")
+async def activate_model_version(
+    request: Request,
+    version: str = Form(...),
+    user: dict = Depends(get_current_user)
+):
+    """
+    Warm a registered version and make it the serving model without downtime (Super Admin only)
+    """
+    try:
+        profile = await get_user_profile(user['id'])
+        if not profile or profile.get("role") != "super_admin":
+            raise HTTPException(status_code=403, detail="Only super admins can manage models")
+
+        try:
+            model = await run_in_threadpool(registry.switch_model_version, version)
+        except KeyError:
+            raise HTTPException(status_code=404, detail=f"Unknown model version: {version}")
+        _audit_event("admin.model_activated", user['id'], {"version": version}, request)
+        return {"message": "Model version activated", "model": model.info()}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error activating model version: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/admin/models/reload")
+async def reload_model_registry(request: Request, user: dict = Depends(get_current_user)):
+    """
+    Re-read models/registry.json to pick up new versions (Super Admin only)
+    """
+    try:
+        profile = await get_user_profile(user['id'])
+        if not profile or profile.get("role") != "super_admin":
+            raise HTTPException(status_code=403, detail="Only super admins can manage models")
+
+        await run_in_threadpool(registry.load_model_if_needed)
+        result = await run_in_threadpool(registry.reload_registry)
+        _audit_event("admin.model_registry_reloaded", user['id'], {"active": result.get("active")}, request)
+        return {"message": "Model registry reloaded", **result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error reloading model registry: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/admin/shadow/summary")
+async def shadow_summary(
+    version: Optional[str] = Query(None),
+    limit: int = Query(1000, ge=1, le=100000),
+    user: dict = Depends(get_current_user)
+):
+    """
+    Disagreement and latency summary for the shadow candidate model (Super Admin only)
+    """
+    try:
+        profile = await get_user_profile(user['id'])
+        if not profile or profile.get("role") != "super_admin":
+            raise HTTPException(status_code=403, detail="Only super admins can view shadow results")
+        return await run_in_threadpool(shadow.summary, version, limit)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error building shadow summary: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/admin/image-cache")
+async def image_cache_stats(user: dict = Depends(get_current_user)):
+    """
+    Size, hit rate and eviction counters of the local image cache (Super Admin only)
+    """
+    try:
+        profile = await get_user_profile(user['id'])
+        if not profile or profile.get("role") != "super_admin":
+            raise HTTPException(status_code=403, detail="Only super admins can view the image cache")
+        cache = await run_in_threadpool(_get_image_cache)
+        return await run_in_threadpool(cache.stats)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error reading image cache stats: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/admin/image-cache/prefetch")
+async def prefetch_pending_images(
+    limit: int = Query(200, ge=1, le=5000),
+    user: dict = Depends(get_current_user)
+):
+    """
+    Warm the image cache with the originals of pending diagnoses, oldest first (Super Admin only)
+    """
+    try:
+        profile = await get_user_profile(user['id'])
+        if not profile or profile.get("role") != "super_admin":
+            raise HTTPException(status_code=403, detail="Only super admins can manage the image cache")
+        response = supabase.table("diagnoses").select("image_path").eq("status", "pending").order("created_at").limit(limit).execute()
+        paths = [row["image_path"] for row in response.data or [] if row.get("image_path")]
+        _prefetch_images(paths)
+        return {"message": "Prefetch queued", "queued": len(paths)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error queueing image prefetch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/admin/backfill")
+async def backfill_status(user: dict = Depends(get_current_user)):
+    """
+    Progress of the re-score backfill (Super Admin only)
+    """
+    try:
+        profile = await get_user_profile(user['id'])
+        if not profile or profile.get("role") != "super_admin":
+            raise HTTPException(status_code=403, detail="Only super admins can view the backfill")
+        if _backfill_job is None:
+            return {"running": False}
+        return _backfill_job.info()
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error reading backfill status: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/admin/backfill/start")
+async def start_backfill(
+    request: Request,
+    version: Optional[str] = Query(None, description="Registry version to re-score with (defaults to the serving one)"),
+    rate: float = Query(2.0, ge=0, le=1000, description="Images per second, 0 = unthrottled"),
+    batch_size: int = Query(16, ge=1, le=256),
+    restart: bool = Query(False, description="Ignore the checkpoint and start from the first diagnosis"),
+    user: dict = Depends(get_current_user)
+):
+    """
+    Re-score completed diagnoses with a model version in a low-priority
+    background thread, resuming from its checkpoint (Super Admin only).
+    The job yields while interactive analyses are queued.
+    """
+    global _backfill_job
+    try:
+        profile = await get_user_profile(user['id'])
+        if not profile or profile.get("role") != "super_admin":
+            raise HTTPException(status_code=403, detail="Only super admins can run the backfill")
+        if _backfill_job is not None and _backfill_job.running:
+            raise HTTPException(status_code=409, detail=f"A backfill towards {_backfill_job.model.name} is already running")
+        await run_in_threadpool(registry.load_model_if_needed)
+        model = registry.get_version(version) if version else registry.get_active_model()
+        if model is None:
+            raise HTTPException(status_code=404, detail=f"Model version {version} not found")
+        await run_in_threadpool(model.load)
+        if not model.loaded:
+            raise HTTPException(status_code=500, detail=f"Model {model.name} failed to load: {model.error}")
+        derivatives = await run_in_threadpool(_get_derivatives)
+        job = BackfillJob(supabase, derivatives, model, batch_size=batch_size, rate=rate,
+                          should_yield=lambda: admission.waiting > 0)
+        if restart:
+            await run_in_threadpool(job.reset)
+        job.start()
+        _backfill_job = job
+        print(f"[backfill] Started towards {model.name} by {user['id']}")
+        _audit_event("admin.backfill_started", user['id'], {"version": model.name, "rate": rate, "restart": restart}, request)
+        return job.info()
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error starting backfill: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/admin/backfill/pause")
+async def pause_backfill(request: Request, user: dict = Depends(get_current_user)):
+    """
+    Stop the backfill after its current batch; starting it again resumes from the checkpoint (Super Admin only)
+    """
+    try:
+        profile = await get_user_profile(user['id'])
+        if not profile or profile.get("role") != "super_admin":
+            raise HTTPException(status_code=403, detail="Only super admins can run the backfill")
+        if _backfill_job is None or not _backfill_job.running:
+            raise HTTPException(status_code=409, detail="No backfill is running")
+        _backfill_job.pause()
+        _audit_event("admin.backfill_paused", user['id'], {"version": _backfill_job.model.name}, request)
+        return {"message": "Backfill pausing after the current batch", **_backfill_job.info()}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error pausing backfill: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/admin/profiles")
+async def list_profiles(
+    limit: int = Query(50, ge=1, le=500),
+    user: dict = Depends(get_current_user)
+):
+    """
+    Recent request profiles, newest first (Super Admin only)
+    """
+    try:
+        profile = await get_user_profile(user['id'])
+        if not profile or profile.get("role") != "super_admin":
+            raise HTTPException(status_code=403, detail="Only super admins can view profiles")
+        if not os.path.isdir(PROFILE_DIR):
+            return {"profiles": []}
+        profiles = []
+        for name in sorted((f for f in os.listdir(PROFILE_DIR) if f.endswith(".json")), reverse=True)[:limit]:
+            with open(os.path.join(PROFILE_DIR, name)) as f:
+                summary = json.load(f)
+            profiles.append({key: summary.get(key) for key in ("id", "endpoint", "filename", "created_at", "status", "total_ms")})
+        return {"profiles": profiles}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error listing profiles: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/admin/profiles/{profile_id}")
+async def get_profile_artifact(
+    profile_id: str,
+    format: str = Query("json", pattern="^(json|pstats)$"),
+    user: dict = Depends(get_current_user)
+):
+    """
+    A stored request profile: the JSON summary, or the raw pstats dump with
+    format=pstats (open with `python -m pstats` or snakeviz) (Super Admin only)
+    """
+    try:
+        profile = await get_user_profile(user['id'])
+        if not profile or profile.get("role") != "super_admin":
+            raise HTTPException(status_code=403, detail="Only super admins can view profiles")
+        if format == "pstats":
+            return FileResponse(_profile_path(profile_id, ".prof"), media_type="application/octet-stream",
+                                filename=f"{profile_id}.prof")
+        with open(_profile_path(profile_id, ".json")) as f:
+            return json.load(f)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error reading profile {profile_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _debug_raw_logits(image_np: np.ndarray, ledger: MemoryLedger = None):
+    with registry.ActiveModel() as model:
+        if model is None or not model.loaded:
+            raise HTTPException(status_code=500, detail="Model not available")
+        with profiling.stage("preprocess"):
+            inp = model.preprocess(image_np)
+        if ledger is not None:
+            ledger.hold("tensor", inp.nbytes)
+        with profiling.stage("inference"):
+            return model, model.run(inp)
+
+@app.post(sniffed_upload("/api/debug/raw-prediction"))
 async def debug_raw_prediction(
+    request: Request,
     file: UploadFile = File(...),
     user: dict = Depends(get_current_user)
 ):
@@ -448,41 +732,12 @@ async def debug_raw_prediction(
 
         print(f"[DEBUG] Processing file: {file.filename}")
         
-        raw = await file.read()
-        
-        # Load image
-        if file.filename.lower().endswith('.dcm'):
-            try:
-                import pydicom
-                ds = pydicom.dcmread(io.BytesIO(raw))
-                image_np = ds.pixel_array.astype(np.float32)
-            except Exception as e:
-                raise HTTPException(status_code=415, detail=f"DICOM error: {str(e)}")
-        else:
-            img = Image.open(io.BytesIO(raw)).convert('RGB')
-            image_np = np.array(img)
+        async with _profile_scope(request, user['id'], profile.get("role"), "debug_raw_prediction", file.filename) as request_profile, \
+                deadline_scope(request) as deadline, admission.slot(user['id'], profile.get("role"), deadline):
+            async with decoded_upload(file, deadline) as (image_np, ledger):
+                # Run inference and get raw logits
+                model, logits = await run_in_threadpool(_debug_raw_logits, image_np, ledger)
 
-        # Run inference and get raw logits
-        _load_model_if_needed()
-        if _onnx_session is None and _torch_model is None:
-            raise HTTPException(status_code=500, detail="Model not available")
-        
-        inp = _preprocess(image_np)
-        
-        if _use_onnx:
-            input_name = _onnx_session.get_inputs()[0].name
-            outputs = _onnx_session.run(None, {input_name: inp})
-            logits = outputs[0]
-        else:
-            import torch
-            with torch.no_grad():
-                tensor = torch.from_numpy(inp)
-                logits = _torch_model(tensor)
-                if hasattr(logits, 'detach'):
-                    logits = logits.detach().cpu().numpy()
-                else:
-                    logits = np.array(logits)
-        
         x = logits.squeeze()
         probs = 1.0 / (1.0 + np.exp(-x))
         
@@ -526,11 +781,16 @@ async def debug_raw_prediction(
         
         return {
             "filename": file.filename,
+            "model_version": model.name,
             "raw_logits": x.tolist(),
             "probabilities": probs.tolist(),
-            "label_mappings": results
+            "label_mappings": results,
+            "memory": ledger.info(),
+            "profile_id": request_profile.id if request_profile else None
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"[DEBUG] Error: {e}")
         import traceback
@@ -539,9 +799,12 @@ async def debug_raw_prediction(
 
 
 
-@app.post("/api/ai/predict")
+@app.post(sniffed_upload("/api/ai/predict"))
 async def ai_predict(
+    request: Request,
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
+    ensemble: Optional[bool] = Form(None),
     user: dict = Depends(get_current_user)
 ):
     try:
@@ -552,30 +815,15 @@ async def ai_predict(
 
         print(f"[AI] Processing file: {file.filename} for user: {user['id']}")
         
-        raw = await file.read()
-        print(f"[AI] File size: {len(raw)} bytes")
-        
-        # Try DICOM first if .dcm
-        try:
-            if file.filename.lower().endswith('.dcm'):
-                try:
-                    import pydicom
-                except Exception as e:
-                    print(f"[AI] DICOM import error: {e}")
-                    raise HTTPException(status_code=415, detail="DICOM not supported on server (install pydicom)")
-                ds = pydicom.dcmread(io.BytesIO(raw))
-                image_np = ds.pixel_array.astype(np.float32)
-                print(f"[AI] DICOM loaded, shape: {image_np.shape}")
-            else:
-                img = Image.open(io.BytesIO(raw)).convert('RGB')
-                image_np = np.array(img)
-                print(f"[AI] Image loaded, shape: {image_np.shape}")
-        except Exception as e:
-            print(f"[AI] Image loading error: {e}")
-            raise HTTPException(status_code=400, detail=f"Invalid image file: {str(e)}")
-
-        print(f"[AI] Running inference...")
-        result = run_inference(image_np)
+        # Decode and inference only start once the request holds an inference slot
+        async with _profile_scope(request, user['id'], profile.get("role"), "ai_predict", file.filename) as request_profile, \
+                deadline_scope(request) as deadline, admission.slot(user['id'], profile.get("role"), deadline):
+            async with decoded_upload(file, deadline) as (image_np, ledger):
+                print(f"[AI] Running inference...")
+                result = await run_in_threadpool(run_inference, image_np, background_tasks, ensemble, deadline, ledger)
+        if request_profile is not None:
+            result["profile_id"] = request_profile.id
+        _audit_event("prediction.run", user['id'], _prediction_details(result, filename=file.filename), request)
         print(f"[AI] Inference completed: {result}")
         return result
         
@@ -590,6 +838,7 @@ async def ai_predict(
 
 @app.post("/api/diagnose")
 async def create_diagnosis(
+    background_tasks: BackgroundTasks,
     image_path: str = Form(...),
     user: dict = Depends(get_current_user)
 ):
@@ -616,6 +865,11 @@ async def create_diagnosis(
             # TODO: Trigger AI analysis here
             # For now, we'll simulate the process
             diagnosis_id = response.data[0]["id"]
+            publish_diagnosis(response.data[0])
+            if DERIVATIVES_AT_INGEST:
+                background_tasks.add_task(_ingest_image, image_path)
+            elif IMAGE_PREFETCH:
+                background_tasks.add_task(_prefetch_images, [image_path])
             
             return {
                 "diagnosis_id": diagnosis_id,
@@ -629,6 +883,99 @@ async def create_diagnosis(
         print(f"Error creating diagnosis: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post(sniffed_upload("/api/diagnoses/predict"))
+async def predict_and_save_diagnosis(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    ensemble: Optional[bool] = Form(None),
+    image_path: Optional[str] = Form(None),
+    user: dict = Depends(get_current_user)
+):
+    """
+    Run the model on an upload and store the diagnosis (predictions and model
+    version) in one request. Send an Idempotency-Key header to make retries
+    safe: a repeated key returns the stored result with "replayed": true.
+    Without `image_path` (a key already in the bucket) the upload is stored first.
+    """
+    owns_key, upload, finished = False, None, None
+    try:
+        profile = await require_active_account(user['id'])
+        if profile.get("role") not in ["doctor", "super_admin"]:
+            raise HTTPException(status_code=403, detail="Only doctors or super admins can run predictions")
+        key = request.headers.get("idempotency-key")
+        if key is not None and not IDEMPOTENCY_KEY_PATTERN.match(key):
+            raise HTTPException(status_code=400, detail="Idempotency-Key must be 8-128 characters of [A-Za-z0-9._:-]")
+        upload = await run_in_threadpool(UploadBuffer, file, True)
+        upload.validate()
+        digest = upload.digest
+
+        if key:
+            pending = _idempotency.running(user['id'], key)
+            if pending is not None:
+                return _idempotency.stored_response(await asyncio.shield(pending), digest)
+            _idempotency.begin(user['id'], key)
+            owns_key = True
+
+        if not image_path:
+            image_path = await run_in_threadpool(_store_upload, user['id'], upload)
+        now = datetime.now().isoformat()
+        diagnosis, existing = await run_in_threadpool(_idempotency.claim, {
+            "id": str(uuid.uuid4()),
+            "user_id": user['id'],
+            "image_path": image_path,
+            "status": "processing",
+            "idempotency_key": key,
+            "request_digest": digest,
+            "created_at": now,
+            "updated_at": now
+        })
+        if diagnosis is None:
+            return _idempotency.stored_response(existing or {}, digest)
+        publish_diagnosis(diagnosis)
+
+        print(f"[AI] Processing file: {file.filename} for user: {user['id']} (diagnosis {diagnosis['id']})")
+        try:
+            async with _profile_scope(request, user['id'], profile.get("role"), "predict_and_save", file.filename) as request_profile, \
+                    deadline_scope(request) as deadline, admission.slot(user['id'], profile.get("role"), deadline):
+                async with decoded_upload(upload, deadline) as (image_np, ledger):
+                    result = await run_in_threadpool(run_inference, image_np, background_tasks, ensemble, deadline, ledger)
+        except BaseException as e:
+            failed = {"status": "failed", "updated_at": datetime.now().isoformat()}
+            with contextlib.suppress(Exception):
+                response = supabase.table("diagnoses").update(failed).eq("id", diagnosis["id"]).execute()
+                diagnosis = response.data[0] if response.data else {**diagnosis, **failed}
+            publish_diagnosis(diagnosis, error=getattr(e, "detail", None) or str(e) or type(e).__name__)
+            raise
+
+        update_data = {
+            "status": "completed",
+            "predictions": result,
+            "model_version": result.get("model_version"),
+            "updated_at": datetime.now().isoformat()
+        }
+        response = supabase.table("diagnoses").update(update_data).eq("id", diagnosis["id"]).execute()
+        if not response.data:
+            raise HTTPException(status_code=500, detail="Failed to save diagnosis")
+        diagnosis = response.data[0]
+        publish_diagnosis(diagnosis, predictions=result)
+        _audit_event("diagnosis.predicted", user['id'], _prediction_details(result, diagnosis_id=diagnosis["id"]), request)
+        finished = diagnosis
+        if request_profile is not None:
+            result["profile_id"] = request_profile.id
+        return {**result, "diagnosis_id": diagnosis["id"], "replayed": False}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"[AI] Unexpected error in predict_and_save_diagnosis: {e}")
+        raise HTTPException(status_code=500, detail=f"AI analysis failed: {str(e)}")
+    finally:
+        if upload is not None:
+            upload.close()
+        if owns_key:
+            _idempotency.finish(user['id'], key, finished)
+
 @app.get("/api/diagnoses")
 async def get_diagnoses(user: dict = Depends(get_current_user)):
     """
@@ -646,6 +993,85 @@ async def get_diagnoses(user: dict = Depends(get_current_user)):
         print(f"Error fetching diagnoses: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/diagnoses/events")
+async def diagnosis_events(request: Request, user: dict = Depends(get_stream_user)):
+    """
+    Server-sent events for the current user's diagnoses: a "status" event per
+    transition (with a findings summary once completed), a heartbeat comment
+    every EVENT_HEARTBEAT_S, and replay from Last-Event-ID on reconnect
+    """
+    try:
+        await require_active_account(user['id'])
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error opening diagnosis events: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    last_event_id = request.headers.get("last-event-id") or request.query_params.get("last_event_id")
+    queue, replay, resync = events.subscribe(user['id'], last_event_id)
+
+    async def stream():
+        try:
+            yield f"retry: {EVENT_RETRY_MS}\n\n"
+            if resync:
+                yield events.format_resync()
+            for item in replay:
+                yield events.format(item)
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=EVENT_HEARTBEAT_S)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": heartbeat\n\n"
+                    continue
+                yield events.format_resync() if item is None else events.format(item)
+        finally:
+            events.unsubscribe(user['id'], queue)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=headers)
+
+@app.get("/api/diagnoses/{diagnosis_id}/image")
+async def get_diagnosis_image(
+    diagnosis_id: str,
+    request: Request,
+    size: str = Query("thumb", pattern="^(thumb|preview)$"),
+    user: dict = Depends(get_current_user)
+):
+    """
+    Serve a derivative of the diagnosis image (thumb or preview JPEG), built on first use
+    """
+    try:
+        await require_active_account(user['id'])
+        response = supabase.table("diagnoses").select("image_path").eq("id", diagnosis_id).eq("user_id", user['id']).execute()
+        if not response.data:
+            raise HTTPException(status_code=404, detail="Diagnosis not found")
+        image_path = response.data[0].get("image_path")
+        if not image_path:
+            raise HTTPException(status_code=404, detail="Diagnosis has no image")
+
+        derivatives = await run_in_threadpool(_get_derivatives)
+        try:
+            file_path, digest, info = await run_in_threadpool(derivatives.image, image_path, size)
+        except ObjectNotFound:
+            raise HTTPException(status_code=404, detail="Image not found in storage")
+        except ValueError as e:
+            raise HTTPException(status_code=415, detail=str(e))
+
+        # Derivatives are immutable per content hash, so the hash is a strong validator
+        etag = f'"{digest[:32]}-{size}"'
+        headers = {"ETag": etag, "Cache-Control": f"private, max-age={DERIVATIVE_MAX_AGE}"}
+        if etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        return FileResponse(file_path, media_type=info["media_type"], headers=headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error serving diagnosis image: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/api/diagnoses/{diagnosis_id}")
 async def get_diagnosis(diagnosis_id: str, user: dict = Depends(get_current_user)):
     """
@@ -689,6 +1115,7 @@ async def update_diagnosis_status(
         response = supabase.table("diagnoses").update(update_data).eq("id", diagnosis_id).execute()
         
         if response.data:
+            publish_diagnosis(response.data[0])
             return {"message": "Status updated successfully", "diagnosis": response.data[0]}
         else:
             raise HTTPException(status_code=500, detail="Failed to update status")
@@ -700,6 +1127,7 @@ async def update_diagnosis_status(
 @app.post("/api/diagnoses/{diagnosis_id}/analyze")
 async def analyze_diagnosis(
     diagnosis_id: str,
+    request: Request,
     user: dict = Depends(get_current_user)
 ):
     """
@@ -713,45 +1141,42 @@ async def analyze_diagnosis(
             raise HTTPException(status_code=404, detail="Diagnosis not found")
         
         diagnosis = response.data[0]
+        if not diagnosis.get("image_path"):
+            raise HTTPException(status_code=400, detail="Diagnosis has no image")
         
-        # TODO: Implement actual AI analysis here
-        # For now, we'll simulate the analysis
+        # Run the model on the stored image's cached 224 derivative (decoded only if missing)
+        profile = await require_active_account(user['id'])
+        async with deadline_scope(request) as deadline, admission.slot(user['id'], profile.get("role"), deadline):
+            _set_diagnosis_status(diagnosis, "processing")
+            try:
+                try:
+                    predictions = await run_in_threadpool(_analyze_stored_image, diagnosis["image_path"])
+                except ObjectNotFound:
+                    raise HTTPException(status_code=404, detail="Image not found in storage")
+                except ModelUnavailableError as e:
+                    raise HTTPException(status_code=500, detail=str(e))
+                except ValueError as e:
+                    raise HTTPException(status_code=415, detail=str(e))
+            except BaseException as e:
+                _set_diagnosis_status(diagnosis, "failed", error=getattr(e, "detail", None) or str(e) or type(e).__name__)
+                raise
         
-        # Simulate AI predictions
-        predictions = {
-            "pneumonia": {"probability": 0.85, "confidence": "high"},
-            "cardiomegaly": {"probability": 0.12, "confidence": "low"},
-            "lung_opacity": {"probability": 0.78, "confidence": "medium"},
-            "fracture": {"probability": 0.05, "confidence": "low"}
-        }
-        
-        # Simulate report generation
-        report = {
-            "impression": "Suspicious for pneumonia in the right lower lobe",
-            "findings": [
-                "Patchy opacities in the right lower lobe",
-                "No significant cardiomegaly",
-                "Clear costophrenic angles"
-            ],
-            "recommendations": [
-                "Consider follow-up chest X-ray in 2-3 days",
-                "Clinical correlation recommended",
-                "Consider CT scan if symptoms persist"
-            ],
-            "disclaimer": "The report is ai generated , plaese consult with the doctors for safety reasons "
-        }
+        report = _findings_report(predictions)
         
         # Update diagnosis with results
         update_data = {
             "status": "completed",
-            "predictions": json.dumps(predictions),
-            "report": json.dumps(report),
+            "predictions": predictions,
+            "model_version": predictions.get("model_version"),
+            "report": report,
             "updated_at": datetime.now().isoformat()
         }
         
         response = supabase.table("diagnoses").update(update_data).eq("id", diagnosis_id).execute()
         
         if response.data:
+            publish_diagnosis(response.data[0], predictions=predictions)
+            _audit_event("diagnosis.analyzed", user['id'], _prediction_details(predictions, diagnosis_id=diagnosis_id), request)
             return {
                 "message": "Analysis completed successfully",
                 "diagnosis": response.data[0],
@@ -761,6 +1186,8 @@ async def analyze_diagnosis(
         else:
             raise HTTPException(status_code=500, detail="Failed to update diagnosis")
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error analyzing diagnosis: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -816,6 +1243,7 @@ async def update_user_settings(
 # User Management Endpoints (Admin Only)
 @app.post("/api/admin/users")
 async def create_user(
+    request: Request,
     email: str = Form(...),
     password: str = Form(...),
     role: str = Form(...),
@@ -869,6 +1297,8 @@ async def create_user(
                 # Fallback to update if upsert not available in current client
                 profile_resp = supabase.table("profiles").update(profile_data).eq("id", existing_auth_user.id).execute()
 
+            _profile_cache.invalidate(existing_auth_user.id)
+            _audit_event("admin.user_created", user['id'], {"target_id": existing_auth_user.id, "email": email, "role": role, "existing_auth_user": True}, request)
             return {
                 "message": "Existing user found. Profile was created/updated successfully.",
                 "user": (profile_resp.data[0] if profile_resp and getattr(profile_resp, "data", None) else profile_data)
@@ -911,6 +1341,8 @@ async def create_user(
                 profile_response = supabase.table("profiles").insert(profile_data).execute()
             
             if profile_response.data:
+                _profile_cache.invalidate(auth_response.user.id)
+                _audit_event("admin.user_created", user['id'], {"target_id": auth_response.user.id, "email": email, "role": role}, request)
                 return {
                     "message": "User created successfully",
                     "user": profile_response.data[0]
@@ -938,6 +1370,7 @@ async def create_user(
 
 @app.put("/api/admin/users/{user_id}/role")
 async def update_user_role(
+    request: Request,
     user_id: str,
     role: str = Form(...),
     user: dict = Depends(get_current_user)
@@ -970,6 +1403,8 @@ async def update_user_role(
         response = supabase.table("profiles").update(update_payload).eq("id", user_id).execute()
         
         if response.data:
+            _profile_cache.invalidate(user_id)
+            _audit_event("admin.user_role_changed", user['id'], {"target_id": user_id, "from": target.get("role"), "to": role}, request)
             return {"message": "User role updated successfully", "user": response.data[0]}
         else:
             raise HTTPException(status_code=404, detail="User not found")
@@ -980,6 +1415,7 @@ async def update_user_role(
 
 @app.put("/api/admin/users/{user_id}/approve")
 async def approve_user(
+    request: Request,
     user_id: str,
     approved: bool = Form(...),
     user: dict = Depends(get_current_user)
@@ -1000,6 +1436,8 @@ async def approve_user(
         if not resp.data:
             raise HTTPException(status_code=404, detail="User not found")
 
+        _profile_cache.invalidate(user_id)
+        _audit_event("admin.user_approved" if approved else "admin.user_approval_revoked", user['id'], {"target_id": user_id}, request)
         return {"message": "Approval updated", "user": resp.data[0]}
     except Exception as e:
         print(f"Error approving user: {e}")
@@ -1007,6 +1445,7 @@ async def approve_user(
 
 @app.delete("/api/admin/users/{user_id}")
 async def delete_user(
+    request: Request,
     user_id: str,
     user: dict = Depends(get_current_user)
 ):
@@ -1030,6 +1469,8 @@ async def delete_user(
         auth_response = supabase.auth.admin.delete_user(user_id)
         
         # Profile will be automatically deleted due to CASCADE
+        _profile_cache.invalidate(user_id)
+        _audit_event("admin.user_deleted", user['id'], {"target_id": user_id}, request)
         return {"message": "User deleted successfully"}
             
     except Exception as e:
@@ -1104,9 +1545,302 @@ async def admin_analytics(user: dict = Depends(get_current_user)):
         print(f"Error fetching analytics: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# ---------------- Admin exports ----------------
+# Tables are streamed as NDJSON or CSV in keyset pages (exports.py); the routes
+# below check the role, build the filters and audit the export.
+async def _export_response(request: Request, user: dict, table: str, name: str, fmt: str, compression: str,
+                           filters, details: dict):
+    profile = await get_user_profile(user['id'])
+    if not profile or profile.get("role") != "super_admin":
+        raise HTTPException(status_code=403, detail="Only super admins can export data")
+    response = stream_export(supabase, table, name, fmt, compression, filters)
+    _audit_event("admin.export", user['id'], {"table": table, "format": fmt, **details}, request)
+    return response
+
+@app.get("/api/admin/export/diagnoses")
+async def export_diagnoses(
+    request: Request,
+    format: str = Query("ndjson"),
+    compression: str = Query("gzip"),
+    since: Optional[str] = Query(None, description="Created at or after (ISO 8601)"),
+    until: Optional[str] = Query(None, description="Created before (ISO 8601)"),
+    status: Optional[str] = Query(None, description="Comma-separated statuses"),
+    user_id: Optional[str] = Query(None),
+    user: dict = Depends(get_current_user)
+):
+    """
+    Stream diagnoses (oldest first) as NDJSON or CSV, gzip-compressed unless
+    compression=none. Super Admin only.
+    """
+    try:
+        since_at, until_at = timestamp_param(since, "since"), timestamp_param(until, "until")
+        statuses = choices_param(status, DIAGNOSIS_STATUSES, "status")
+        if user_id and not UUID_PATTERN.match(user_id.lower()):
+            raise HTTPException(status_code=400, detail="Invalid user_id")
+
+        def filters(query):
+            if since_at:
+                query = query.gte("created_at", since_at)
+            if until_at:
+                query = query.lt("created_at", until_at)
+            if statuses:
+                query = query.in_("status", statuses)
+            if user_id:
+                query = query.eq("user_id", user_id.lower())
+            return query
+
+        details = {"since": since_at, "until": until_at, "status": statuses, "user_id": user_id}
+        return await _export_response(request, user, "diagnoses", "diagnoses", format, compression, filters, details)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error exporting diagnoses: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/admin/export/users")
+async def export_users(
+    request: Request,
+    format: str = Query("ndjson"),
+    compression: str = Query("gzip"),
+    since: Optional[str] = Query(None, description="Created at or after (ISO 8601)"),
+    until: Optional[str] = Query(None, description="Created before (ISO 8601)"),
+    role: Optional[str] = Query(None, description="Comma-separated roles"),
+    approved: Optional[bool] = Query(None),
+    user: dict = Depends(get_current_user)
+):
+    """
+    Stream user profiles (oldest first) as NDJSON or CSV, gzip-compressed
+    unless compression=none. Super Admin only.
+    """
+    try:
+        since_at, until_at = timestamp_param(since, "since"), timestamp_param(until, "until")
+        roles = choices_param(role, PROFILE_ROLES, "role")
+
+        def filters(query):
+            if since_at:
+                query = query.gte("created_at", since_at)
+            if until_at:
+                query = query.lt("created_at", until_at)
+            if roles:
+                query = query.in_("role", roles)
+            if approved is not None:
+                query = query.eq("approved", approved)
+            return query
+
+        details = {"since": since_at, "until": until_at, "role": roles, "approved": approved}
+        return await _export_response(request, user, "profiles", "users", format, compression, filters, details)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error exporting users: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/profiles/resolve")
+async def resolve_profiles(
+    ids: List[str] = Body(..., embed=True),
+    user: dict = Depends(get_current_user)
+):
+    """
+    Display fields (name, username, email, role) for up to PROFILE_RESOLVE_MAX_IDS
+    user ids in one call, keyed by id; ids without a profile are listed in "missing"
+    """
+    try:
+        if len(ids) > PROFILE_RESOLVE_MAX_IDS:
+            raise HTTPException(status_code=422, detail=f"At most {PROFILE_RESOLVE_MAX_IDS} ids per request")
+        ids = [str(user_id).lower() for user_id in ids]
+        profiles = await _profile_cache.resolve([user_id for user_id in ids if UUID_PATTERN.match(user_id)])
+        return {
+            "profiles": profiles,
+            "missing": [user_id for user_id in dict.fromkeys(ids) if user_id not in profiles]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error resolving profiles: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/api/profiles/{user_id}")
 async def get_profile_username(user_id: str):
-    resp = supabase.table("profiles").select("username, email").eq("id", user_id).single().execute()
-    if not resp.data:
+    user_id = user_id.lower()
+    profiles = await _profile_cache.resolve([user_id]) if UUID_PATTERN.match(user_id) else {}
+    if user_id not in profiles:
         raise HTTPException(status_code=404, detail="User not found")
-    return resp.data
+    return {"username": profiles[user_id]["username"], "email": profiles[user_id]["email"]}
+
+# ---------------- Conversations ----------------
+# Inboxes are read from the conversations summary (conversation-index.sql),
+# which a trigger on messages keeps current: one row per conversation and
+# participant with the last message and that participant's unread count.
+# History is paged with keyset cursors, so neither grows with message volume.
+CONVERSATION_PAGE_MAX = 100
+
+def _encode_cursor(at: str, row_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([at, row_id]).encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor: str):
+    try:
+        at, row_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        datetime.fromisoformat(str(at).replace("Z", "+00:00"))
+        if not UUID_PATTERN.match(str(row_id)):
+            raise ValueError(row_id)
+        return at, row_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _peer_id(peer_id: str) -> str:
+    peer_id = peer_id.lower()
+    if not UUID_PATTERN.match(peer_id):
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return peer_id
+
+@app.get("/api/conversations")
+async def list_conversations(
+    limit: int = Query(30, ge=1, le=CONVERSATION_PAGE_MAX),
+    cursor: Optional[str] = Query(None),
+    user: dict = Depends(get_current_user)
+):
+    """
+    The current user's conversations, most recent first, each with the peer's
+    display fields, the last message and the unread count. Pass next_cursor
+    back as cursor for the next page.
+    """
+    try:
+        await require_active_account(user['id'])
+        query = supabase.table("conversations").select("*").eq("user_id", user['id'])
+        if cursor:
+            at, peer_id = _decode_cursor(cursor)
+            query = query.or_(f'last_message_at.lt."{at}",and(last_message_at.eq."{at}",peer_id.lt.{peer_id})')
+        rows = query.order("last_message_at", desc=True).order("peer_id", desc=True).limit(limit + 1).execute().data or []
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        peers = await _profile_cache.resolve([row["peer_id"] for row in rows])
+        conversations = [{
+            "peer_id": row["peer_id"],
+            "peer": peers.get(row["peer_id"]),
+            "last_message": {
+                "id": row.get("last_message_id"),
+                "content": row.get("last_message_preview"),
+                "created_at": row["last_message_at"],
+                "from_me": row.get("last_message_from_me", False)
+            },
+            "unread_count": row.get("unread_count", 0),
+            "last_read_at": row.get("last_read_at")
+        } for row in rows]
+        return {
+            "conversations": conversations,
+            "next_cursor": _encode_cursor(rows[-1]["last_message_at"], rows[-1]["peer_id"]) if has_more else None
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error listing conversations: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/conversations/{peer_id}/messages")
+async def list_conversation_messages(
+    peer_id: str,
+    limit: int = Query(50, ge=1, le=CONVERSATION_PAGE_MAX),
+    before: Optional[str] = Query(None),
+    user: dict = Depends(get_current_user)
+):
+    """
+    One page of the conversation with peer_id, newest first. Pass next_cursor
+    back as before to load older messages.
+    """
+    try:
+        await require_active_account(user['id'])
+        params = {"me": user['id'], "peer": _peer_id(peer_id), "page_size": limit + 1}
+        if before:
+            params["before_at"], params["before_id"] = _decode_cursor(before)
+        rows = supabase.rpc("conversation_messages", params).execute().data or []
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        return {
+            "messages": rows,
+            "next_cursor": _encode_cursor(rows[-1]["created_at"], rows[-1]["id"]) if has_more else None
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error loading conversation messages: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/conversations/{peer_id}/read")
+async def mark_conversation_read(peer_id: str, user: dict = Depends(get_current_user)):
+    """
+    Reset the unread count of the conversation with peer_id
+    """
+    try:
+        await require_active_account(user['id'])
+        supabase.table("conversations").update({
+            "unread_count": 0,
+            "last_read_at": datetime.now().isoformat()
+        }).eq("user_id", user['id']).eq("peer_id", _peer_id(peer_id)).execute()
+        return {"message": "Conversation marked as read", "unread_count": 0}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error marking conversation read: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ---------------- Ask AI ----------------
+# Answers come from AskAIService (ask_ai.py): a normalised (question, context,
+# model) cache shared by all workers, and one shared generation per question
+# while it is being answered. With `Accept: text/event-stream` the answer is
+# streamed as "token" events followed by "done" (or "error"); otherwise the
+# full answer is returned as JSON once it is complete.
+@app.post("/api/ask-ai")
+async def ask_ai(
+    request: Request,
+    question: str = Body(...),
+    context: Optional[str] = Body(""),
+    user: dict = Depends(get_current_user)
+):
+    """
+    Answer a question about imaging findings, streamed when the client accepts
+    text/event-stream
+    """
+    question, context = question.strip(), (context or "").strip()
+    if not question:
+        raise HTTPException(status_code=400, detail="Missing question")
+    if len(question) > ASK_AI_MAX_QUESTION_CHARS or len(context) > ASK_AI_MAX_CONTEXT_CHARS:
+        raise HTTPException(status_code=413, detail="Question or context is too long")
+    try:
+        await require_active_account(user['id'])
+        service = shared_service()
+        generation = await run_in_threadpool(service.ask, question, context)
+    except HTTPException:
+        raise
+    except AskAIUnavailableError as e:
+        raise HTTPException(status_code=503, detail=f"Ask AI is not available: {e}")
+    except Exception as e:
+        print(f"Error starting Ask AI answer: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if "text/event-stream" not in request.headers.get("accept", ""):
+        try:
+            answer = "".join([chunk async for chunk in answer_chunks(generation)])
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Timed out waiting for the answer")
+        except Exception as e:
+            print(f"Error answering Ask AI question: {e}")
+            raise HTTPException(status_code=502, detail="Failed to get answer")
+        return {"answer": answer, "cached": generation.cached, "model": generation.model}
+
+    async def stream():
+        try:
+            async for chunk in answer_chunks(generation):
+                yield sse_event("token", {"text": chunk})
+            yield sse_event("done", {"cached": generation.cached, "model": generation.model})
+        except asyncio.TimeoutError:
+            yield sse_event("error", {"error": "Timed out waiting for the answer"})
+        except Exception as e:
+            print(f"Error streaming Ask AI answer: {e}")
+            yield sse_event("error", {"error": "Failed to get answer"})
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=headers)
+
+@app.on_event("shutdown")
+async def _close_ask_ai():
+    close_shared_service()
@@ -0,0 +1,113 @@
+"""
+Display profiles (name, username, email, role) for views that list many users
+at once, such as conversations and admin pages, behind /api/profiles/resolve.
+
+    profiles = ProfileCache(supabase)
+    found = await profiles.resolve(ids)   # {id: display profile} for ids that exist
+
+Profiles are served from a per-worker TTL cache shared by all requests. Misses
+from requests arriving within PROFILE_BATCH_WINDOW_MS of each other are
+resolved together, with one `id IN (...)` query per chunk. Unknown ids are
+cached briefly too, and admin changes to a profile invalidate it.
+"""
+import asyncio
+import collections
+import os
+import re
+import time
+
+from fastapi.concurrency import run_in_threadpool
+
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "60"))
+PROFILE_CACHE_MISSING_TTL = float(os.getenv("PROFILE_CACHE_MISSING_TTL", "10"))
+PROFILE_CACHE_MAX = int(os.getenv("PROFILE_CACHE_MAX", "20000"))
+PROFILE_RESOLVE_MAX_IDS = int(os.getenv("PROFILE_RESOLVE_MAX_IDS", "500"))
+PROFILE_BATCH_WINDOW_MS = float(os.getenv("PROFILE_BATCH_WINDOW_MS", "2"))
+PROFILE_QUERY_CHUNK = 200
+PROFILE_DISPLAY_FIELDS = "id, username, email, first_name, last_name, role"
+UUID_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+
+def display_profile(row: dict) -> dict:
+    full_name = " ".join(part for part in (row.get("first_name"), row.get("last_name")) if part).strip()
+    return {**row, "display_name": full_name or row.get("username") or row.get("email") or "User"}
+
+
+class ProfileCache:
+    """Only touched from the event loop, so it needs no locking"""
+
+    def __init__(self, client):
+        self.client = client
+        self.entries = collections.OrderedDict()  # id -> (expires_at, profile or None)
+        self.pending = {}                         # id -> Future filled by the next batched query
+        self.flush_handle = None
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "queries": 0, "invalidations": 0}
+
+    def _cached(self, user_id: str):
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] <= time.monotonic():
+            return False, None
+        self.entries.move_to_end(user_id)
+        return True, entry[1]
+
+    def _store(self, user_id: str, profile):
+        ttl = PROFILE_CACHE_TTL if profile is not None else PROFILE_CACHE_MISSING_TTL
+        self.entries[user_id] = (time.monotonic() + ttl, profile)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > PROFILE_CACHE_MAX:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id: str):
+        if self.entries.pop(user_id, None) is not None:
+            self.counters["invalidations"] += 1
+
+    async def resolve(self, ids: list) -> dict:
+        """{id: display profile} for the ids that exist"""
+        loop = asyncio.get_running_loop()
+        found, waiting = {}, {}
+        for user_id in dict.fromkeys(ids):
+            hit, profile = self._cached(user_id)
+            if hit:
+                self.counters["hits"] += 1
+                if profile is not None:
+                    found[user_id] = profile
+                continue
+            future = self.pending.get(user_id)
+            if future is None:
+                self.counters["misses"] += 1
+                future = self.pending[user_id] = loop.create_future()
+                if self.flush_handle is None:
+                    self.flush_handle = loop.call_later(PROFILE_BATCH_WINDOW_MS / 1000,
+                                                        lambda: asyncio.ensure_future(self._flush()))
+            else:
+                self.counters["coalesced"] += 1
+            waiting[user_id] = future
+        if waiting:
+            results = await asyncio.gather(*(asyncio.shield(f) for f in waiting.values()))
+            found.update((user_id, profile) for user_id, profile in zip(waiting, results) if profile is not None)
+        return found
+
+    async def _flush(self):
+        batch, self.pending, self.flush_handle = self.pending, {}, None
+        ids = list(batch)
+        try:
+            rows = []
+            for offset in range(0, len(ids), PROFILE_QUERY_CHUNK):
+                chunk = ids[offset:offset + PROFILE_QUERY_CHUNK]
+                self.counters["queries"] += 1
+                response = await run_in_threadpool(
+                    lambda: self.client.table("profiles").select(PROFILE_DISPLAY_FIELDS).in_("id", chunk).execute())
+                rows.extend(response.data or [])
+            by_id = {row["id"]: display_profile(row) for row in rows}
+            for user_id, future in batch.items():
+                self._store(user_id, by_id.get(user_id))
+                if not future.done():
+                    future.set_result(by_id.get(user_id))
+        except Exception as e:
+            print(f"[profiles] Resolving {len(ids)} profiles failed: {e}")
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+
+    def metrics(self) -> dict:
+        return {"entries": len(self.entries), "pending": len(self.pending), **self.counters}
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Build an INT8 copy of the serving model and compare it against FP32.
+
+    # dynamic (weights only, no data needed)
+    python quantize_model.py quantize --mode dynamic
+
+    # static, calibrated on a folder of representative X-rays
+    python quantize_model.py quantize --mode static --calibration-dir ./calib
+
+    # accuracy / latency / memory report over a folder of images
+    python quantize_model.py compare --images ./val --report int8_report.json
+
+The INT8 file is written next to the FP32 model as `<name>.int8.onnx`, which is
+where the API looks for it when MODEL_VARIANT=int8. Model discovery, preprocessing
+and session options come from the `inference` package the API serves with.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.dirname(__file__))
+
+from inference import DEFAULT_LABELS, apply_thread_budget, preprocess, sigmoid  # noqa: E402
+from inference import runtime  # noqa: E402
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".dcm")
+
+
+def _list_images(folder: str, limit: int = None):
+    paths = []
+    for root, _, files in os.walk(folder):
+        for fname in sorted(files):
+            if fname.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, fname))
+    paths.sort()
+    return paths[:limit] if limit else paths
+
+
+def _load_image(path: str) -> np.ndarray:
+    if path.lower().endswith(".dcm"):
+        import pydicom
+        return pydicom.dcmread(path).pixel_array.astype(np.float32)
+    return np.array(Image.open(path).convert("RGB"))
+
+
+def _export_onnx(model_path: str) -> str:
+    """Export a .pt/.pth checkpoint to ONNX so it can be quantised"""
+    onnx_path = os.path.splitext(model_path)[0] + ".onnx"
+    if os.path.exists(onnx_path):
+        return onnx_path
+    print(f"[quantize] Exporting {model_path} -> {onnx_path}")
+    runtime.export_torch_to_onnx(runtime.load_torch_checkpoint(model_path), onnx_path)
+    return onnx_path
+
+
+class _ImageCalibrationReader:
+    """Feeds preprocessed calibration images to onnxruntime's static quantiser"""
+
+    def __init__(self, input_name: str, paths):
+        self.input_name = input_name
+        self.paths = iter(paths)
+
+    def get_next(self):
+        for path in self.paths:
+            try:
+                return {self.input_name: preprocess(_load_image(path))}
+            except Exception as e:
+                print(f"[quantize] Skipping {path}: {e}")
+        return None
+
+
+def quantize(args):
+    from onnxruntime import InferenceSession
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+    model_path = args.model or runtime.discover_model_path()
+    if not model_path:
+        raise SystemExit("No model found. Set MODEL_PATH or place file under backend/models/")
+    if not model_path.lower().endswith(".onnx"):
+        model_path = _export_onnx(model_path)
+    output = args.output or runtime.quantized_model_path(model_path)
+
+    # Shape inference + graph cleanup gives the quantiser more nodes to work with
+    source = model_path
+    prepared = os.path.splitext(output)[0] + ".prep.onnx"
+    try:
+        from onnxruntime.quantization.shape_inference import quant_pre_process
+        quant_pre_process(model_path, prepared)
+        source = prepared
+    except Exception as e:
+        print(f"[quantize] Pre-processing skipped: {e}")
+
+    try:
+        if args.mode == "dynamic":
+            quantize_dynamic(source, output, weight_type=QuantType.QInt8, per_channel=args.per_channel)
+        else:
+            if not args.calibration_dir:
+                raise SystemExit("--calibration-dir is required for static quantisation")
+            paths = _list_images(args.calibration_dir, args.calibration_limit)
+            if not paths:
+                raise SystemExit(f"No images found in {args.calibration_dir}")
+            input_name = InferenceSession(source, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+            print(f"[quantize] Calibrating on {len(paths)} images")
+            quantize_static(
+                source, output, _ImageCalibrationReader(input_name, paths),
+                quant_format=QuantFormat.QDQ,
+                activation_type=QuantType.QUInt8,
+                weight_type=QuantType.QInt8,
+                per_channel=args.per_channel,
+            )
+    finally:
+        if source == prepared and os.path.exists(prepared):
+            os.remove(prepared)
+
+    fp32_mb = os.path.getsize(model_path) / 1e6
+    int8_mb = os.path.getsize(output) / 1e6
+    print(f"[quantize] Wrote {output} ({args.mode}): {fp32_mb:.1f} MB -> {int8_mb:.1f} MB")
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def _auc(scores: np.ndarray, targets: np.ndarray):
+    """Rank-based ROC AUC; None when only one class is present"""
+    pos = targets.sum()
+    neg = len(targets) - pos
+    if pos == 0 or neg == 0:
+        return None
+    order = scores.argsort()
+    ranks = np.empty(len(scores), dtype=np.float64)
+    ranks[order] = np.arange(1, len(scores) + 1)
+    # average ranks for ties
+    for value in np.unique(scores):
+        tied = scores == value
+        if tied.sum() > 1:
+            ranks[tied] = ranks[tied].mean()
+    return float((ranks[targets == 1].sum() - pos * (pos + 1) / 2) / (pos * neg))
+
+
+def _profile_variant(model_path: str, inputs):
+    rss_before = _rss_mb()
+    session = runtime.create_onnx_session(model_path)
+    input_name = session.get_inputs()[0].name
+    session.run(None, {input_name: inputs[0]})  # warm-up
+    rss_after = _rss_mb()
+
+    probs, latencies = [], []
+    for inp in inputs:
+        start = time.perf_counter()
+        logits = session.run(None, {input_name: inp})[0]
+        latencies.append((time.perf_counter() - start) * 1000)
+        probs.append(sigmoid(logits.reshape(-1)))
+    lat = np.array(latencies)
+    return np.stack(probs), {
+        "model": model_path,
+        "file_mb": round(os.path.getsize(model_path) / 1e6, 2),
+        "session_rss_mb": round(rss_after - rss_before, 1),
+        "latency_ms": {
+            "mean": round(float(lat.mean()), 2),
+            "p50": round(float(np.percentile(lat, 50)), 2),
+            "p95": round(float(np.percentile(lat, 95)), 2),
+        },
+    }
+
+
+def compare(args):
+    fp32_path = args.fp32 or runtime.discover_model_path()
+    if not fp32_path:
+        raise SystemExit("No model found. Set MODEL_PATH or place file under backend/models/")
+    if not fp32_path.lower().endswith(".onnx"):
+        fp32_path = _export_onnx(fp32_path)
+    int8_path = args.int8 or runtime.quantized_model_path(fp32_path)
+    if not os.path.exists(int8_path):
+        raise SystemExit(f"{int8_path} not found; run `quantize` first")
+
+    paths = _list_images(args.images, args.limit)
+    if not paths:
+        raise SystemExit(f"No images found in {args.images}")
+    inputs = []
+    for path in paths:
+        try:
+            inputs.append(preprocess(_load_image(path)))
+        except Exception as e:
+            print(f"[compare] Skipping {path}: {e}")
+    if not inputs:
+        raise SystemExit(f"None of the {len(paths)} images in {args.images} could be loaded")
+    print(f"[compare] Scoring {len(inputs)} images with FP32 and INT8")
+
+    fp32_probs, fp32_stats = _profile_variant(fp32_path, inputs)
+    int8_probs, int8_stats = _profile_variant(int8_path, inputs)
+
+    # FP32 decisions act as the reference labels
+    labels = DEFAULT_LABELS
+    per_label = []
+    for idx in range(fp32_probs.shape[1]):
+        ref = (fp32_probs[:, idx] > args.threshold).astype(np.int64)
+        got = (int8_probs[:, idx] > args.threshold).astype(np.int64)
+        auc = _auc(int8_probs[:, idx], ref)
+        per_label.append({
+            "label": labels[idx] if idx < len(labels) else f"Finding_{idx}",
+            "agreement": round(float((ref == got).mean()), 4),
+            "auc_vs_fp32": round(auc, 4) if auc is not None else None,
+            "mean_abs_diff": round(float(np.abs(fp32_probs[:, idx] - int8_probs[:, idx]).mean()), 4),
+        })
+
+    top1_agreement = float((fp32_probs.argmax(axis=1) == int8_probs.argmax(axis=1)).mean())
+    report = {
+        "images": len(inputs),
+        "threshold": args.threshold,
+        "top1_agreement": round(top1_agreement, 4),
+        "fp32": fp32_stats,
+        "int8": int8_stats,
+        "speedup": round(fp32_stats["latency_ms"]["mean"] / max(int8_stats["latency_ms"]["mean"], 1e-6), 2),
+        "per_label": per_label,
+    }
+
+    print(f"\n{'label':<22}{'agree':>8}{'auc':>8}{'|diff|':>9}")
+    for row in per_label:
+        auc = f"{row['auc_vs_fp32']:.3f}" if row["auc_vs_fp32"] is not None else "n/a"
+        print(f"{row['label']:<22}{row['agreement']:>8.3f}{auc:>8}{row['mean_abs_diff']:>9.4f}")
+    print(f"\nTop-1 agreement: {top1_agreement:.3f}")
+    for name, stats in (("FP32", fp32_stats), ("INT8", int8_stats)):
+        lat = stats["latency_ms"]
+        print(f"{name}: mean {lat['mean']} ms, p95 {lat['p95']} ms, file {stats['file_mb']} MB, session RSS {stats['session_rss_mb']} MB")
+    print(f"Speedup: {report['speedup']}x")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.report}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="INT8 quantisation tooling for the Clarix model")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    q = sub.add_parser("quantize", help="Produce an INT8 model")
+    q.add_argument("--mode", choices=["dynamic", "static"], default="dynamic")
+    q.add_argument("--model", help="FP32 model (defaults to the one the API serves)")
+    q.add_argument("--output", help="Output path (defaults to <model>.int8.onnx)")
+    q.add_argument("--calibration-dir", help="Images used to calibrate static quantisation")
+    q.add_argument("--calibration-limit", type=int, default=200)
+    q.add_argument("--per-channel", action="store_true")
+    q.set_defaults(func=quantize)
+
+    c = sub.add_parser("compare", help="Compare INT8 against FP32 on a folder of images")
+    c.add_argument("--images", required=True)
+    c.add_argument("--fp32")
+    c.add_argument("--int8")
+    c.add_argument("--limit", type=int)
+    c.add_argument("--threshold", type=float, default=0.5)
+    c.add_argument("--report", help="Write the JSON report here")
+    c.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    apply_thread_budget()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,362 @@
+"""
+Access to images in the `medical-images` storage bucket through a size-bounded
+on-disk LRU cache, so re-scoring, heatmaps and derivatives don't download the
+same multi-MB film from Supabase every time.
+
+    cache = ImageCache(bucket_from_env(supabase))
+    with cache.open("user-id/study.dcm") as f:
+        ...
+
+Blobs are stored once per content hash (sha256) under IMAGE_CACHE_DIR/blobs;
+an SQLite index maps bucket paths to hashes and records last access for LRU
+eviction. Downloads go to a temp file and are renamed into place, so a reader
+never sees a partial blob, and concurrent requests for the same path share one
+download. With STORAGE_BACKEND=local the bucket is a plain directory
+(STORAGE_LOCAL_ROOT), which stands in for Supabase in offline runs and tests.
+"""
+import contextlib
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+STORAGE_BUCKET = os.getenv("STORAGE_BUCKET", "medical-images")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase").lower()  # supabase | local
+STORAGE_LOCAL_ROOT = os.getenv("STORAGE_LOCAL_ROOT") or os.path.join(BACKEND_DIR, "storage", STORAGE_BUCKET)
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR") or os.path.join(BACKEND_DIR, ".image_cache")
+IMAGE_CACHE_MB = float(os.getenv("IMAGE_CACHE_MB", "2048"))
+IMAGE_PREFETCH_WORKERS = int(os.getenv("IMAGE_PREFETCH_WORKERS", "2"))
+CHUNK_SIZE = 1024 * 1024
+
+
+class StorageError(Exception):
+    """The bucket could not be read"""
+
+
+class ObjectNotFound(StorageError):
+    """No object at that path"""
+
+
+def normalize_path(path: str) -> str:
+    """Bucket paths are relative, '/'-separated and may not climb out of the bucket"""
+    parts = [p for p in path.replace("\\", "/").split("/") if p not in ("", ".")]
+    if not parts or ".." in parts:
+        raise ObjectNotFound(f"Invalid storage path: {path!r}")
+    return "/".join(parts)
+
+
+class SupabaseBucket:
+    """A Supabase storage bucket, read with the service-role client"""
+
+    def __init__(self, client, bucket: str = STORAGE_BUCKET):
+        self.client = client
+        self.bucket = bucket
+
+    def download(self, path: str, dest):
+        try:
+            data = self.client.storage.from_(self.bucket).download(normalize_path(path))
+        except Exception as e:
+            detail = e.args[0] if e.args and isinstance(e.args[0], dict) else {}
+            if str(detail.get("statusCode")) in ("400", "404") or "not found" in str(e).lower():
+                raise ObjectNotFound(f"{self.bucket}/{path} not found") from e
+            raise StorageError(f"Download of {self.bucket}/{path} failed: {e}") from e
+        dest.write(data)
+
+    def upload(self, path: str, data: bytes, content_type: str = None):
+        options = {"upsert": "true"}
+        if content_type:
+            options["content-type"] = content_type
+        try:
+            self.client.storage.from_(self.bucket).upload(normalize_path(path), data, options)
+        except Exception as e:
+            raise StorageError(f"Upload of {self.bucket}/{path} failed: {e}") from e
+
+    def describe(self) -> str:
+        return f"supabase:{self.bucket}"
+
+
+class LocalBucket:
+    """A directory standing in for the bucket (offline runs and tests)"""
+
+    def __init__(self, root: str = STORAGE_LOCAL_ROOT):
+        self.root = root
+
+    def _full_path(self, path: str) -> str:
+        return os.path.join(self.root, *normalize_path(path).split("/"))
+
+    def download(self, path: str, dest):
+        try:
+            with open(self._full_path(path), "rb") as src:
+                shutil.copyfileobj(src, dest, CHUNK_SIZE)
+        except FileNotFoundError as e:
+            raise ObjectNotFound(f"{path} not found in {self.root}") from e
+        except OSError as e:
+            raise StorageError(f"Reading {path} from {self.root} failed: {e}") from e
+
+    def upload(self, path: str, data: bytes, content_type: str = None):
+        # Write next to the object and rename into place, so readers never see a partial file
+        full_path = self._full_path(path)
+        try:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(full_path), prefix=".", suffix=".part")
+        except OSError as e:
+            raise StorageError(f"Writing {path} to {self.root} failed: {e}") from e
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, full_path)
+        except BaseException as e:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            if isinstance(e, OSError):
+                raise StorageError(f"Writing {path} to {self.root} failed: {e}") from e
+            raise
+
+    def describe(self) -> str:
+        return f"local:{self.root}"
+
+
+def bucket_from_env(client=None):
+    """The bucket STORAGE_BACKEND selects; `client` is the Supabase client for the default backend"""
+    if STORAGE_BACKEND == "local":
+        return LocalBucket(STORAGE_LOCAL_ROOT)
+    if client is None:
+        raise StorageError("STORAGE_BACKEND=supabase needs a Supabase client")
+    return SupabaseBucket(client, STORAGE_BUCKET)
+
+
+class _HashingWriter:
+    """File wrapper that hashes and counts what the bucket writes through it"""
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+
+class ImageCache:
+    """
+    Bucket reads through an on-disk LRU cache of at most `max_bytes`.
+    Safe to share between threads; several processes may share one cache_dir
+    (writes are atomic renames, the index is SQLite), though they don't
+    coalesce downloads with each other.
+    """
+
+    def __init__(self, bucket, cache_dir: str = IMAGE_CACHE_DIR, max_bytes: int = int(IMAGE_CACHE_MB * 1024 * 1024),
+                 prefetch_workers: int = IMAGE_PREFETCH_WORKERS):
+        self.bucket = bucket
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.prefetch_workers = prefetch_workers
+        self._blob_dir = os.path.join(cache_dir, "blobs")
+        self._tmp_dir = os.path.join(cache_dir, "tmp")
+        os.makedirs(self._blob_dir, exist_ok=True)
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._executor = None
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "errors": 0, "prefetched": 0}
+        self._db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite3"), timeout=30, check_same_thread=False)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS paths (
+                path TEXT PRIMARY KEY,
+                digest TEXT NOT NULL REFERENCES blobs(digest),
+                fetched_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS blobs_lru ON blobs(last_access);
+        """)
+        self._db.commit()
+        self._sweep_tmp()
+
+    def _sweep_tmp(self):
+        """Remove temp files left by a process that died mid-download"""
+        cutoff = time.time() - 3600
+        for name in os.listdir(self._tmp_dir):
+            full_path = os.path.join(self._tmp_dir, name)
+            with contextlib.suppress(OSError):
+                if os.path.getmtime(full_path) < cutoff:
+                    os.remove(full_path)
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self._blob_dir, digest[:2], digest)
+
+    def _lookup(self, path: str):
+        """Cached blob for `path` (touching it for LRU), or None. Caller holds _lock."""
+        row = self._db.execute("SELECT digest FROM paths WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        blob_path = self._blob_path(row[0])
+        if not os.path.exists(blob_path):
+            # Evicted by another process sharing the directory
+            self._db.execute("DELETE FROM paths WHERE path = ?", (path,))
+            self._db.commit()
+            return None
+        self._db.execute("UPDATE blobs SET last_access = ? WHERE digest = ?", (time.time(), row[0]))
+        self._db.commit()
+        return blob_path
+
+    def _download(self, path: str) -> str:
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                writer = _HashingWriter(f)
+                self.bucket.download(path, writer)
+                f.flush()
+                os.fsync(f.fileno())
+            digest = writer.digest.hexdigest()
+            blob_path = self._blob_path(digest)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(tmp_path, blob_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO blobs (digest, size, last_access) VALUES (?, ?, ?) "
+                "ON CONFLICT(digest) DO UPDATE SET last_access = excluded.last_access",
+                (digest, writer.size, now),
+            )
+            self._db.execute(
+                "INSERT INTO paths (path, digest, fetched_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET digest = excluded.digest, fetched_at = excluded.fetched_at",
+                (path, digest, now),
+            )
+            self._db.commit()
+            self._evict(keep=digest)
+        print(f"[storage] Cached {path} ({writer.size / 1e6:.1f} MB, {digest[:12]})")
+        return blob_path
+
+    def _evict(self, keep: str = None):
+        """Drop least recently used blobs until the cache fits. Caller holds _lock."""
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for digest, size in self._db.execute("SELECT digest, size FROM blobs ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            if digest == keep:
+                continue
+            # Open readers keep their file; the name goes away
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._blob_path(digest))
+            self._db.execute("DELETE FROM paths WHERE digest = ?", (digest,))
+            self._db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            total -= size
+            self.counters["evictions"] += 1
+        self._db.commit()
+
+    def fetch(self, path: str) -> str:
+        """Local file holding `path`, downloading it on a miss. Prefer open(): eviction may remove this name."""
+        path = normalize_path(path)
+        with self._lock:
+            blob_path = self._lookup(path)
+            if blob_path is not None:
+                self.counters["hits"] += 1
+                return blob_path
+            future = self._inflight.get(path)
+            owner = future is None
+            if owner:
+                future = self._inflight[path] = Future()
+                self.counters["misses"] += 1
+            else:
+                self.counters["coalesced"] += 1
+        if not owner:
+            return future.result()
+        try:
+            blob_path = self._download(path)
+            future.set_result(blob_path)
+            return blob_path
+        except BaseException as e:
+            with self._lock:
+                self.counters["errors"] += 1
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(path, None)
+
+    def open(self, path: str):
+        """Open the cached copy of `path` for reading (binary)"""
+        for _ in range(3):
+            blob_path = self.fetch(path)
+            try:
+                return open(blob_path, "rb")
+            except FileNotFoundError:
+                # Evicted between fetch and open; the index forgets it, so fetch again
+                with self._lock:
+                    self._lookup(normalize_path(path))
+        raise StorageError(f"Could not keep {path} in the cache (IMAGE_CACHE_MB too small?)")
+
+    def read(self, path: str) -> bytes:
+        with self.open(path) as f:
+            return f.read()
+
+    def contains(self, path: str) -> bool:
+        with self._lock:
+            return self._lookup(normalize_path(path)) is not None
+
+    def upload(self, path: str, data: bytes, content_type: str = None):
+        """Write `path` to the bucket; a cached copy of the old object is forgotten"""
+        self.bucket.upload(path, data, content_type)
+        self.invalidate(path)
+
+    def invalidate(self, path: str):
+        """Forget `path` (e.g. after the object was replaced); its blob is evicted normally"""
+        with self._lock:
+            self._db.execute("DELETE FROM paths WHERE path = ?", (normalize_path(path),))
+            self._db.commit()
+
+    def _prefetch_one(self, path: str):
+        try:
+            if not self.contains(path):
+                self.fetch(path)
+                with self._lock:
+                    self.counters["prefetched"] += 1
+        except Exception as e:
+            print(f"[storage] Prefetch of {path} failed: {e}")
+
+    def prefetch(self, paths) -> list:
+        """Warm the cache for `paths` in the background; returns the futures"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=max(self.prefetch_workers, 1), thread_name_prefix="prefetch")
+        return [self._executor.submit(self._prefetch_one, path) for path in dict.fromkeys(p for p in paths if p)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+            paths = self._db.execute("SELECT COUNT(*) FROM paths").fetchone()[0]
+            return {
+                "bucket": self.bucket.describe(),
+                "cache_dir": self.cache_dir,
+                "blobs": entries,
+                "paths": paths,
+                "size_mb": round(total / 1024 / 1024, 1),
+                "max_mb": round(self.max_bytes / 1024 / 1024, 1),
+                "downloading": len(self._inflight),
+                **self.counters,
+            }
@@ -0,0 +1,214 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import admission
+from admission import AdmissionController, DegradationPolicy, RequestDeadline
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(admission, "USER_MAX_CONCURRENT", 2)
+    monkeypatch.setattr(admission, "ROLE_MAX_CONCURRENT", {"doctor": 3})
+    monkeypatch.setattr(admission, "INFERENCE_QUEUE_TIMEOUT", 5.0)
+
+
+async def _occupy(controller, user, role, release: asyncio.Event, deadline=None):
+    async with controller.slot(user, role, deadline):
+        await release.wait()
+
+
+async def _rejection(controller, user, role):
+    with pytest.raises(HTTPException) as e:
+        async with controller.slot(user, role):
+            pass
+    return e.value
+
+
+def test_user_and_role_quotas():
+    async def scenario():
+        controller = AdmissionController(concurrency=4, queue_depth=4)
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(_occupy(controller, "alice", "user", release)) for _ in range(2)]
+        tasks += [asyncio.create_task(_occupy(controller, f"doc{i}", "doctor", release)) for i in range(3)]
+        await asyncio.sleep(0.01)
+        user_limited = await _rejection(controller, "alice", "user")
+        role_limited = await _rejection(controller, "doc9", "doctor")
+        release.set()
+        await asyncio.gather(*tasks)
+        return controller, user_limited, role_limited
+
+    controller, user_limited, role_limited = asyncio.run(scenario())
+    assert user_limited.status_code == 429
+    assert role_limited.status_code == 429
+    assert controller.counters["rejected_user_quota"] == 1
+    assert controller.counters["rejected_role_quota"] == 1
+    assert controller.per_user == {} and controller.per_role == {}
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    async def scenario():
+        controller = AdmissionController(concurrency=1, queue_depth=1)
+        controller.service_time_s = 3.0
+        release = asyncio.Event()
+        running = asyncio.create_task(_occupy(controller, "a", "user", release))
+        queued = asyncio.create_task(_occupy(controller, "b", "user", release))
+        await asyncio.sleep(0.01)
+        assert (controller.executing, controller.waiting) == (1, 1)
+        rejected = await _rejection(controller, "c", "user")
+        release.set()
+        await asyncio.gather(running, queued)
+        return controller, rejected
+
+    controller, rejected = asyncio.run(scenario())
+    assert rejected.status_code == 503
+    # One slot, this request behind the one already waiting: two service times
+    assert rejected.headers["Retry-After"] == "6"
+    assert controller.counters["rejected_queue_full"] == 1
+    assert controller.counters["completed"] == 2
+
+
+def test_queue_timeout(monkeypatch):
+    monkeypatch.setattr(admission, "INFERENCE_QUEUE_TIMEOUT", 0.05)
+
+    async def scenario():
+        controller = AdmissionController(concurrency=1, queue_depth=4)
+        release = asyncio.Event()
+        running = asyncio.create_task(_occupy(controller, "a", "user", release))
+        await asyncio.sleep(0.01)
+        rejected = await _rejection(controller, "b", "user")
+        release.set()
+        await running
+        return controller, rejected
+
+    controller, rejected = asyncio.run(scenario())
+    assert rejected.status_code == 503
+    assert "Retry-After" in rejected.headers
+    assert controller.counters["queue_timeouts"] == 1
+    assert controller._semaphore._value == 1
+
+
+def test_waiters_are_admitted_in_arrival_order():
+    async def scenario():
+        controller = AdmissionController(concurrency=1, queue_depth=8)
+        order = []
+
+        async def job(i):
+            async with controller.slot(f"user{i}", "user"):
+                order.append(i)
+                await asyncio.sleep(0.01)
+
+        tasks = []
+        for i in range(6):
+            tasks.append(asyncio.create_task(job(i)))
+            await asyncio.sleep(0.001)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == list(range(6))
+
+
+def test_cancelled_deadline_leaves_the_queue_and_frees_its_place():
+    async def scenario():
+        controller = AdmissionController(concurrency=1, queue_depth=4)
+        release = asyncio.Event()
+        deadline = RequestDeadline(30)
+        running = asyncio.create_task(_occupy(controller, "a", "user", release))
+        await asyncio.sleep(0.01)
+        abandoned = asyncio.create_task(_occupy(controller, "b", "user", release, deadline))
+        await asyncio.sleep(0.01)
+        deadline.cancel()
+        with pytest.raises(HTTPException) as e:
+            await abandoned
+        release.set()
+        await running
+        return controller, e.value
+
+    controller, error = asyncio.run(scenario())
+    assert error.status_code == 499
+    assert controller.waiting == 0
+    assert controller._semaphore._value == 1
+
+
+def _request(headers: dict) -> Request:
+    raw = [(name.lower().encode(), value.encode()) for name, value in headers.items()]
+    return Request({"type": "http", "headers": raw})
+
+
+def test_deadline_header_parsing(monkeypatch):
+    monkeypatch.setattr(admission, "INFERENCE_DEADLINE_SECONDS", 30.0)
+    assert RequestDeadline.from_request(_request({})).timeout_s == 30.0
+    assert RequestDeadline.from_request(_request({"x-request-timeout-ms": "1500"})).timeout_s == 1.5
+    # Capped by config, and never negative
+    assert RequestDeadline.from_request(_request({"x-request-timeout-ms": "600000"})).timeout_s == 30.0
+    assert RequestDeadline.from_request(_request({"X-Request-Timeout-Ms": "-5"})).timeout_s == 0.0
+    with pytest.raises(HTTPException) as e:
+        RequestDeadline.from_request(_request({"x-request-timeout-ms": "soon"}))
+    assert e.value.status_code == 400
+
+
+def test_deadline_check():
+    RequestDeadline(30).check("decode")
+    with pytest.raises(HTTPException) as expired:
+        RequestDeadline(0).check("decode")
+    cancelled = RequestDeadline(30)
+    cancelled.cancel()
+    with pytest.raises(HTTPException) as gone:
+        cancelled.check("decode")
+    assert expired.value.status_code == 504
+    assert gone.value.status_code == 499
+
+
+@pytest.fixture
+def thresholds(monkeypatch):
+    for name, value in {"DEGRADE_QUEUE_WAIT_MS": 2000, "DEGRADE_P95_MS": 5000, "RECOVER_QUEUE_WAIT_MS": 300,
+                        "RECOVER_P95_MS": 2000, "DEGRADE_MIN_DWELL_SECONDS": 15}.items():
+        monkeypatch.setattr(admission, name, value)
+
+
+def _dwell_elapsed(policy: DegradationPolicy):
+    policy.changed_at -= admission.DEGRADE_MIN_DWELL_SECONDS
+
+
+def test_degradation_waits_out_the_dwell_time(thresholds):
+    policy = DegradationPolicy("int8")
+    policy.observe(3.0, 6.0)
+    assert not policy.degraded
+    _dwell_elapsed(policy)
+    policy.observe(3.0, 6.0)
+    assert policy.degraded and policy.transitions == 1
+    # Load is gone, but the new state holds for the dwell time
+    policy.observe(0.0, 0.1)
+    assert policy.degraded
+
+
+def test_degradation_hysteresis(thresholds):
+    policy = DegradationPolicy("int8")
+    _dwell_elapsed(policy)
+    policy.observe(2.5, 1.0)
+    assert policy.degraded
+    # Between the recover and degrade thresholds: stays degraded
+    _dwell_elapsed(policy)
+    policy.observe(1.0, 1.0)
+    assert policy.degraded
+    _dwell_elapsed(policy)
+    policy.observe(0.1, 1.0)
+    assert policy.degraded  # p95 still sees the 1 s wait
+    policy.waits_ms.clear()
+    policy.latencies_ms.clear()
+    policy.observe(0.1, 1.0)
+    assert not policy.degraded and policy.transitions == 2
+    # Between the thresholds again, from the healthy side: stays healthy
+    _dwell_elapsed(policy)
+    policy.observe(1.0, 3.0)
+    assert not policy.degraded
+
+
+def test_degradation_is_off_without_a_fallback(thresholds):
+    policy = DegradationPolicy(None)
+    _dwell_elapsed(policy)
+    policy.observe(60.0, 60.0)
+    assert not policy.degraded
+    assert policy.metrics()["enabled"] is False
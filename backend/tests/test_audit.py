@@ -0,0 +1,125 @@
+import glob
+import json
+import os
+
+import pytest
+
+from audit import AuditLog
+
+
+class ConnectionLost(Exception):
+    """No `code`: the database was not reached"""
+
+
+class Rejected(Exception):
+    code = "23503"
+
+
+class FakeTable:
+    def __init__(self, db):
+        self.db = db
+        self.rows = None
+
+    def upsert(self, rows, on_conflict=None, ignore_duplicates=False):
+        self.rows = rows
+        return self
+
+    def execute(self):
+        if self.db.down:
+            raise ConnectionLost("connection refused")
+        if any(row["action"] == "bad" for row in self.rows):
+            raise Rejected("violates foreign key constraint")
+        for row in self.rows:
+            self.db.rows.setdefault(row["id"], row)
+
+
+class FakeClient:
+    def __init__(self):
+        self.rows = {}
+        self.down = False
+
+    def table(self, name):
+        return FakeTable(self)
+
+
+@pytest.fixture
+def audit(tmp_path):
+    client = FakeClient()
+    log = AuditLog(client, batch_size=3, flush_interval=3600, spill_dir=str(tmp_path))
+    yield client, log
+    log.close(timeout=1)
+
+
+def test_batches_are_written(audit):
+    client, log = audit
+    for i in range(7):
+        log.log("diagnosis.viewed", "u1", {"n": i})
+    log.flush()
+    assert len(client.rows) == 7
+    assert log.counters["written"] == 7
+    assert log.counters["batches"] == 3
+
+
+def test_rejected_rows_do_not_block_their_batch(audit):
+    client, log = audit
+    for action in ["ok", "bad", "ok"]:
+        log.log(action)
+    log.flush()
+    assert len(client.rows) == 2
+    assert log.counters["rejected"] == 1
+    assert log.counters["written"] + log.counters["rejected"] == log.counters["logged"]
+
+
+def test_outage_spills_then_replays_in_order(audit, tmp_path):
+    client, log = audit
+    client.down = True
+    for i in range(5):
+        log.log("admin.export", "u1", {"n": i})
+    log.flush()
+    assert client.rows == {}
+    assert log.counters["spilled"] == 5
+    spilled = [json.loads(line) for path in glob.glob(str(tmp_path / "*.jsonl")) for line in open(path)]
+    assert [row["details"]["n"] for row in spilled] == list(range(5))
+
+    # Still inside the backoff window: new events go straight to the spill file
+    log.log("admin.export", "u1", {"n": 5})
+    log.flush()
+    assert log.counters["spilled"] == 6
+
+    client.down = False
+    log.log("admin.export", "u1", {"n": 6})
+    log.close(timeout=1)
+    assert sorted(row["details"]["n"] for row in client.rows.values()) == list(range(7))
+    assert log.counters["written"] == 7
+    assert log.counters["replayed"] >= 6  # the flusher may spill the last event too while it stops
+    assert glob.glob(str(tmp_path / "*.jsonl*")) == []
+
+
+def test_replay_is_idempotent(audit, tmp_path):
+    client, log = audit
+    client.down = True
+    log.log("a")
+    log.flush()
+    spill = glob.glob(str(tmp_path / "*.jsonl"))[0]
+    copy = str(tmp_path / "spill-copy.jsonl")
+    with open(spill) as src, open(copy, "w") as dst:
+        dst.write(src.read())
+    client.down = False
+    log.close(timeout=1)
+    assert len(client.rows) == 1
+    assert not os.path.exists(spill) and not os.path.exists(copy)
+
+
+def test_full_spill_directory_drops_and_counts(tmp_path):
+    client = FakeClient()
+    client.down = True
+    log = AuditLog(client, batch_size=10, flush_interval=3600, spill_dir=str(tmp_path), spill_max_bytes=1)
+    try:
+        log.log("a")
+        log.flush()
+        log.log("b")
+        log.flush()
+        assert log.counters["spilled"] == 1
+        assert log.counters["dropped"] == 1
+    finally:
+        log.close(timeout=1)
@@ -0,0 +1,142 @@
+import json
+import re
+
+import pytest
+
+from backfill import BackfillJob
+
+
+class FakeQuery:
+    def __init__(self, db):
+        self.db = db
+        self.filters = []
+        self.count = None
+
+    def select(self, columns):
+        return self
+
+    def or_(self, expression):
+        # Only the form the job sends: model_version.is.null,model_version.neq.<version>
+        version = re.fullmatch(r"model_version\.is\.null,model_version\.neq\.(.+)", expression).group(1)
+        self.filters.append(lambda row: row["model_version"] is None or row["model_version"] != version)
+        self.db.log.append(("or", expression))
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row[column] == value)
+        return self
+
+    def gt(self, column, value):
+        self.filters.append(lambda row: row[column] > value)
+        self.db.log.append(("gt", value))
+        return self
+
+    def order(self, column):
+        assert column == "id"
+        return self
+
+    def limit(self, count):
+        self.count = count
+        return self
+
+    def execute(self):
+        rows = sorted((r for r in self.db.rows if all(f(r) for f in self.filters)), key=lambda r: r["id"])
+        return type("Response", (), {"data": [dict(r) for r in rows[:self.count]]})
+
+
+class FakeSupabase:
+    def __init__(self, rows):
+        self.rows = rows
+        self.log = []
+        self.applied = []
+
+    def table(self, name):
+        assert name == "diagnoses"
+        return FakeQuery(self)
+
+    def rpc(self, name, params):
+        assert name == "apply_prediction_backfill"
+        by_id = {row["id"]: row for row in self.rows}
+        for update in params["updates"]:
+            by_id[update["id"]]["model_version"] = update["model_version"]
+            self.applied.append(update["id"])
+        return type("Call", (), {"execute": lambda _: type("Response", (), {"data": len(params["updates"])})})()
+
+
+class FakeModel:
+    name = "v2"
+
+
+def _rows():
+    rows = []
+    for i in range(25):
+        rows.append({"id": f"{i:04d}", "image_path": f"u/{i}.png", "status": "completed",
+                     "model_version": "v2" if i % 5 == 0 else ("v1" if i % 2 else None)})
+    rows.append({"id": "0100", "image_path": "u/p.png", "status": "pending", "model_version": None})
+    return rows
+
+
+@pytest.fixture
+def scored(monkeypatch):
+    """Skip the model: every row of a page scores"""
+    calls = []
+
+    def score_page(self, rows, pool, scorer):
+        calls.append([row["id"] for row in rows])
+        if self.on_page is not None:
+            self.on_page(self)
+        return [{"id": row["id"], "model_version": self.model.name, "predictions": {}} for row in rows]
+
+    monkeypatch.setattr(BackfillJob, "on_page", None, raising=False)
+    monkeypatch.setattr(BackfillJob, "_score_page", score_page)
+    return calls
+
+
+def test_keyset_walk_reads_only_stale_completed_rows(tmp_path, scored):
+    db = FakeSupabase(_rows())
+    state = BackfillJob(db, None, FakeModel(), batch_size=4, rate=0, checkpoint_dir=str(tmp_path)).run()
+
+    stale = [r["id"] for r in _rows() if r["status"] == "completed" and r["model_version"] != "v2"]
+    assert sorted(db.applied) == db.applied == stale
+    assert all(len(page) <= 4 for page in scored)
+    assert ("or", "model_version.is.null,model_version.neq.v2") in db.log
+    # Each page starts after the last id of the previous one
+    assert [value for kind, value in db.log if kind == "gt"] == [page[-1] for page in scored]
+    assert state["scored"] == state["updated"] == len(stale)
+    assert state["finished_at"] is not None
+
+
+def test_paused_job_resumes_from_its_checkpoint(tmp_path, scored):
+    db = FakeSupabase(_rows())
+    job = BackfillJob(db, None, FakeModel(), batch_size=4, rate=0, checkpoint_dir=str(tmp_path))
+    job.on_page = lambda j: j.pause() if len(scored) == 2 else None
+    state = job.run()
+    assert state["finished_at"] is None
+    assert state["last_id"] == scored[1][-1]
+    with open(tmp_path / "v2.json") as f:
+        assert json.load(f)["last_id"] == state["last_id"]
+
+    db.log.clear()
+    resumed = BackfillJob(db, None, FakeModel(), batch_size=4, rate=0, checkpoint_dir=str(tmp_path))
+    assert resumed.state["last_id"] == state["last_id"]
+    final = resumed.run()
+    assert final["finished_at"] is not None
+    # No row is skipped or scored twice across the pause
+    assert len(db.applied) == len(set(db.applied)) == final["scored"]
+    assert [value for kind, value in db.log if kind == "gt"][0] == state["last_id"]
+
+
+def test_reset_starts_over(tmp_path, scored):
+    db = FakeSupabase(_rows())
+    BackfillJob(db, None, FakeModel(), batch_size=4, rate=0, checkpoint_dir=str(tmp_path)).run()
+    job = BackfillJob(db, None, FakeModel(), batch_size=4, rate=0, checkpoint_dir=str(tmp_path))
+    job.reset()
+    assert job.state["last_id"] is None and job.state["scored"] == 0
+    assert job._next_page() == []  # every completed row is on v2 now
+
+
+def test_unreadable_checkpoint_starts_fresh(tmp_path):
+    (tmp_path / "v2.json").write_text("{not json")
+    job = BackfillJob(FakeSupabase([]), None, FakeModel(), checkpoint_dir=str(tmp_path))
+    assert job.state["last_id"] is None
+    assert job.state["model_version"] == "v2"
@@ -0,0 +1,91 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from inference import MB, DecodePlan, decode_image, read_image_header
+from inference import decode_plan
+
+
+def _png(height, width, mode="L"):
+    buf = io.BytesIO()
+    Image.fromarray(np.zeros((height, width) if mode == "L" else (height, width, 3), dtype=np.uint8)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+@pytest.fixture
+def budget(monkeypatch):
+    def configure(mb, policy="downsample", max_side=2048):
+        monkeypatch.setattr(decode_plan, "INFERENCE_MEMORY_BUDGET_MB", mb)
+        monkeypatch.setattr(decode_plan, "MEMORY_OVER_BUDGET", policy)
+        monkeypatch.setattr(decode_plan, "DOWNSAMPLE_MAX_SIDE", max_side)
+    return configure
+
+
+def test_plan_from_png_header():
+    data = _png(300, 200, "RGB")
+    plan = DecodePlan.from_header(read_image_header(data, "png"), "png", len(data))
+    assert (plan.kind, plan.height, plan.width, plan.channels, plan.frames) == ("png", 300, 200, 3, 1)
+    assert plan.scale == 1
+    # Compressed bytes + PIL buffer + numpy copy + uint8 and CLAHE working planes
+    assert plan.estimate == len(data) + 300 * 200 * 3 * 4
+
+
+def test_plan_for_dicom_counts_frames_and_sample_size():
+    header = {"height": 1000, "width": 800, "channels": 1, "frames": 3, "sample_bytes": 2, "mode": None}
+    plan = DecodePlan.from_header(header, "dicom", 10 * MB)
+    decoded = 1000 * 800 * 3 * 2
+    stretch = 1000 * 800 * 4 + 2 * 1000 * 800
+    assert plan.estimate == 10 * MB + decoded + stretch
+
+
+def test_within_budget_is_left_alone(budget):
+    budget(2048)
+    plan = DecodePlan.from_header({"height": 2000, "width": 2000, "channels": 1, "mode": "L"}, "png", MB)
+    assert not plan.over_budget
+    assert plan.fit_budget() is False
+    assert plan.scale == 1
+
+
+def test_over_budget_downsamples_to_fit(budget):
+    budget(96, max_side=4096)
+    plan = DecodePlan.from_header({"height": 8000, "width": 6000, "channels": 1, "mode": "L"}, "png", 20 * MB)
+    assert plan.over_budget
+    assert plan.fit_budget() is True
+    # PNG still decodes the full 48 MB frame, so the reduced copies must fit in what is left
+    assert plan.scale == 4
+    assert plan.estimate <= 96 * MB
+
+
+@pytest.mark.parametrize("policy", ["queue", "reject"])
+def test_other_policies_never_downsample(budget, policy):
+    budget(1, policy=policy)
+    plan = DecodePlan.from_header({"height": 4000, "width": 4000, "channels": 1, "mode": "L"}, "png", MB)
+    assert plan.over_budget
+    assert plan.fit_budget() is False
+    assert plan.scale == 1
+
+
+def test_jpeg_reduction_skips_the_full_frame():
+    png = DecodePlan("png", 4000, 4000, 1, 1, 1, MB, 0)
+    jpeg = DecodePlan("jpeg", 4000, 4000, 1, 1, 1, MB, 0)
+    png.downsample_to(1000, 10**12)
+    jpeg.downsample_to(1000, 10**12)
+    assert png.scale == jpeg.scale == 4
+    assert png.estimate - jpeg.estimate == 4000 * 4000
+
+
+def test_header_round_trip_replans_identically(budget):
+    budget(64)
+    plan = DecodePlan.from_header({"height": 8000, "width": 6000, "channels": 1, "mode": "L"}, "png", 20 * MB)
+    again = DecodePlan(**plan.header())
+    plan.fit_budget()
+    again.fit_budget()
+    assert again.scale == plan.scale
+    assert again.estimate == plan.estimate
+
+
+def test_decode_honours_the_planned_scale():
+    data = _png(400, 300)
+    assert decode_image(data, "png", 4).shape[:2] == (100, 75)
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from inference import DEFAULT_LABELS, NORMAL_LABEL, SNIFF_BYTES, postprocess_probs_batch, sniff_format
+
+
+def _reference_postprocess(probs, labels=DEFAULT_LABELS):
+    """The original per-row postprocess (before batching), on probabilities instead of logits"""
+    results = [{"label": labels[i] if i < len(labels) else f"Finding_{i}", "confidence": float(p)}
+               for i, p in enumerate(probs)]
+    results.sort(key=lambda d: d["confidence"], reverse=True)
+    no_finding = None
+    pathologies = []
+    for result in results:
+        if "No Finding" in result["label"]:
+            no_finding = result
+        else:
+            pathologies.append(result)
+    if no_finding:
+        max_pathology = max([r["confidence"] for r in pathologies]) if pathologies else 0
+        if no_finding["confidence"] > 0.75 and max_pathology < 0.4:
+            return [{"label": NORMAL_LABEL, "confidence": no_finding["confidence"]}]
+    for result in pathologies:
+        if result["confidence"] < 0.4:
+            result["label"] += " (Low Confidence)"
+        elif result["confidence"] > 0.7:
+            result["label"] += " (High Confidence)"
+    filtered = [r for r in pathologies if r["confidence"] > 0.25]
+    if not filtered:
+        return [{"label": NORMAL_LABEL, "confidence": 0.8}]
+    return filtered[:5]
+
+
+def _assert_same(batch_row, reference):
+    assert [r["label"] for r in batch_row] == [r["label"] for r in reference]
+    assert [r["confidence"] for r in batch_row] == pytest.approx([r["confidence"] for r in reference], abs=1e-6)
+
+
+def test_batch_postprocess_matches_per_row_postprocess():
+    rng = np.random.default_rng(0)
+    probs = rng.random((200, len(DEFAULT_LABELS))).astype(np.float32)
+    # Rows that hit each rule: confident normal, nothing above 0.25, ties, boundary values
+    no_finding = DEFAULT_LABELS.index("No Finding")
+    probs[0] = 0.1
+    probs[0, no_finding] = 0.9
+    probs[1] = 0.2
+    probs[2] = 0.5
+    probs[3] = [0.25, 0.4, 0.7, 0.75, 0.26, 0.39, 0.71, 0.1, 0.3, 0.3, 0.3, 0.69, 0.41, 0.0]
+
+    rows = postprocess_probs_batch(probs)
+
+    assert len(rows) == len(probs)
+    for row, p in zip(rows, probs):
+        _assert_same(row, _reference_postprocess(p))
+    assert rows[0] == [{"label": NORMAL_LABEL, "confidence": pytest.approx(0.9)}]
+    assert rows[1] == [{"label": NORMAL_LABEL, "confidence": 0.8}]
+
+
+def test_batch_postprocess_names_unlabelled_columns():
+    probs = np.full((1, len(DEFAULT_LABELS) + 2), 0.1, dtype=np.float32)
+    probs[0, -1] = 0.9
+    row = postprocess_probs_batch(probs)[0]
+    _assert_same(row, _reference_postprocess(probs[0]))
+    assert row[0]["label"] == f"Finding_{len(DEFAULT_LABELS) + 1} (High Confidence)"
+
+
+@pytest.mark.parametrize("head, kind", [
+    (b"\x89PNG\r\n\x1a\n" + b"\0" * 32, "png"),
+    (b"\xff\xd8\xff\xe0" + b"\0" * 32, "jpeg"),
+    (b"II*\x00" + b"\0" * 32, "tiff"),
+    (b"MM\x00*" + b"\0" * 32, "tiff"),
+    (b"BM" + b"\0" * 32, "bmp"),
+    (b"\0" * 128 + b"DICM" + b"\0" * 16, "dicom"),
+    (b"GIF89a" + b"\0" * 32, None),
+    (b"%PDF-1.7\n" + b"\0" * 32, None),
+    (b"", None),
+])
+def test_sniff_format(head, kind):
+    assert sniff_format(head) == kind
+
+
+def test_sniff_format_reads_only_the_sniff_window():
+    assert sniff_format(b"\0" * SNIFF_BYTES + b"\x89PNG\r\n\x1a\n") is None
+    assert sniff_format(memoryview(b"\0" * 128 + b"DICM" + b"\0" * 1024)) == "dicom"
+
+
+def test_sniff_format_dicom_without_preamble_needs_the_extension():
+    head = b"\x08\x00\x05\x00CS" + b"\0" * 64
+    assert sniff_format(head) is None
+    assert sniff_format(head, "chest.DCM") == "dicom"
+    assert sniff_format(b"\x07\x00" + b"\0" * 64, "chest.dcm") is None
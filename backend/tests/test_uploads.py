@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import uploads
+from admission import RequestDeadline
+from inference import MB, DecodePlan, decode_plan
+from uploads import MemoryBudget
+
+
+def _large_plan():
+    return DecodePlan.from_header({"height": 8000, "width": 8000, "channels": 1, "mode": "L"}, "png", 20 * MB)
+
+
+@pytest.fixture
+def policy(monkeypatch):
+    def configure(name, budget_mb=64):
+        monkeypatch.setattr(uploads, "MEMORY_OVER_BUDGET", name)
+        monkeypatch.setattr(decode_plan, "MEMORY_OVER_BUDGET", name)
+        monkeypatch.setattr(decode_plan, "INFERENCE_MEMORY_BUDGET_MB", budget_mb)
+    return configure
+
+
+def test_plan_rejects_over_budget_images(policy):
+    policy("reject")
+    budget = MemoryBudget(64 * MB)
+    with pytest.raises(HTTPException) as e:
+        budget.plan(_large_plan())
+    assert e.value.status_code == 413
+    assert budget.counters["rejected"] == 1
+
+
+def test_plan_downsamples_over_budget_images(policy):
+    policy("downsample")
+    budget = MemoryBudget(64 * MB)
+    plan = budget.plan(_large_plan())
+    assert plan.scale > 1
+    assert budget.counters["downsampled"] == 1
+
+
+def test_plan_leaves_queued_images_at_full_resolution(policy):
+    policy("queue")
+    budget = MemoryBudget(64 * MB)
+    plan = budget.plan(_large_plan())
+    assert plan.scale == 1
+    assert budget.counters == {"queued": 0, "downsampled": 0, "rejected": 0}
+
+
+def test_reserve_waits_for_room_and_lets_a_lone_request_through():
+    async def scenario():
+        budget = MemoryBudget(100)
+        order = []
+
+        async def hold(name, nbytes, seconds):
+            async with budget.reserve(nbytes):
+                order.append((name, budget.in_use))
+                await asyncio.sleep(seconds)
+
+        first = asyncio.create_task(hold("first", 80, 0.1))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(hold("second", 50, 0))
+        await asyncio.gather(first, second)
+        # Bigger than the whole budget, but alone: admitted rather than waiting forever
+        await hold("oversized", 500, 0)
+        return budget, order
+
+    budget, order = asyncio.run(scenario())
+    assert order == [("first", 80), ("second", 50), ("oversized", 500)]
+    assert budget.in_use == 0
+    assert budget.counters["queued"] == 1
+
+
+def test_reserve_gives_up_at_the_deadline():
+    async def scenario():
+        budget = MemoryBudget(100)
+        async with budget.reserve(80):
+            async with budget.reserve(50, RequestDeadline(0.05)):
+                pass
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(scenario())
+    assert e.value.status_code == 504
@@ -0,0 +1,384 @@
+"""
+Image uploads for the inference endpoints, from the request body to a
+decoded array inside the per-worker memory budget:
+
+    async with decoded_upload(file, deadline) as (image_np, ledger):
+        ...
+
+UploadLimitMiddleware refuses oversized bodies and (on routes marked with
+sniffed_upload) non-image files while they are arriving. The multipart spool
+is then read in place (UploadBuffer), the decode cost is planned from the
+image headers, and the decode runs once the estimate fits the budget.
+"""
+import asyncio
+import contextlib
+import hashlib
+import io
+import os
+import re
+
+import numpy as np
+from fastapi import HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from starlette.formparsers import MultiPartParser
+
+from admission import RequestDeadline
+from inference import (
+    MB,
+    SNIFF_BYTES,
+    DecodePlan,
+    ImageDecodeError,
+    UnsupportedImageError,
+    decode_image,
+    profiling,
+    read_image_header,
+    sniff_format,
+)
+from inference.config import INFERENCE_MEMORY_BUDGET_MB, MEMORY_OVER_BUDGET
+
+# ---------------- Memory budget ----------------
+# Peak memory per request is estimated from image headers before anything is
+# decoded. Requests reserve their estimate against a per-process budget; when a
+# single image would not fit, it is downsampled while decoding (or rejected).
+MEMORY_TRACE = os.getenv("MEMORY_TRACE", "false").lower() == "true"
+
+def plan_decode(source, kind: str) -> DecodePlan:
+    """Estimate decode cost from headers without touching pixel data"""
+    raw_bytes = source.size if isinstance(source, UploadBuffer) else len(source)
+    with profiling.stage("plan"):
+        try:
+            return DecodePlan.from_header(read_image_header(open_upload(source), kind), kind, raw_bytes)
+        except ImportError:
+            raise HTTPException(status_code=415, detail="DICOM not supported on server (install pydicom)")
+        except Exception as e:
+            print(f"[AI] Image header error: {e}")
+            raise HTTPException(status_code=400, detail=f"Invalid image file: {str(e)}")
+
+class MemoryBudget:
+    def __init__(self, budget_bytes: int):
+        self.budget = budget_bytes
+        self.in_use = 0
+        self.counters = {"queued": 0, "downsampled": 0, "rejected": 0}
+        self.max_request_peak = 0
+        self._cond = None
+
+    def plan(self, plan: DecodePlan) -> DecodePlan:
+        if plan.over_budget and MEMORY_OVER_BUDGET == "reject":
+            self.counters["rejected"] += 1
+            raise HTTPException(
+                status_code=413,
+                detail=f"Image needs ~{plan.estimate // MB} MB to process, over the {self.budget // MB} MB budget",
+            )
+        # "queue": reserve() holds an over-budget plan until it can run with the worker to itself
+        if plan.fit_budget():
+            self.counters["downsampled"] += 1
+            print(f"[AI] Over memory budget, downsampling {plan.width}x{plan.height} by {plan.scale}")
+        return plan
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, nbytes: int, deadline: RequestDeadline = None):
+        """Hold `nbytes` of the budget; waits (bounded by the deadline) while others release theirs"""
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        async with self._cond:
+            if self.in_use and self.in_use + nbytes > self.budget:
+                self.counters["queued"] += 1
+            # A lone request is always let through so an oversized one can't wait forever
+            while self.in_use and self.in_use + nbytes > self.budget:
+                if deadline is not None:
+                    deadline.check("memory")
+                try:
+                    await asyncio.wait_for(self._cond.wait(), timeout=0.25)
+                except asyncio.TimeoutError:
+                    pass
+            self.in_use += nbytes
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self.in_use -= nbytes
+                self._cond.notify_all()
+
+    def record_peak(self, nbytes: int):
+        self.max_request_peak = max(self.max_request_peak, nbytes)
+
+    def metrics(self) -> dict:
+        return {
+            "budget_mb": round(self.budget / MB, 1),
+            "in_use_mb": round(self.in_use / MB, 1),
+            "max_request_peak_mb": round(self.max_request_peak / MB, 1),
+            "counters": dict(self.counters),
+        }
+
+memory_budget = MemoryBudget(int(INFERENCE_MEMORY_BUDGET_MB * MB))
+
+class MemoryLedger:
+    """
+    Per-request estimate of the large buffers a request holds at each stage
+    (decoded image, tensor, ...), counted from their nbytes. With
+    MEMORY_TRACE=true, tracemalloc runs while a stage does and the growth it
+    sees is recorded as well; it is process-wide, so that figure includes
+    whatever overlapping requests allocated.
+    """
+
+    def __init__(self):
+        self.live = {}
+        self.peak = 0
+        self.traced_peak = 0
+
+    def hold(self, name: str, nbytes: int):
+        self.live[name] = nbytes
+        self.peak = max(self.peak, sum(self.live.values()))
+
+    def drop(self, name: str):
+        self.live.pop(name, None)
+
+    @contextlib.contextmanager
+    def stage(self):
+        if not MEMORY_TRACE:
+            yield
+            return
+        import tracemalloc
+        profiling.trace_memory_acquire()
+        baseline, peak_before = tracemalloc.get_traced_memory()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            # The peak is shared with every other tracer, so it only counts when this stage raised it
+            grown = peak - baseline if peak > peak_before else current - baseline
+            self.traced_peak = max(self.traced_peak, grown)
+            profiling.trace_memory_release()
+
+    def info(self) -> dict:
+        info = {"estimated_peak_mb": round(self.peak / MB, 1)}
+        if MEMORY_TRACE:
+            info["traced_peak_mb"] = round(self.traced_peak / MB, 1)
+        return info
+
+# ---------------- Uploads ----------------
+# Uploads are spooled by the multipart parser (memory up to UPLOAD_SPOOL_MB,
+# then a temp file) and decoded in place from that spool. Oversized bodies and
+# files that are not a supported image are refused while the body is arriving.
+MAX_UPLOAD_MB = float(os.getenv("MAX_UPLOAD_MB", "64"))
+UPLOAD_SPOOL_MB = float(os.getenv("UPLOAD_SPOOL_MB", "4"))
+SNIFFED_UPLOAD_PATHS = set()  # filled by sniffed_upload() on the routes that take an image `file`
+_SNIFF_WINDOW = 64 * 1024
+
+MultiPartParser.spool_max_size = int(UPLOAD_SPOOL_MB * MB)
+
+def sniffed_upload(path: str) -> str:
+    """Route path wrapper: uploads to this route are magic-byte checked while they arrive"""
+    SNIFFED_UPLOAD_PATHS.add(path)
+    return path
+
+def _sniff_multipart_head(head: bytes):
+    """
+    Look for the `file` part in the first chunk(s) of a multipart body.
+    Returns (decided, kind); undecided until enough of the part has arrived.
+    """
+    start = head.find(b'name="file"')
+    if start < 0:
+        return False, None
+    header_end = head.find(b"\r\n\r\n", start)
+    if header_end < 0:
+        return False, None
+    filename = re.search(rb'filename="([^"]*)"', head[start:header_end])
+    data = head[header_end + 4:header_end + 4 + SNIFF_BYTES]
+    kind = sniff_format(data, filename.group(1).decode(errors="replace") if filename else None)
+    if kind or len(data) >= SNIFF_BYTES:
+        return True, kind
+    return False, None
+
+def upload_too_large() -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Upload exceeds the {MAX_UPLOAD_MB:g} MB limit")
+
+def unsupported_upload() -> HTTPException:
+    return HTTPException(status_code=415, detail="Unsupported file type; upload a DICOM, PNG, JPEG, TIFF or BMP image")
+
+class UploadLimitMiddleware:
+    """
+    Counts multipart body bytes as they are received and sniffs the `file` part
+    of prediction uploads, raising 413/415 from the receive channel so the
+    parser stops reading. Declared Content-Length is checked before any read.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("method") != "POST":
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get("headers") or [])
+        if not headers.get(b"content-type", b"").startswith(b"multipart/form-data"):
+            return await self.app(scope, receive, send)
+
+        limit = int(MAX_UPLOAD_MB * MB)
+        declared = headers.get(b"content-length", b"")
+        oversized = declared.isdigit() and int(declared) > limit
+        sniffing = scope.get("path") in SNIFFED_UPLOAD_PATHS
+        head = bytearray()
+        received = 0
+
+        async def limited_receive():
+            nonlocal received, sniffing
+            if oversized:
+                raise upload_too_large()
+            message = await receive()
+            if message["type"] != "http.request":
+                return message
+            body = message.get("body", b"")
+            received += len(body)
+            if received > limit:
+                raise upload_too_large()
+            if sniffing:
+                head.extend(body[:_SNIFF_WINDOW - len(head)])
+                decided, kind = _sniff_multipart_head(head)
+                if decided and kind is None:
+                    raise unsupported_upload()
+                if decided or len(head) >= _SNIFF_WINDOW:
+                    sniffing = False
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+class _MemoryviewReader(io.RawIOBase):
+    """Seekable read-only file over a memoryview; each read copies only the slice asked for"""
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(self._pos + size, len(self._view))
+        data = self._view[self._pos:end].tobytes()
+        self._pos = max(end, self._pos)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        n = max(min(len(b), len(self._view) - self._pos), 0)
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+class UploadBuffer:
+    """
+    An uploaded file viewed in place: a memoryview over the parser's in-memory
+    spool, or over an mmap of its temp file once it has rolled to disk.
+    """
+
+    def __init__(self, upload: UploadFile, digest: bool = False):
+        spool = upload.file
+        spool.seek(0, os.SEEK_END)
+        self.size = spool.tell()
+        spool.seek(0)
+        self._mmap = None
+        # SpooledTemporaryFile keeps its in-memory buffer in the private `_file`;
+        # anything else goes through fileno(), which rolls a spool over to disk
+        inner = getattr(spool, "_file", None)
+        self.in_memory = isinstance(inner, io.BytesIO)
+        if self.in_memory:
+            self.view = inner.getbuffer()
+        elif self.size:
+            import mmap
+            try:
+                self._mmap = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self._mmap)
+            except (AttributeError, OSError, ValueError):  # no backing file descriptor
+                self.in_memory = True
+                self.view = memoryview(spool.read())
+        else:
+            self.view = memoryview(b"")
+        self.kind = sniff_format(self.view[:SNIFF_BYTES], upload.filename)
+        # sha256 over the view in place, in the same worker-thread hop that opened it
+        self.digest = hashlib.sha256(self.view).hexdigest() if digest else None
+
+    def validate(self):
+        if self.size == 0:
+            raise HTTPException(status_code=400, detail="Empty file")
+        if self.size > MAX_UPLOAD_MB * MB:
+            raise upload_too_large()
+        if self.kind is None:
+            raise unsupported_upload()
+
+    def reader(self) -> io.RawIOBase:
+        return _MemoryviewReader(self.view)
+
+    def close(self):
+        # The spool can't be closed (or the mmap unmapped) while a view is exported
+        with contextlib.suppress(BufferError):
+            self.view.release()
+        if self._mmap is not None:
+            with contextlib.suppress(BufferError):
+                self._mmap.close()
+
+def open_upload(source) -> io.IOBase:
+    """File object for a decoder: reads an UploadBuffer in place, wraps plain bytes"""
+    if isinstance(source, UploadBuffer):
+        return source.reader()
+    return io.BytesIO(source)
+
+# ---------------- Decoding ----------------
+def _decode_image(source, kind: str, deadline: RequestDeadline = None,
+                  plan: DecodePlan = None, ledger: MemoryLedger = None) -> np.ndarray:
+    """
+    Decode an uploaded DICOM or raster image into a numpy array, reduced by
+    plan.scale when the plan asks for it. Multi-frame DICOMs yield their first frame.
+    """
+    if deadline is not None:
+        deadline.check("decode")
+    try:
+        image_np = decode_image(open_upload(source), kind, plan.scale if plan is not None else 1)
+    except UnsupportedImageError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except ImageDecodeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if ledger is not None:
+        ledger.hold("decoded", image_np.nbytes)
+    return image_np
+
+@contextlib.asynccontextmanager
+async def decoded_upload(file, deadline: RequestDeadline = None):
+    """
+    Read and decode an upload (an UploadFile, or an UploadBuffer the caller
+    already opened) inside the memory budget. Yields (image_np, ledger); the
+    reservation is held until the caller has finished with the image.
+    """
+    upload = file if isinstance(file, UploadBuffer) else await run_in_threadpool(UploadBuffer, file)
+    try:
+        print(f"[AI] File size: {upload.size} bytes ({upload.kind}, {'memory' if upload.in_memory else 'disk'} spool)")
+        upload.validate()
+        ledger = MemoryLedger()
+        ledger.hold("raw", upload.size if upload.in_memory else 0)
+        plan = memory_budget.plan(await run_in_threadpool(plan_decode, upload, upload.kind))
+        async with memory_budget.reserve(plan.estimate, deadline):
+            with ledger.stage():
+                image_np = await run_in_threadpool(_decode_image, upload, upload.kind, deadline, plan, ledger)
+            upload.close()
+            ledger.drop("raw")
+            with ledger.stage():
+                yield image_np, ledger
+    finally:
+        upload.close()
+    memory_budget.record_peak(ledger.peak)
+    print(f"[AI] Memory: planned {plan.info()}, held (estimate) {ledger.info()}")
@@ -0,0 +1,56 @@
+import { supabase } from './supabase'
+
+export const API_URL = 'http://localhost:8000'
+
+// fetch() against the backend with the current session's bearer token; resolves to the JSON body
+export async function apiFetch(path, options = {}) {
+  const { data: { session } } = await supabase.auth.getSession()
+  if (!session) throw new Error('No active session')
+  const response = await fetch(`${API_URL}${path}`, {
+    ...options,
+    headers: {
+      'Authorization': `Bearer ${session.access_token}`,
+      ...(options.headers || {})
+    }
+  })
+  if (!response.ok) throw new Error(`Request failed: ${response.statusText}`)
+  return response.json()
+}
+
+// fetch() against a backend endpoint that answers with server-sent events; calls onEvent(name, data) per event
+export async function apiStream(path, options = {}, onEvent) {
+  const { data: { session } } = await supabase.auth.getSession()
+  if (!session) throw new Error('No active session')
+  const response = await fetch(`${API_URL}${path}`, {
+    ...options,
+    headers: {
+      'Authorization': `Bearer ${session.access_token}`,
+      'Accept': 'text/event-stream',
+      ...(options.headers || {})
+    }
+  })
+  if (!response.ok) {
+    const body = await response.json().catch(() => ({}))
+    throw new Error(body.detail || `Request failed: ${response.statusText}`)
+  }
+  const reader = response.body.getReader()
+  const decoder = new TextDecoder()
+  let buffer = ''
+  while (true) {
+    const { value, done } = await reader.read()
+    if (done) break
+    buffer += decoder.decode(value, { stream: true })
+    let end
+    while ((end = buffer.indexOf('\n\n')) !== -1) {
+      const frame = buffer.slice(0, end)
+      buffer = buffer.slice(end + 2)
+      let name = 'message'
+      const data = []
+      for (const line of frame.split('\n')) {
+        if (line.startsWith('event:')) name = line.slice(6).trim()
+        else if (line.startsWith('data:')) data.push(line.slice(5).trimStart())
+      }
+      if (data.length) onEvent(name, JSON.parse(data.join('\n')))
+    }
+  }
+}
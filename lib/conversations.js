@@ -0,0 +1,19 @@
+import { apiFetch } from './api'
+
+// Inbox page: { conversations: [{ peer_id, peer, last_message, unread_count }], next_cursor }
+export function listConversations(cursor = null, limit = 30) {
+  const params = new URLSearchParams({ limit: String(limit) })
+  if (cursor) params.set('cursor', cursor)
+  return apiFetch(`/api/conversations?${params}`)
+}
+
+// One page of history, newest first: { messages, next_cursor }; pass next_cursor as `before` for older ones
+export function loadConversationMessages(peerId, before = null, limit = 50) {
+  const params = new URLSearchParams({ limit: String(limit) })
+  if (before) params.set('before', before)
+  return apiFetch(`/api/conversations/${peerId}/messages?${params}`)
+}
+
+export function markConversationRead(peerId) {
+  return apiFetch(`/api/conversations/${peerId}/read`, { method: 'POST' })
+}
@@ -0,0 +1,14 @@
+import { apiFetch } from './api'
+
+// Display fields for many users in one backend call (served from its shared cache).
+// Returns { [id]: { id, username, email, first_name, last_name, role, display_name } }
+export async function resolveProfiles(ids) {
+  const unique = Array.from(new Set(ids.filter(Boolean)))
+  if (!unique.length) return {}
+  const { profiles } = await apiFetch('/api/profiles/resolve', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ ids: unique })
+  })
+  return profiles || {}
+}